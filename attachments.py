@@ -0,0 +1,155 @@
+# attachments.py
+import io
+import mimetypes
+import mmap
+import os
+import tempfile
+from base64 import b64encode
+from bisect import bisect_right
+from functools import lru_cache
+from hashlib import sha256
+import gridfs
+from db import get_db, now
+
+# Content-addressed store: <dir>/<sha[:2]>/<sha> holds the file, <sha>.b64 its base64 MIME body, encoded once
+ATTACHMENT_DIR = os.getenv("MASSMAIL_ATTACHMENT_DIR",
+                           os.path.join(os.path.dirname(os.path.abspath(__file__)), "attachments"))
+# "gridfs" also keeps every file in Mongo so other hosts (e.g. a separate scheduler) can fetch it by hash
+ATTACHMENT_STORE = os.getenv("MASSMAIL_ATTACHMENT_STORE", "local")
+MAX_ATTACHMENT_BYTES = 25 * 1024 * 1024  # Gmail's per-message attachment limit
+READ_CHUNK = 57 * 16 * 1024  # a multiple of 57 bytes, so every chunk encodes to whole 76-character lines
+LINE_BYTES = 57
+MAPPED_FILES = 64  # encoded bodies kept memory-mapped; the pages live in the OS cache, shared by every send
+
+
+def _path(sha, suffix=""):
+    return os.path.join(ATTACHMENT_DIR, sha[:2], sha + suffix)
+
+def _move_into_place(tmp_name, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(path):
+        os.unlink(tmp_name)
+    else:
+        os.replace(tmp_name, path)
+
+def _encode(sha):
+    """Write the base64 body (CRLF-folded at 76 characters) next to the file, streaming so memory stays flat."""
+    encoded = _path(sha, ".b64")
+    if os.path.exists(encoded):
+        return encoded
+    with open(_path(sha), "rb") as src, tempfile.NamedTemporaryFile(dir=ATTACHMENT_DIR, delete=False) as tmp:
+        for chunk in iter(lambda: src.read(READ_CHUNK), b""):
+            tmp.write(b"".join(b64encode(chunk[i:i + LINE_BYTES]) + b"\r\n" for i in range(0, len(chunk), LINE_BYTES)))
+    _move_into_place(tmp.name, encoded)
+    return encoded
+
+def _bucket(db):
+    return gridfs.GridFSBucket(db, bucket_name="attachment_blobs")
+
+def _register(ref):
+    client, db = get_db()
+    if db is None:
+        return
+    try:
+        db.attachments.update_one({"_id": ref["sha256"]},
+                                  {"$setOnInsert": {"size": ref["size"], "content_type": ref["content_type"],
+                                                    "filename": ref["filename"], "created_at": now()}}, upsert=True)
+        if ATTACHMENT_STORE == "gridfs" and db.attachment_blobs.files.find_one({"_id": ref["sha256"]}, {"_id": 1}) is None:
+            with open(_path(ref["sha256"]), "rb") as src:
+                _bucket(db).upload_from_stream_with_id(ref["sha256"], ref["filename"], src)
+    finally:
+        client.close()
+
+def store_attachment(fileobj, filename, content_type=None):
+    """Hash an upload while copying it into the store; identical content is kept and encoded only once."""
+    os.makedirs(ATTACHMENT_DIR, exist_ok=True)
+    digest, size = sha256(), 0
+    with tempfile.NamedTemporaryFile(dir=ATTACHMENT_DIR, delete=False) as tmp:
+        for chunk in iter(lambda: fileobj.read(READ_CHUNK), b""):
+            size += len(chunk)
+            if size > MAX_ATTACHMENT_BYTES:
+                tmp.close()
+                os.unlink(tmp.name)
+                raise ValueError(f"{filename} is larger than {MAX_ATTACHMENT_BYTES // (1024 * 1024)} MB")
+            digest.update(chunk)
+            tmp.write(chunk)
+    sha = digest.hexdigest()
+    _move_into_place(tmp.name, _path(sha))
+    _encode(sha)
+    ref = {"sha256": sha, "filename": filename, "size": size,
+           "content_type": content_type or mimetypes.guess_type(filename)[0] or "application/octet-stream"}
+    _register(ref)
+    return ref
+
+def _fetch(sha):
+    """Copy a file this host has not seen from GridFS into the local store."""
+    client, db = get_db()
+    if db is None:
+        raise FileNotFoundError(sha)
+    try:
+        os.makedirs(ATTACHMENT_DIR, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=ATTACHMENT_DIR, delete=False) as tmp:
+            try:
+                _bucket(db).download_to_stream(sha, tmp)
+            except gridfs.errors.NoFile:
+                tmp.close()
+                os.unlink(tmp.name)
+                raise FileNotFoundError(sha)
+        _move_into_place(tmp.name, _path(sha))
+    finally:
+        client.close()
+
+@lru_cache(maxsize=MAPPED_FILES)
+def encoded_body(sha):
+    """Read-only view of the attachment's base64 body, memory-mapped rather than read per send."""
+    if not os.path.exists(_path(sha, ".b64")):
+        if not os.path.exists(_path(sha)):
+            if ATTACHMENT_STORE != "gridfs":
+                raise FileNotFoundError(sha)
+            _fetch(sha)
+        _encode(sha)
+    with open(_path(sha, ".b64"), "rb") as fp:
+        if os.fstat(fp.fileno()).st_size == 0:
+            return memoryview(b"")
+        return memoryview(mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+class MessageStream(io.RawIOBase):
+    """Seekable read-only concatenation of byte segments, handed to the Gmail media upload without joining them."""
+
+    def __init__(self, segments):
+        self._segments = [memoryview(s) for s in segments]
+        self._starts = []
+        total = 0
+        for segment in self._segments:
+            self._starts.append(total)
+            total += len(segment)
+        self.size = total
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: self.size}[whence]
+        self._pos = max(0, base + offset)
+        return self._pos
+
+    def readinto(self, buffer):
+        written = 0
+        index = bisect_right(self._starts, self._pos) - 1
+        while written < len(buffer) and 0 <= index < len(self._segments) and self._pos < self.size:
+            segment = self._segments[index]
+            offset = self._pos - self._starts[index]
+            n = min(len(buffer) - written, len(segment) - offset)
+            buffer[written:written + n] = segment[offset:offset + n]
+            written += n
+            self._pos += n
+            index += 1
+        return written
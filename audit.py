@@ -0,0 +1,185 @@
+# audit.py
+"""Audit log of admin actions: who did what to which user, contact, template or scheduled email.
+
+record() only appends to an in-process buffer, so a page never waits on the write; one flusher thread per
+process inserts the buffer in batches. Entries live in `audit_log`, which a TTL index on `at` trims after
+MASSMAIL_AUDIT_RETENTION_DAYS (a TTL rather than a capped collection, so retention is by age, not by how busy
+the app was). Indexes on actor, action and target serve the filters of the audit page.
+"""
+import atexit
+import logging
+import threading
+from collections import deque
+from datetime import datetime, time as dt_time, timedelta
+import pandas as pd
+import streamlit as st
+from bson import ObjectId
+from pymongo.errors import BulkWriteError, PyMongoError
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from db import DEFAULT_TENANT, current_tenant, get_db, now
+import metrics
+import profiler
+import session
+
+FLUSH_SIZE = 500  # entries per insert_many
+FLUSH_INTERVAL = 1.0  # seconds between flushes of a partly filled buffer
+MAX_BUFFERED = 50000  # entries held while the database is unreachable; later ones are dropped and counted
+PAGE_SIZE = 200
+SYSTEM_ACTOR = "system"  # scheduler, CLI and anything else outside a signed-in page
+
+ACTIONS = (
+    "user.create", "user.update", "user.delete",
+    "contact.create", "contact.update", "contact.delete", "contact.import",
+    "template.create", "template.update", "template.delete",
+    "scheduled_email.delete", "scheduled_email.cancel", "scheduled_email.reschedule", "scheduled_email.retry",
+    "export.import",
+)
+
+logger = logging.getLogger(__name__)
+
+
+def current_actor():
+    """(user id, username) of the admin signed in to this page run, or the system actor outside one."""
+    if get_script_run_ctx() is None:
+        return None, SYSTEM_ACTOR
+    principal = session.get_principal(st.session_state.get("principal_id"))
+    if principal is None:
+        return None, SYSTEM_ACTOR
+    return principal["user_id"], principal["username"]
+
+
+class AuditBuffer:
+    """Entries appended by page runs and inserted in bulk by one flusher thread."""
+
+    def __init__(self, flush_size=FLUSH_SIZE, flush_interval=FLUSH_INTERVAL, max_buffered=MAX_BUFFERED):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_buffered = max_buffered
+        self._entries = deque()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, entry):
+        if len(self._entries) >= self.max_buffered:
+            metrics.incr("audit_entries_dropped_total")
+            return False
+        self._entries.append(entry)
+        self.start()
+        if len(self._entries) >= self.flush_size:
+            self._wake.set()
+        return True
+
+    def flush(self):
+        """Insert everything buffered, flush_size entries per round trip; returns the number written."""
+        if not self._entries:
+            return 0
+        client, db = get_db(unscoped=True)  # the buffer holds entries of every tenant active in this process
+        if db is None:
+            return 0
+        written = 0
+        try:
+            while self._entries:
+                batch = []
+                while self._entries and len(batch) < self.flush_size:
+                    batch.append(self._entries.popleft())
+                try:
+                    db.audit_log.insert_many(batch, ordered=False)
+                except PyMongoError as e:
+                    # Entries carry their _id, so retrying a partly written batch only repeats duplicate-key errors
+                    if not isinstance(e, BulkWriteError) or any(
+                            err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+                        logger.warning(f"Could not write {len(batch)} audit entries, retrying: {e}")
+                        self._entries.extendleft(reversed(batch))
+                        break
+                written += len(batch)
+            return written
+        finally:
+            client.close()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="audit-flush", daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Audit flush failed: {e}")
+
+
+buffer = AuditBuffer()
+
+def record(action, target_type, target_id=None, target=None, **details):
+    """Queue one audit entry; returns at once. details must not hold secrets such as passwords."""
+    actor_id, actor = current_actor()
+    buffer.add({"_id": ObjectId(), "tenant_id": current_tenant() or DEFAULT_TENANT, "at": now(),
+                "actor_id": actor_id, "actor": actor, "action": action,
+                "target_type": target_type, "target_id": None if target_id is None else str(target_id),
+                "target": target, "details": details})
+
+
+def build_filter(actor=None, action=None, target=None, start=None, end=None):
+    query = {}
+    if actor:
+        query["actor"] = actor
+    if action:
+        query["action"] = action
+    if target:
+        query["$or"] = [{"target_id": target}, {"target": target}]
+    if start or end:
+        query["at"] = {}
+        if start:
+            query["at"]["$gte"] = start
+        if end:
+            query["at"]["$lt"] = end
+    return query
+
+def fetch_entries(db, query, limit=PAGE_SIZE):
+    return list(db.audit_log.find(query).sort([("at", -1), ("_id", -1)]).limit(limit))
+
+
+@profiler.page("audit")
+def show_audit_log():
+    st.title("Audit log")
+    st.markdown("-------------------------------------------------------------------------------------------------------------------")
+    col1, col2, col3 = st.columns(3)
+    actor = col1.text_input("Actor (username)").strip()
+    action = col2.selectbox("Action", ["All", *ACTIONS])
+    target = col3.text_input("Target (id, username or name)").strip()
+    col4, col5 = st.columns(2)
+    start_date = col4.date_input("From", value=datetime.now().date() - timedelta(days=7))
+    end_date = col5.date_input("To", value=datetime.now().date())
+
+    client, db = get_db()
+    if db is None:
+        st.error("Could not connect to the database.")
+        return
+    try:
+        buffer.flush()  # this process's own recent actions show up at once
+        query = build_filter(actor, None if action == "All" else action, target,
+                             datetime.combine(start_date, dt_time.min), datetime.combine(end_date + timedelta(days=1), dt_time.min))
+        entries = fetch_entries(db, query)
+        if not entries:
+            st.info("No audit entries match these filters.")
+            return
+        st.dataframe(pd.DataFrame([{"At": e["at"], "Actor": e.get("actor"), "Action": e.get("action"),
+                                    "Target type": e.get("target_type"), "Target id": e.get("target_id"),
+                                    "Target": e.get("target"),
+                                    "Details": ", ".join(f"{k}={v}" for k, v in (e.get("details") or {}).items())}
+                                   for e in entries]))
+        if len(entries) == PAGE_SIZE:
+            st.caption(f"Showing the latest {PAGE_SIZE} entries; narrow the filters to see older ones.")
+    except Exception as e:
+        st.error(f"Error reading the audit log: {e}")
+    finally:
+        client.close()
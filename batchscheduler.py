@@ -0,0 +1,348 @@
+# batchscheduler.py
+import logging
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+from db import DEFAULT_TENANT, get_db, tenant_db, to_object_id, now
+from throttle import AdaptiveThrottle, is_throttling_error
+from renderpool import MIN_POOLED, RENDER_PROCESSES, RenderPool
+import contacts
+import metrics
+import recipients
+from recipients import FAILED, SENT, RecipientSet
+import sendmail
+import tracking
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 5  # seconds between polls of scheduled_emails
+SEND_CONCURRENCY = 8  # sends in flight; each sender thread builds one Gmail service and reuses it
+DISPATCH_CHUNK = 500  # jobs one worker claims, sends and writes back per round; the rest stay for other workers
+CLAIM_TIMEOUT = timedelta(minutes=15)  # claims not renewed for this long are handed back to Pending
+CLAIM_RENEWAL = timedelta(minutes=1)  # how often a worker refreshes claimed_at while it still works on a claim
+LEASE_TTL = timedelta(seconds=60)  # a leader that stops renewing for this long is replaced
+MAINTENANCE_LEASE = "scheduler-maintenance"
+
+
+def release_stale_claims(db):
+    res = db.scheduled_emails.update_many(
+        {"status": "Sending", "claimed_at": {"$lt": now() - CLAIM_TIMEOUT}},
+        {"$set": {"status": "Pending"}, "$unset": {"claim": ""}},
+    )
+    if res.modified_count:
+        logger.warning(f"Released {res.modified_count} stale scheduled email claim(s).")
+
+def renew_claims(db, claims):
+    """Refresh claimed_at so release_stale_claims leaves these claims alone while their worker is still on them."""
+    db.scheduled_emails.update_many({"claim": {"$in": list(claims)}, "status": "Sending"}, {"$set": {"claimed_at": now()}})
+
+def claim_due_emails(db, worker_id, due, limit=DISPATCH_CHUNK):
+    """Claim up to `limit` Pending emails due by `due` (UTC) and return them, oldest first.
+
+    Concurrent workers may pick the same ids, but the update only takes those still Pending and due,
+    so each email ends up claimed by exactly one of them.
+    """
+    claim = f"{worker_id}:{uuid.uuid4().hex}"
+    due_filter = {"status": "Pending", "next_run_at": {"$lte": due}}
+    # Range scan on the (status, next_run_at) index; only due work is touched
+    ids = [d["_id"] for d in db.scheduled_emails.find(due_filter, {"_id": 1}).sort("next_run_at", 1).limit(limit)]
+    if not ids:
+        return []
+    db.scheduled_emails.update_many(
+        {"_id": {"$in": ids}, **due_filter},
+        {"$set": {"status": "Sending", "claim": claim, "claimed_at": now()}},
+    )
+    return list(db.scheduled_emails.find({"claim": claim}).sort("next_run_at", 1))
+
+def acquire_lease(db, name, holder, ttl=LEASE_TTL):
+    """Take or renew the named lease; True while `holder` is the one worker that should run singleton tasks."""
+    try:
+        db.leases.find_one_and_update(
+            {"_id": name, "$or": [{"holder": holder}, {"expires_at": {"$lt": now()}}]},
+            {"$set": {"holder": holder, "expires_at": now() + ttl}},
+            upsert=True,
+        )
+        return True
+    except DuplicateKeyError:
+        # The lease exists and is held by a live worker, so the upsert's insert collided
+        return False
+
+def pause_campaign(db, campaign_id, seconds):
+    """Push every still-pending chunk of a throttled campaign back after a provider error."""
+    try:
+        db.scheduled_emails.update_many(
+            {"campaign_id": campaign_id, "status": "Pending"},
+            [{"$set": {"next_run_at": {"$add": ["$next_run_at", seconds * 1000]}}}],
+        )
+        logger.warning(f"Provider throttling: paused campaign {campaign_id} for {seconds}s.")
+    except Exception as e:
+        # The shared token bucket still holds the campaign back
+        logger.error(f"Could not pause campaign {campaign_id}: {e}")
+
+def sender_key(job):
+    return job.get("tenant_id") or DEFAULT_TENANT, job.get("user_id")
+
+def fetch_senders(db, keys):
+    """Map each (tenant_id, user_id) of a scheduled email to its sender address with one users query per tenant.
+
+    A user_id is a user's _id or, for older emails, a username; usernames are only unique within a tenant, so
+    each tenant's are looked up in its own users.
+    """
+    by_tenant = {}
+    for tenant_id, user_id in keys:
+        by_tenant.setdefault(tenant_id, set()).add(user_id)
+    senders = {}
+    for tenant_id, user_ids in by_tenant.items():
+        oids = [oid for oid in (to_object_id(u) for u in user_ids) if oid]
+        names = [u for u in user_ids if u and not to_object_id(u)]
+        users = tenant_db(db, tenant_id).users
+        for user in users.find({"$or": [{"_id": {"$in": oids}}, {"username": {"$in": names}}]}, {"username": 1}):
+            senders[(tenant_id, str(user["_id"]))] = user.get("username")
+            senders[(tenant_id, user.get("username"))] = user.get("username")
+    return senders
+
+def suppress_recipients(db, recipient_sets):
+    """Mark addresses on the suppression list (one document per lower-cased address as _id) in every set."""
+    addresses = {a for recipient_set in recipient_sets for a in recipient_set}
+    if not addresses:
+        return
+    suppressed = [d["_id"] for d in db.suppressions.find({"_id": {"$in": list(addresses)}}, {"_id": 1})]
+    for recipient_set in recipient_sets:
+        recipient_set.suppress(suppressed)
+
+
+class BatchScheduler:
+    def __init__(self, poll_interval=POLL_INTERVAL, concurrency=SEND_CONCURRENCY, service_factory=None,
+                 claim_batch=DISPATCH_CHUNK, render_processes=RENDER_PROCESSES):
+        self.poll_interval = poll_interval
+        self.claim_batch = claim_batch
+        self.render_pool = RenderPool(render_processes) if render_processes else None
+        self.service_factory = service_factory or sendmail.authenticate_gmail_api
+        self.worker_id = uuid.uuid4().hex
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="batch-sender")
+        self._local = threading.local()
+        self._stop = threading.Event()
+        self._thread = None
+        self._backfilled = False
+        self.throttle = AdaptiveThrottle()
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="batch-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        self._executor.shutdown(wait=True)
+        if self.render_pool:
+            self.render_pool.shutdown()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f"Batch scheduler poll failed: {e}")
+            self._stop.wait(self.poll_interval)
+
+    def run_once(self, due=None):
+        """Claim and send everything due, using one DB connection for the whole window."""
+        client, db = get_db()
+        if db is None:
+            logger.error("No DB")
+            return 0
+        try:
+            # Stale-claim recovery and backfills run on one worker at a time
+            if acquire_lease(db, MAINTENANCE_LEASE, self.worker_id):
+                if not self._backfilled:
+                    sendmail.backfill_next_run_at(db)
+                    contacts.migrate_legacy(db)
+                    self._backfilled = True
+                release_stale_claims(db)
+            due = due or now()
+            processed = 0
+            # Claim in batches so other workers share a large backlog instead of one taking all of it
+            while not self._stop.is_set():
+                jobs = claim_due_emails(db, self.worker_id, due, self.claim_batch)
+                if not jobs:
+                    break
+                self.dispatch(db, jobs)
+                processed += len(jobs)
+            if processed:
+                logger.info(f"Batch scheduler processed {processed} scheduled email(s).")
+            return processed
+        finally:
+            client.close()
+
+    def dispatch(self, db, jobs):
+        senders = fetch_senders(db, {sender_key(job) for job in jobs})
+        status_ops, sent_per_user, paused = [], {}, {}
+        to_sets = {job["_id"]: RecipientSet.from_text(job.get("to_emails")) for job in jobs}
+        suppress_recipients(db, to_sets.values())
+
+        # The claims are renewed as metering, rendering and sending progress, so a slow dispatch is not released
+        # and sent again by another worker
+        claims, renewed = {job["claim"] for job in jobs}, now()
+
+        # Throttled campaign chunks only go out while their campaign's bucket has room
+        ready = []
+        for job in jobs:
+            wait = self._meter(db, job, to_sets[job["_id"]])
+            if wait:
+                status_ops.append(self._defer(job, wait))
+            else:
+                ready.append(job)
+            renewed = self._renew(db, claims, renewed)
+        personal = self._personalization(db, ready, to_sets)
+        # Sends of the first rendered chunk start while the render pool works on the next
+        futures = []
+        for job, raw in zip(ready, self._rendered(ready, senders, to_sets, personal)):
+            futures.append(self._executor.submit(self._send, job, senders.get(sender_key(job)), to_sets[job["_id"]], raw,
+                                                 personal.get(job["_id"])))
+            renewed = self._renew(db, claims, renewed)
+        errors = []
+        for future in futures:
+            errors.append(future.result())
+            renewed = self._renew(db, claims, renewed)
+
+        for job, error in zip(ready, errors):
+            throttle = job.get("throttle")
+            to_set = to_sets[job["_id"]]
+            if throttle and is_throttling_error(error):
+                backoff = self.throttle.on_error(db, job["campaign_id"], throttle["rate_per_minute"])
+                paused[job["campaign_id"]] = max(backoff, paused.get(job["campaign_id"], 0))
+                # A personalized job that already reached some of its recipients is finished, not sent to them again
+                if not to_set.status(SENT).any():
+                    status_ops.append(self._defer(job, backoff))
+                    continue
+            elif throttle and error is None:
+                self.throttle.on_success(db, job["campaign_id"], throttle["rate_per_minute"])
+            to_set.mark(SENT if error is None else FAILED, to_set.pending())
+            update = sendmail.completion_update(job, error is None)
+            update["$set"]["recipient_counts"] = {status: n for status, n in to_set.counts().items() if status != "pending"}
+            update["$unset"] = {"claim": ""}
+            status_ops.append(UpdateOne({"_id": job["_id"], "claim": job["claim"]}, update))
+            reached = int(to_set.status(SENT).sum())
+            if error is None or (job["_id"] in personal and reached):
+                num_sent = reached + recipients.count(job.get("cc")) + recipients.count(job.get("bcc"))
+                key = sender_key(job)
+                sent, messages = sent_per_user.get(key, (0, 0))
+                sent_per_user[key] = (sent + num_sent, messages + (reached if job["_id"] in personal else 1))
+        # Shift the rest of a paused campaign first so the chunks deferred below are not pushed back twice
+        for campaign_id, backoff in paused.items():
+            pause_campaign(db, campaign_id, backoff)
+        res = db.scheduled_emails.bulk_write(status_ops, ordered=False)
+        lost = len(status_ops) - res.matched_count
+        if lost:
+            # Released as stale and taken by another worker before this one finished; their status is not written
+            logger.error(f"Lost the claim on {lost} scheduled email(s) before writing their status.")
+            metrics.incr("scheduler_lost_claims_total", lost)
+        if sent_per_user:
+            db.email_stats.bulk_write(
+                [UpdateOne({"tenant_id": tenant_id, "user_id": uid}, sendmail.stats_update(*counts), upsert=True)
+                 for (tenant_id, uid), counts in sent_per_user.items()],
+                ordered=False,
+            )
+
+    def _renew(self, db, claims, renewed):
+        """Renew `claims` if CLAIM_RENEWAL has passed since `renewed`; returns when they were last renewed."""
+        if now() - renewed < CLAIM_RENEWAL:
+            return renewed
+        renew_claims(db, claims)
+        return now()
+
+    def _meter(self, db, job, to_set):
+        throttle = job.get("throttle")
+        if not throttle:
+            return 0
+        cost = int(to_set.pending().sum())
+        return self.throttle.acquire(db, job["campaign_id"], throttle["rate_per_minute"], cost)
+
+    def _defer(self, job, seconds):
+        return UpdateOne({"_id": job["_id"], "claim": job["claim"]}, {
+            "$set": {"status": "Pending", "next_run_at": now() + timedelta(seconds=seconds)},
+            "$unset": {"claim": ""},
+        })
+
+    def _personalization(self, db, jobs, to_sets):
+        """{job _id: {address: contact attributes}} for the jobs whose message uses contact placeholders."""
+        personal = {}
+        for job in jobs:
+            try:
+                if not sendmail.is_personalized(job.get("subject"), sendmail.scheduled_body(job)):
+                    continue
+            except LookupError:
+                continue  # _send reports it
+            to_set = to_sets[job["_id"]]
+            personal[job["_id"]] = contacts.attributes(tenant_db(db, job.get("tenant_id") or DEFAULT_TENANT),
+                                                       to_set.to_list(to_set.pending()))
+        return personal
+
+    def _rendered(self, jobs, senders, to_sets, personal=()):
+        """Raw messages from the render pool in job order; None where the send thread renders the job itself."""
+        messages = {}
+        if self.render_pool is not None:
+            for i, job in enumerate(jobs):
+                sender = senders.get(sender_key(job))
+                if not sender or job.get("attachments") or job["_id"] in personal:
+                    continue  # attachments are streamed, and personalized jobs are rendered once per recipient
+                try:
+                    to_set = to_sets[job["_id"]]
+                    messages[i] = (sender, job.get("subject"), tracking.instrument(sendmail.scheduled_body(job)), job.get("cc"),
+                                   job.get("bcc"), to_set.header(to_set.pending()), tracking.variables(job.get("user_id"), job["_id"]))
+                except LookupError:
+                    continue  # _send reports it
+        if len(messages) < MIN_POOLED:
+            yield from [None] * len(jobs)
+            return
+        raws = self.render_pool.render(messages.values())
+        for i in range(len(jobs)):
+            raw = None
+            if i in messages and raws is not None:
+                try:
+                    raw = next(raws)
+                except Exception as e:
+                    logger.error(f"Render pool failed, rendering in the send threads instead: {e}")
+                    raws = None
+            yield raw
+
+    def _service(self):
+        service = getattr(self._local, "service", None)
+        if service is None:
+            service = self._local.service = self.service_factory()
+        return service
+
+    def _send(self, job, from_address, to_set, raw=None, attributes=None):
+        """Send one claimed job, pre-rendered as `raw` if given; returns None on success or the error that stopped it.
+
+        With contact `attributes` each recipient gets a message of their own (see sendmail.deliver_each).
+        """
+        if not from_address:
+            logger.error(f"Sender details missing for email ID {job['_id']}")
+            return LookupError("Sender details missing")
+        to_emails = to_set.header(to_set.pending())
+        if not (to_emails or job.get("cc") or job.get("bcc")):
+            logger.info(f"Every recipient of email ID {job['_id']} is suppressed; nothing to send.")
+            return None
+        try:
+            if attributes is not None and to_emails:
+                return sendmail.deliver_each(self._service(), from_address, to_set, job.get("subject"),
+                                             tracking.instrument(sendmail.scheduled_body(job)), job.get("cc"), job.get("bcc"),
+                                             job.get("attachments"), job.get("user_id"), job["_id"], attributes)
+            if raw is not None:
+                sendmail.deliver_raw_message(self._service(), raw)
+                return None
+            sendmail.deliver_message(self._service(), from_address, to_emails, job.get("subject"),
+                                     tracking.instrument(sendmail.scheduled_body(job)), job.get("cc"), job.get("bcc"),
+                                     job.get("attachments"), tracking.variables(job.get("user_id"), job["_id"]))
+            return None
+        except Exception as e:
+            logger.error(f"Failed to send email ID {job['_id']}: {e}")
+            return e
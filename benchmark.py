@@ -0,0 +1,488 @@
+# benchmark.py
+"""End-to-end benchmarks of the real app functions against mongomock (or a local mongod) and a fake Gmail server.
+
+    python benchmark.py all [--scale 1000] [--backend mongomock|mongod] [--save] [--compare] [--fail-on-regression]
+    python benchmark.py scheduler --jobs 10000 [--processes 1,2,4,8]
+    python benchmark.py mime --fanout 100000
+    python benchmark.py render --fanout 100000 [--processes 1,2,4,8]
+
+The mongomock backend needs the development requirements: pip install -r requirements-dev.txt
+"""
+import argparse
+import glob
+import http.client
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from base64 import urlsafe_b64encode
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")
+os.environ.setdefault("MONGO_DB", "massmail_bench")
+os.environ.setdefault("MASSMAIL_SCHEDULER", "none")  # benchmarks drive the schedulers themselves
+
+import httplib2
+from bson import ObjectId
+from googleapiclient.discovery import build
+import db
+import sendmail
+import usermanagement
+import dashboard
+import tracking
+from batchscheduler import BatchScheduler
+from mimebuilder import compile_message
+from renderpool import RenderPool
+
+GMAIL_SEND_LATENCY = 0.002  # seconds the fake Gmail server waits before answering messages.send
+APSCHEDULER_POOL = 10  # APScheduler's default thread pool size
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_results")
+MIME_BODY = "<h1>Spring offer for {{name}}</h1>" + "<p>Static campaign copy shared by every recipient.</p>\n" * 60
+MIME_ALLOC_SAMPLE = 1000  # messages traced with tracemalloc per builder
+REGRESSION_THRESHOLD = 0.2  # flag a >20% drop in throughput or rise in p99 against the previous run
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def incr(self):
+        with self._lock:
+            self.value += 1
+
+
+class FakeGmailHandler(BaseHTTPRequestHandler):
+    """Answers POST /gmail/v1/users/me/messages/send the way Gmail does, after GMAIL_SEND_LATENCY."""
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True  # headers and body go out as separate writes; avoid delayed-ACK stalls
+    sends = Counter()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(GMAIL_SEND_LATENCY)
+        if not self.path.startswith("/gmail/v1/users/me/messages/send"):
+            self.send_error(404)
+            return
+        self.sends.incr()
+        body = json.dumps({"id": f"{self.sends.value:x}", "threadId": f"{self.sends.value:x}", "labelIds": ["SENT"]}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_fake_gmail():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeGmailHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fake-gmail", daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+def gmail_service_factory(endpoint, builds):
+    """Builds the real discovery-based Gmail client, pointed at the fake server instead of Google."""
+    def factory():
+        builds.incr()
+        return build("gmail", "v1", http=httplib2.Http(), static_discovery=True,
+                     client_options={"api_endpoint": endpoint})
+    return factory
+
+
+def install_backend(backend):
+    """Count every MongoClient the app opens; with mongomock all clients share one in-memory store."""
+    connections = Counter()
+    if backend == "mongomock":
+        import mongomock
+        store = mongomock.store.ServerStore()
+        base = mongomock.MongoClient
+
+        # pymongo >= 4.11 passes sort= to bulk update builders, which mongomock does not accept yet;
+        # written against the mongomock pinned in requirements-dev.txt
+        add_update = mongomock.collection.BulkOperationBuilder.add_update
+        mongomock.collection.BulkOperationBuilder.add_update = (
+            lambda self, *args, sort=None, **kwargs: add_update(self, *args, **kwargs))
+
+        def factory(*args, **kwargs):
+            connections.incr()
+            return base(*args, _store=store, **kwargs)
+    else:
+        base = db.MongoClient
+
+        def factory(*args, **kwargs):
+            connections.incr()
+            return base(*args, **kwargs)
+    db.MongoClient = factory
+    return connections
+
+def reset_collections(*names):
+    client, database = db.get_db()
+    try:
+        for name in names:
+            database[name].delete_many({})
+    finally:
+        client.close()
+
+def seed_users(n=10):
+    client, database = db.get_db()
+    try:
+        database = db.tenant_db(database, db.DEFAULT_TENANT)  # senders of the admin the load test signs in as
+        return [str(database.users.insert_one({"username": f"sender{i}@example.com", "is_enabled": True}).inserted_id)
+                for i in range(n)]
+    finally:
+        client.close()
+
+
+def measure(name, func, args_list):
+    """Call func(*args) for every args tuple, timing each call; returns throughput and latency percentiles."""
+    latencies = []
+    start = time.perf_counter()
+    for args in args_list:
+        t0 = time.perf_counter()
+        func(*args)
+        latencies.append(time.perf_counter() - t0)
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    pick = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000
+    return {"name": name, "ops": len(latencies), "seconds": elapsed, "throughput": len(latencies) / elapsed,
+            "p50_ms": pick(0.50), "p99_ms": pick(0.99)}
+
+
+def bench_contacts_import(scale, env):
+    reset_collections("contacts", "contact_attributes")
+    # Same per-row create_contact call the manual form makes, with 10% repeated addresses
+    rows = [(f"contact{i % max(1, scale - scale // 10)}@example.com", {"first_name": f"Contact {i}"}) for i in range(scale)]
+    return measure("contacts_import", usermanagement.create_contact, rows)
+
+def bench_send_email(scale, env):
+    reset_collections("users", "email_stats")
+    user_ids = seed_users()
+    service = gmail_service_factory(env["gmail"], Counter())()
+    args = [(service, "sender@example.com", f"rcpt{i}@example.com, other{i}@example.com", "Bench", "Hello from the benchmark.",
+             user_ids[i % len(user_ids)], f"cc{i}@example.com", "") for i in range(scale)]
+    return measure("send_email", sendmail.send_email, args)
+
+def bench_log_email_stats(scale, env):
+    reset_collections("email_stats")
+    args = [(f"user{i % 50}", f"a{i}@example.com,b{i}@example.com", "c@example.com", "") for i in range(scale)]
+    return measure("log_email_stats", sendmail.log_email_stats, args)
+
+def bench_schedule_email(scale, env):
+    reset_collections("scheduled_emails", "contacts")
+    when = datetime.now() + timedelta(days=1)
+    args = [(f"user{i % 50}", f"rcpt{i}@example.com", "Bench", "Hello from the benchmark.", when) for i in range(scale)]
+    return measure("schedule_email", sendmail.schedule_email_with_apscheduler, args)
+
+def bench_dashboard(scale, env):
+    reset_collections("email_stats")
+    client, database = db.get_db()
+    try:
+        start = db.now() - timedelta(days=90)
+        database.email_stats.insert_many([
+            {"user_id": f"user{i % 50}", "sent": 3, "messages": 1, "bounced": 0, "opened": 1, "timestamp": start + timedelta(hours=i % 2160)}
+            for i in range(scale)
+        ])
+    finally:
+        client.close()
+    rounds = [()] * max(10, scale // 100)
+    return [
+        measure("dashboard_fetch_user_stats", dashboard.fetch_user_stats, rounds),
+        measure("dashboard_fetch_user_performance", dashboard.fetch_user_performance, rounds),
+        measure("dashboard_fetch_campaign_growth", dashboard.fetch_campaign_growth, rounds),
+    ]
+
+def bench_scheduled_report(scale, env):
+    """The scheduled page's queries over `scale` historical emails: one keyset page, and the status chart's $group
+    uncached and as the page serves it on reruns. Run with --backend mongod --scale 1000000 to check a real index."""
+    reset_collections("scheduled_emails")
+    statuses = sendmail.SCHEDULED_STATUSES
+    client, database = db.get_db()
+    try:
+        start = db.now() - timedelta(days=120)
+        for first in range(0, scale, 10000):
+            database.scheduled_emails.insert_many([
+                {"user_id": f"user{i % 50}", "to_emails": f"rcpt{i}@example.com", "subject": "Bench", "status": statuses[i % len(statuses)],
+                 "schedule_time": start + timedelta(minutes=i % 172800), "next_run_at": start + timedelta(minutes=i % 172800),
+                 "created_at": start}
+                for i in range(first, min(scale, first + 10000))
+            ])
+        query = sendmail.build_scheduled_email_filter(start=db.now() - timedelta(days=30), end=db.now() + timedelta(days=90))
+        rounds = [()] * max(10, min(100, scale // 100))
+        return [
+            measure("scheduled_report_page", lambda: sendmail.fetch_scheduled_email_page(database, query, 50), rounds),
+            measure("scheduled_report_counts", lambda: sendmail.fetch_scheduled_status_counts(database, query), rounds),
+            measure("scheduled_report_counts_cached", lambda: sendmail.cached_status_counts(database, query), rounds),
+        ]
+    finally:
+        client.close()
+
+def bench_tracking(scale, env):
+    """Pixel hits over one keep-alive connection (the request path only buffers), then bulk writes of full batches."""
+    reset_collections("tracking_events", "engagement", "email_stats", "suppressions")
+    server = ThreadingHTTPServer(("127.0.0.1", 0), tracking.TrackingHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="bench-tracking", daemon=True).start()
+    conn = http.client.HTTPConnection("127.0.0.1", server.server_port)
+
+    def hit(path):
+        conn.request("GET", path)
+        conn.getresponse().read()
+
+    # Half the opens repeat a message, as re-opens do
+    paths = [(f"/o/{tracking.make_token(f'user{i % 50}', f'msg{i % max(1, scale // 2)}')}.gif",) for i in range(scale)]
+    hits = measure("tracking_pixel_hit", hit, paths)
+    conn.close()
+    server.shutdown()
+    server.server_close()
+    tracking.buffer.flush()
+    client, database = db.get_db()
+    try:
+        batches = [([{"_id": ObjectId(), "type": tracking.OPEN, "user_id": f"user{i % 50}", "message_id": f"m{b}-{i % 700}",
+                      "at": db.now()} for i in range(tracking.FLUSH_SIZE)],) for b in range(max(1, scale // tracking.FLUSH_SIZE))]
+        writes = measure(f"tracking_write_events_x{tracking.FLUSH_SIZE}", lambda events: tracking.write_events(database, events),
+                         batches)
+    finally:
+        client.close()
+    return [hits, writes]
+
+SUITES = {
+    "contacts_import": bench_contacts_import,
+    "send_email": bench_send_email,
+    "log_email_stats": bench_log_email_stats,
+    "schedule_email": bench_schedule_email,
+    "dashboard": bench_dashboard,
+    "scheduled_report": bench_scheduled_report,
+    "tracking": bench_tracking,
+}
+
+
+def seed_due_jobs(n):
+    reset_collections("scheduled_emails", "email_stats", "users")
+    user_ids = seed_users()
+    client, database = db.get_db()
+    try:
+        due = db.now() - timedelta(seconds=1)
+        res = database.scheduled_emails.insert_many([
+            {"user_id": user_ids[i % len(user_ids)], "to_emails": f"rcpt{i}@example.com", "subject": "Bench",
+             "body": "Hello from the benchmark.", "cc": "", "bcc": "", "schedule_time": due, "next_run_at": due, "status": "Pending"}
+            for i in range(n)
+        ])
+        return [str(i) for i in res.inserted_ids]
+    finally:
+        client.close()
+
+def bench_scheduler(jobs, env, processes=()):
+    """Per-job DateTrigger sends vs one BatchScheduler window over the same due jobs, without and with a render pool.
+
+    The pooled runs go through run_once like a worker does, so they measure the pool on dispatch-sized batches
+    (claim_batch emails at a time) with claiming, sending and completion updates included.
+    """
+    results = {}
+    variants = [("per-job DateTrigger", None), ("batch", 0)]
+    variants += [(f"batch, {n} render process{'es' if n > 1 else ''}", n) for n in processes]
+    for name, render_processes in variants:
+        email_ids = seed_due_jobs(jobs)
+        builds = Counter()
+        service_factory = gmail_service_factory(env["gmail"], builds)
+        sendmail.authenticate_gmail_api = service_factory
+        scheduler = None
+        if render_processes is not None:
+            scheduler = BatchScheduler(service_factory=service_factory, render_processes=render_processes)
+            if scheduler.render_pool:
+                scheduler.render_pool.warm_up()  # paid once per worker, not per dispatch
+        sent_before = FakeGmailHandler.sends.value
+        env["connections"].value = 0
+        start = time.perf_counter()
+        if scheduler:
+            scheduler.run_once()
+        else:
+            # What APScheduler does at the due time: one send_scheduled_email call per job on its pool
+            with ThreadPoolExecutor(max_workers=APSCHEDULER_POOL) as pool:
+                list(pool.map(sendmail.send_scheduled_email, email_ids))
+        elapsed = time.perf_counter() - start
+        if scheduler:
+            scheduler.stop()
+        sent = FakeGmailHandler.sends.value - sent_before
+        results[name] = {"elapsed": elapsed, "throughput": sent / elapsed, "sent": sent,
+                         "connections": env["connections"].value, "gmail_builds": builds.value}
+
+    print(f"{jobs} simultaneous due jobs")
+    print(f"{'scheduler':<30}{'sent':>8}{'seconds':>10}{'msgs/s':>10}{'db conns':>10}{'gmail builds':>14}")
+    for name, r in results.items():
+        print(f"{name:<30}{r['sent']:>8}{r['elapsed']:>10.2f}{r['throughput']:>10.0f}{r['connections']:>10}{r['gmail_builds']:>14}")
+    return results
+
+
+def legacy_raw_message(from_email, to_emails, subject, body):
+    """send_email's original build: a fresh MIMEMultipart per message, text/plain only."""
+    message = MIMEMultipart()
+    message["From"] = from_email
+    message["To"] = to_emails
+    message["Subject"] = subject
+    message.attach(MIMEText(body, "plain"))
+    return urlsafe_b64encode(message.as_bytes()).decode()
+
+def bench_mime(fanout):
+    """Messages built per second and bytes allocated per message for one campaign fanned out to `fanout` recipients."""
+    static_body = MIME_BODY.replace("{{name}}", "you")
+    builders = {
+        "legacy MIMEMultipart": lambda i: legacy_raw_message("sender@example.com", f"rcpt{i}@example.com", "Offer", static_body),
+        "compiled, static body": lambda i: compile_message("sender@example.com", "Offer", static_body).render(f"rcpt{i}@example.com"),
+        "compiled, {{name}} body": lambda i: compile_message("sender@example.com", "Offer {{name}}", MIME_BODY).render(
+            f"rcpt{i}@example.com", {"name": f"Customer {i}"}),
+    }
+    results = {}
+    for name, builder in builders.items():
+        size = 0
+        start = time.perf_counter()
+        for i in range(fanout):
+            size += len(builder(i))
+        elapsed = time.perf_counter() - start
+        # Peak bytes allocated while building one message, above what was live before it
+        peaks = []
+        tracemalloc.start()
+        for i in range(min(fanout, MIME_ALLOC_SAMPLE)):
+            tracemalloc.reset_peak()
+            live = tracemalloc.get_traced_memory()[0]
+            builder(i)
+            peaks.append(tracemalloc.get_traced_memory()[1] - live)
+        tracemalloc.stop()
+        results[name] = {"throughput": fanout / elapsed, "elapsed": elapsed, "bytes_per_message": size / fanout,
+                         "alloc_per_message": sum(peaks) / len(peaks)}
+
+    print(f"{fanout} messages, one campaign")
+    print(f"{'builder':<26}{'msgs/s':>10}{'seconds':>10}{'raw bytes/msg':>15}{'alloc bytes/msg':>17}")
+    for name, r in results.items():
+        print(f"{name:<26}{r['throughput']:>10.0f}{r['elapsed']:>10.2f}{r['bytes_per_message']:>15.0f}{r['alloc_per_message']:>17.0f}")
+    return results
+
+
+def bench_render(fanout, processes):
+    """Personalized messages rendered per second in this process vs RenderPool, pickling and unpacking included."""
+    messages = [("sender@example.com", "Offer {{name}}", MIME_BODY, None, None, f"rcpt{i}@example.com", {"name": f"Customer {i}"})
+                for i in range(fanout)]
+    results = {}
+    start = time.perf_counter()
+    for from_email, subject, body, cc, bcc, to_emails, variables in messages:
+        compile_message(from_email, subject, body, cc, bcc).render(to_emails, variables)
+    results["in-process"] = {"elapsed": time.perf_counter() - start}
+    for n in processes:
+        pool = RenderPool(n)
+        pool.warm_up()  # process start-up and imports are paid once per scheduler, not per dispatch
+        start = time.perf_counter()
+        rendered = sum(1 for _ in pool.render(messages))
+        results[f"pool, {n} process{'es' if n > 1 else ''}"] = {"elapsed": time.perf_counter() - start}
+        pool.shutdown()
+        assert rendered == fanout
+    baseline = results["in-process"]["elapsed"]
+    for r in results.values():
+        r["throughput"] = fanout / r["elapsed"]
+        r["speedup"] = baseline / r["elapsed"]
+
+    print(f"{fanout} personalized messages, {os.cpu_count()} CPU(s)")
+    print(f"{'renderer':<24}{'msgs/s':>10}{'seconds':>10}{'speedup':>10}")
+    for name, r in results.items():
+        print(f"{name:<24}{r['throughput']:>10.0f}{r['elapsed']:>10.2f}{r['speedup']:>9.2f}x")
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(RESULTS_DIR),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def save_results(run):
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, f"{run['started']:%Y%m%d-%H%M%S}-{run['revision']}.json")
+    with open(path, "w") as fp:
+        json.dump(run, fp, indent=2, default=str)
+    return path
+
+def previous_run(run):
+    """Latest saved run with the same backend and scale, other than this one."""
+    for path in sorted(glob.glob(os.path.join(RESULTS_DIR, "*.json")), reverse=True):
+        with open(path) as fp:
+            candidate = json.load(fp)
+        if (candidate.get("backend"), candidate.get("scale")) == (run["backend"], run["scale"]) \
+                and candidate.get("started") != str(run["started"]):
+            return candidate
+    return None
+
+def compare(run, baseline):
+    """Print deltas against the baseline run; returns the names of benchmarks that regressed."""
+    old = {r["name"]: r for r in baseline["results"]}
+    regressions = []
+    print(f"\nCompared with {baseline['revision']} ({baseline['started']})")
+    print(f"{'benchmark':<34}{'ops/s':>10}{'p99':>10}")
+    for r in run["results"]:
+        before = old.get(r["name"])
+        if not before:
+            continue
+        throughput_delta = r["throughput"] / before["throughput"] - 1
+        p99_delta = r["p99_ms"] / before["p99_ms"] - 1 if before["p99_ms"] else 0
+        regressed = throughput_delta < -REGRESSION_THRESHOLD or p99_delta > REGRESSION_THRESHOLD
+        if regressed:
+            regressions.append(r["name"])
+        print(f"{r['name']:<34}{throughput_delta:>+10.1%}{p99_delta:>+10.1%}{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+def print_results(results):
+    print(f"{'benchmark':<34}{'ops':>8}{'ops/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for r in results:
+        print(f"{r['name']:<34}{r['ops']:>8}{r['throughput']:>10.0f}{r['p50_ms']:>10.2f}{r['p99_ms']:>10.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("suite", choices=["all", "scheduler", "mime", "render"] + list(SUITES))
+    parser.add_argument("--scale", type=int, default=1000, help="operations / documents per benchmark")
+    parser.add_argument("--jobs", type=int, default=10000, help="due jobs for the scheduler benchmark")
+    parser.add_argument("--fanout", type=int, default=100000, help="recipients for the mime and render benchmarks")
+    parser.add_argument("--processes", default=",".join(str(1 << i) for i in range((os.cpu_count() or 1).bit_length())),
+                        help="comma-separated render pool sizes (render and scheduler suites)")
+    parser.add_argument("--backend", choices=["mongomock", "mongod"], default="mongomock")
+    parser.add_argument("--save", action="store_true", help=f"store results under {RESULTS_DIR}")
+    parser.add_argument("--compare", action="store_true", help="compare with the previous saved run")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args()
+
+    if args.suite == "mime":
+        bench_mime(args.fanout)
+        sys.exit(0)
+    if args.suite == "render":
+        bench_render(args.fanout, [int(n) for n in args.processes.split(",")])
+        sys.exit(0)
+
+    env = {"connections": install_backend(args.backend), "gmail": start_fake_gmail()}
+    if args.suite == "scheduler":
+        bench_scheduler(args.jobs, env, [int(n) for n in args.processes.split(",")])
+        sys.exit(0)
+
+    run = {"revision": git_revision(), "started": datetime.now(), "backend": args.backend, "scale": args.scale, "results": []}
+    for name, suite in SUITES.items():
+        if args.suite in ("all", name):
+            result = suite(args.scale, env)
+            run["results"].extend(result if isinstance(result, list) else [result])
+    print_results(run["results"])
+
+    if args.save:
+        print(f"\nSaved {save_results(run)}")
+    if args.compare or args.fail_on_regression:
+        baseline = previous_run(run)
+        regressions = compare(run, baseline) if baseline else []
+        if not baseline:
+            print("\nNo previous run to compare with.")
+        if regressions and args.fail_on_regression:
+            sys.exit(1)
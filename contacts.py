@@ -0,0 +1,239 @@
+# contacts.py
+"""Contacts keyed by their canonical address, with typed per-contact attributes.
+
+A contact is {address_hash, username, attributes, added_at, updated_at}. The address is trimmed and
+lower-cased, and its SHA-256 is address_hash, which has a unique index: every write is an upsert on it, so
+concurrent or repeated imports of the same list end with one document per address instead of racing a
+find-then-insert. attributes holds personalization fields in their own types (str, int, float, bool,
+datetime); a wildcard index on attributes serves segment queries on any of them, and `contact_attributes`
+records each attribute's name and type for the UI and for exports.
+"""
+import hashlib
+import logging
+import re
+from datetime import date, datetime, timezone
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from db import DEFAULT_TENANT, now, tenant_db, tenant_of
+
+ATTRIBUTE_NAME = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")  # usable as a {{placeholder}}; no dots or $
+TYPES = ((bool, "bool"), (int, "int"), (float, "float"), (datetime, "date"), (str, "string"))  # bool before int
+SEGMENT_OPERATORS = {"$eq", "$ne", "$gt", "$gte", "$lt", "$lte", "$in", "$nin", "$exists"}
+LEGACY_ADDED_AT = "%Y-%m-%d %H:%M:%S"
+
+logger = logging.getLogger(__name__)
+_migrated = set()  # tenants whose legacy contacts this process has migrated
+
+
+def canonical_address(address):
+    address = _plain(address)  # empty CSV cells arrive as NaN
+    return "" if address is None else str(address).strip().lower()
+
+def address_hash(address):
+    return hashlib.sha256(canonical_address(address).encode("utf-8")).hexdigest()
+
+def _plain(value):
+    """Python value for an attribute from pandas/numpy/Arrow input; None for blanks and NaN."""
+    if hasattr(value, "item") and not isinstance(value, (str, bytes)):
+        value = value.item()  # numpy scalars
+    if hasattr(value, "to_pydatetime"):
+        value = value.to_pydatetime()  # pandas Timestamp
+    if isinstance(value, date) and not isinstance(value, datetime):
+        value = datetime(value.year, value.month, value.day)
+    if value is None or value == "" or value != value:  # NaN and NaT are not equal to themselves
+        return None
+    if isinstance(value, datetime) and value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)  # stored as naive UTC like the rest of the app
+    return value
+
+def clean_attributes(attributes):
+    """Attributes with blank values dropped; raises ValueError for names that cannot be placeholders."""
+    cleaned = {}
+    for name, value in (attributes or {}).items():
+        if not ATTRIBUTE_NAME.match(str(name)):
+            raise ValueError(f"'{name}' is not a valid attribute name (letters, digits and _ only).")
+        value = _plain(value)
+        if value is not None:
+            cleaned[str(name)] = value
+    return cleaned
+
+def attribute_type(value):
+    for python_type, name in TYPES:
+        if isinstance(value, python_type):
+            return name
+    return "string"
+
+def parse_value(text):
+    """Typed value for a manually entered attribute: true/false, numbers and ISO dates, else the text itself."""
+    text = text.strip()
+    if text.lower() in ("true", "false"):
+        return text.lower() == "true"
+    for convert in (int, float, datetime.fromisoformat):
+        try:
+            return convert(text)
+        except ValueError:
+            continue
+    return text
+
+
+def upsert_op(address, attributes=None, at=None, _id=None, overwrite=True):
+    """Upsert for one contact; attributes given are set (only on insert unless overwrite), others are left as they are."""
+    at = at or now()
+    update = {"$setOnInsert": {"_id": _id or ObjectId(), "username": canonical_address(address), "added_at": at}}
+    if attributes and overwrite:
+        update["$set"] = {"updated_at": at, **{f"attributes.{name}": value for name, value in attributes.items()}}
+    else:
+        update["$setOnInsert"].update({"updated_at": at, "attributes": attributes or {}})
+    return UpdateOne({"address_hash": address_hash(address)}, update, upsert=True)
+
+def _scoped(db):
+    """db itself if it is scoped to a tenant; the unscoped database (CLIs, workers) writes the default tenant."""
+    return tenant_db(db, DEFAULT_TENANT) if tenant_of(db) is None else db
+
+def upsert_contacts(db, rows):
+    """Upsert (address, attributes) rows; returns (added, existing, duplicates) as lists of canonical addresses.
+
+    Repeated addresses keep their first row. An upsert that loses a race with a concurrent one for the same
+    address fails on the unique index; it is retried once and then updates the winner's document.
+    """
+    db = _scoped(db)
+    unique, duplicates = {}, []
+    for address, attributes in rows:
+        canonical = canonical_address(address)
+        if not canonical:
+            continue
+        if canonical in unique:
+            duplicates.append(canonical)
+        else:
+            unique[canonical] = clean_attributes(attributes)
+    if not unique:
+        return [], [], duplicates
+    # Each op carries the _id it would insert, so inserted documents map back to their address
+    ids = {ObjectId(): address for address in unique}
+    at = now()
+    ops = [upsert_op(address, unique[address], at, _id) for _id, address in ids.items()]
+    try:
+        upserted = set(db.contacts.bulk_write(ops, ordered=False).upserted_ids.values())
+    except BulkWriteError as e:
+        if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+            raise
+        upserted = {op["_id"] for op in e.details.get("upserted", [])}
+        db.contacts.bulk_write([ops[err["index"]] for err in e.details["writeErrors"]], ordered=False)
+    record_attribute_types(db, unique.values())
+    added = [address for _id, address in ids.items() if _id in upserted]
+    return added, [address for _id, address in ids.items() if _id not in upserted], duplicates
+
+def _common_type(a, b):
+    """Type that holds values of both; an attribute seen with mixed types is exported as text."""
+    if a == b or b is None:
+        return a
+    if {a, b} == {"int", "float"}:
+        return "float"
+    return "string"
+
+def record_attribute_types(db, attribute_dicts):
+    types = {}
+    for attributes in attribute_dicts:
+        for name, value in attributes.items():
+            types[name] = _common_type(attribute_type(value), types.get(name))
+    if not types:
+        return
+    db = _scoped(db)  # attribute names are per tenant; an unscoped upsert on name could rewrite another tenant's
+    known = {d["name"]: d.get("type") for d in db.contact_attributes.find({"name": {"$in": list(types)}})}
+    changed = {name: _common_type(type_name, known.get(name)) for name, type_name in types.items()}
+    changed = {name: type_name for name, type_name in changed.items() if known.get(name) != type_name}
+    if changed:
+        db.contact_attributes.bulk_write([UpdateOne({"name": name}, {"$set": {"type": type_name}}, upsert=True)
+                                          for name, type_name in changed.items()], ordered=False)
+
+def attribute_types(db):
+    return {d["name"]: d.get("type", "string") for d in db.contact_attributes.find()}
+
+def sample_attributes(db):
+    """Attributes of the newest contact that has any, for rendering template previews."""
+    doc = db.contacts.find_one({"attributes": {"$nin": [{}, None]}}, {"attributes": 1}, sort=[("_id", -1)])
+    return (doc or {}).get("attributes") or {}
+
+
+def segment_query(conditions):
+    """contacts filter for {attribute: value or {operator: value}}; served by the attributes wildcard index."""
+    query = {}
+    for name, condition in conditions.items():
+        if not ATTRIBUTE_NAME.match(name):
+            raise ValueError(f"'{name}' is not a valid attribute name.")
+        if isinstance(condition, dict) and not set(condition) <= SEGMENT_OPERATORS:
+            raise ValueError(f"Unsupported operator in {condition}; use one of {', '.join(sorted(SEGMENT_OPERATORS))}.")
+        query[f"attributes.{name}"] = condition
+    return query
+
+def attributes(db, addresses):
+    """{canonical address: attributes} for the contacts among `addresses`, to personalize their messages with."""
+    migrate_legacy(db)
+    hashes = [address_hash(a) for a in addresses]
+    docs = db.contacts.find({"address_hash": {"$in": hashes}}, {"username": 1, "attributes": 1})
+    return {d["username"]: d.get("attributes") or {} for d in docs}
+
+def timezones(db, addresses):
+    """{canonical address: timezone attribute} for the contacts among `addresses` that have one."""
+    migrate_legacy(db)
+    hashes = [address_hash(a) for a in addresses]
+    docs = db.contacts.find({"address_hash": {"$in": hashes}, "attributes.timezone": {"$exists": True}},
+                            {"username": 1, "attributes.timezone": 1})
+    return {d["username"]: d["attributes"]["timezone"] for d in docs}
+
+
+def migrate_legacy(db):
+    """Hash, canonicalize and merge contacts written before address_hash; runs once per tenant and process.
+
+    Duplicates of one address (left by the old find-then-insert) are merged into the oldest document, which
+    keeps the earliest added_at and every attribute; the top-level timezone moves to attributes.timezone.
+    On the unscoped database (workers) it runs once for each tenant that has legacy contacts, on a handle
+    scoped to it, so a contact is only ever merged with contacts of its own tenant.
+    """
+    if tenant_of(db) in _migrated:
+        return
+    if tenant_of(db) is None:
+        for tenant_id in db.contacts.distinct("tenant_id", {"address_hash": {"$exists": False}}):
+            migrate_legacy(tenant_db(db, tenant_id or DEFAULT_TENANT))  # ensure_indexes gave every contact a tenant
+        _migrated.add(None)
+        return
+    legacy = list(db.contacts.find({"address_hash": {"$exists": False}}).sort("_id", 1))
+    if legacy:
+        keepers, removed, ops, migrated = {}, [], [], []
+        hashed = {d["address_hash"]: d for d in db.contacts.find(
+            {"address_hash": {"$in": list({address_hash(d.get("username")) for d in legacy})}}, {"address_hash": 1})}
+        for doc in legacy:
+            if not canonical_address(doc.get("username")):
+                continue
+            key = address_hash(doc["username"])
+            attributes = dict(doc.get("attributes") or {})
+            if doc.get("timezone"):
+                attributes.setdefault("timezone", doc["timezone"])
+            if key in hashed or key in keepers:
+                # An upsert already wrote this address, or an older legacy document holds it
+                target = hashed[key]["_id"] if key in hashed else keepers[key]
+                if attributes:
+                    ops.append(UpdateOne({"_id": target}, {"$set": {f"attributes.{k}": v for k, v in attributes.items()}}))
+                removed.append(doc["_id"])
+                continue
+            keepers[key] = doc["_id"]
+            migrated.append(attributes)
+            added_at = doc.get("added_at")
+            if isinstance(added_at, str):
+                try:
+                    added_at = datetime.strptime(added_at, LEGACY_ADDED_AT)
+                except ValueError:
+                    added_at = None
+            ops.append(UpdateOne({"_id": doc["_id"]}, {
+                "$set": {"address_hash": key, "username": canonical_address(doc["username"]), "attributes": attributes,
+                         "added_at": added_at or doc["_id"].generation_time.replace(tzinfo=None), "updated_at": now()},
+                "$unset": {"timezone": ""},
+            }))
+        if ops:
+            db.contacts.bulk_write(ops, ordered=False)
+        if removed:
+            db.contacts.delete_many({"_id": {"$in": removed}})
+        record_attribute_types(db, migrated)
+        logger.info(f"Migrated {len(keepers)} legacy contact(s), merged {len(removed)} duplicate(s).")
+    _migrated.add(tenant_of(db))
@@ -5,44 +5,51 @@ import pandas as pd
 from streamlit_echarts import st_echarts
 from db import get_db, to_object_id
 from bson.son import SON
+import exports
+import metrics
+import profiler
 
 
 
 # Fetch user stats
 
+EMPTY_STATS = {'total_sent': 0, 'total_messages': 0, 'total_bounced': 0, 'total_opened': 0, 'total_clicked': 0,
+               'total_complaints': 0}
+
 def fetch_user_stats():
+    """Totals over email_stats: sends counted by the senders, the rest from tracking events (see tracking.py)."""
     client, db = get_db()
     if db is None:
 
-        return {'total_sent':0,'total_delivered':0,'landed_inbox':0,'landed_spam':0}
+        return dict(EMPTY_STATS)
     try:
         pipeline = [
             {
                 "$group": {
                     "_id": None,
                     "total_sent": {"$sum": {"$ifNull":["$sent",0]}},
-                    "total_delivered": {"$sum": {"$ifNull":["$delivered",0]}},
-                    "landed_inbox": {"$sum": {"$ifNull":["$inbox",0]}},
-                    "landed_spam": {"$sum": {"$ifNull":["$spam",0]}}
+                    "total_messages": {"$sum": {"$ifNull":["$messages",0]}},
+                    "total_bounced": {"$sum": {"$ifNull":["$bounced",0]}},
+                    "total_opened": {"$sum": {"$ifNull":["$opened",0]}},
+                    "total_clicked": {"$sum": {"$ifNull":["$clicked",0]}},
+                    "total_complaints": {"$sum": {"$ifNull":["$complained",0]}}
                 }
             }
         ]
         res = list(db.email_stats.aggregate(pipeline))
         if not res:
-            return {'total_sent':0,'total_delivered':0,'landed_inbox':0,'landed_spam':0}
+            return dict(EMPTY_STATS)
         row = res[0]
-        return {
-            'total_sent': int(row.get('total_sent',0)),
-            'total_delivered': int(row.get('total_delivered',0)),
-            'landed_inbox': int(row.get('landed_inbox',0)),
-            'landed_spam': int(row.get('landed_spam',0))
-        }
+        return {key: int(row.get(key, 0)) for key in EMPTY_STATS}
     except Exception as e:
         st.error(f"Error fetching stats: {e}")
-        return {'total_sent':0,'total_delivered':0,'landed_inbox':0,'landed_spam':0}
+        return dict(EMPTY_STATS)
     finally:
         client.close()
 
+def _share(count, total, unit):
+    return f"{count / total:.1%} of {total} {unit}" if total else None
+
 def fetch_user_performance():
     client, db = get_db()
     if db is None:
@@ -119,19 +126,27 @@ def show_superuser_overview():
         return
 
     total_sent = int(stats.get('total_sent', 0))
-    total_delivered = int(stats.get('total_delivered', 0))
-    landed_inbox = int(stats.get('landed_inbox', 0))
-    landed_spam = int(stats.get('landed_spam', 0))
-
-    col1, col2, col3, col4 = st.columns(4)
+    total_bounced = int(stats.get('total_bounced', 0))
+    total_delivered = max(0, total_sent - total_bounced)
+    total_opened = int(stats.get('total_opened', 0))
+    total_clicked = int(stats.get('total_clicked', 0))
+    total_complaints = int(stats.get('total_complaints', 0))
+    total_messages = int(stats.get('total_messages', 0))
+
+    col1, col2, col3, col4, col5 = st.columns(5)
     col1.metric("Total Sent", total_sent)
-    col2.metric("Total Delivered", total_delivered)
-    col3.metric("Landed in Inbox", landed_inbox)
-    col4.metric("Landed in Spam", landed_spam)
+    col2.metric("Delivered", total_delivered, delta=f"-{total_bounced} bounced" if total_bounced else None, delta_color="off")
+    col3.metric("Opened (messages)", total_opened, delta=_share(total_opened, total_messages, "messages"), delta_color="off")
+    col4.metric("Clicked (messages)", total_clicked, delta=_share(total_clicked, total_messages, "messages"), delta_color="off")
+    col5.metric("Spam Complaints", total_complaints)
+    st.caption("Sent, delivered, bounces and complaints count recipients. Opens and clicks count messages: one "
+               "message goes to a whole chunk of recipients and carries one tracking token, so they are shown "
+               "against messages sent. Opens (messages whose pixel loaded) undercount clients that block images, "
+               "and only HTML messages sent with tracking enabled report opens and clicks.")
 
     # Deliverability Score as a Gauge
-    if total_delivered > 0:
-        deliverability_score = (landed_inbox / total_delivered) * 100
+    if total_sent > 0:
+        deliverability_score = round(total_delivered / total_sent * 100, 1)
     else:
         deliverability_score = 0
 
@@ -149,11 +164,11 @@ def show_superuser_overview():
     }
     st_echarts(options=gauge_options)
 
-    # Bar chart for Sent, Delivered, Inbox, and Spam
+    # Bar chart for Sent, Delivered, Opened, Clicked, Bounced and Complaints
     st.subheader("Email Performance Breakdown")
     bar_data = {
-        "categories": ["Sent", "Delivered", "Inbox", "Spam"],
-        "values": [total_sent, total_delivered, landed_inbox, landed_spam],
+        "categories": ["Sent", "Delivered", "Opened (msgs)", "Clicked (msgs)", "Bounced", "Spam"],
+        "values": [total_sent, total_delivered, total_opened, total_clicked, total_bounced, total_complaints],
     }
     bar_options = {
         "xAxis": {"type": "category", "data": bar_data["categories"]},
@@ -188,8 +203,44 @@ def show_superuser_overview():
     if not campaign_data.empty:
         st.line_chart(campaign_data.set_index("campaign_date"))
 
+# Runtime timings and counters from metrics.py, also exported at /metrics
+def show_runtime_metrics():
+    st.subheader("Runtime Metrics")
+    counters, histograms = metrics.snapshot()
+    rows = []
+    for (name, labels), hist in sorted(histograms.items()):
+        count = sum(hist[:-1])
+        rows.append({"Metric": name, "Labels": ", ".join(f"{k}={v}" for k, v in labels), "Count": count,
+                     "Avg (ms)": round(hist[-1] / count * 1000, 2) if count else 0})
+    for (name, labels), value in sorted(counters.items()):
+        rows.append({"Metric": name, "Labels": ", ".join(f"{k}={v}" for k, v in labels), "Count": value, "Avg (ms)": None})
+    if rows:
+        st.dataframe(pd.DataFrame(rows))
+    else:
+        st.write("No samples recorded yet.")
+    st.caption(f"Prometheus text format: http://127.0.0.1:{metrics.METRICS_PORT}/metrics")
+
+# Mongo commands per page rerun from profiler.py, newest first
+def show_query_profile():
+    st.subheader("Queries per Page Rerun")
+    rows = [{"Page": p.page, "Commands": len(p.commands), "Budget": p.budget,
+             "Mongo (ms)": round(sum(c[3] for c in p.commands) * 1000, 2), "Rerun (ms)": round(p.seconds * 1000, 2),
+             "Callers": ", ".join(f"{caller} {command} x{count}" for (caller, command, _), (count, _) in p.by_caller().items())}
+            for p in profiler.recent()]
+    if rows:
+        st.dataframe(pd.DataFrame(rows))
+    else:
+        st.write("No page reruns profiled yet.")
+
 # Main app
+@profiler.page("dashboard")
 def app():
     show_superuser_overview()
+    with st.expander("Export email stats"):
+        exports.show_export("email_stats")
+    if metrics.ENABLED:
+        show_runtime_metrics()
+    if profiler.ENABLED:
+        show_query_profile()
 
 
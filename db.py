@@ -1,20 +1,299 @@
 # db.py
+import copy
 import os
-from pymongo import MongoClient
+import logging
+from collections.abc import Mapping
+from pymongo import MongoClient, IndexModel, InsertOne, ReplaceOne, ASCENDING, DESCENDING
 from pymongo.errors import PyMongoError
 from bson import ObjectId
 from datetime import datetime
 import streamlit as st
+import metrics
+import profiler
 
 MONGO_URI = os.getenv("MONGO_URI") or (st.secrets["MONGO_URI"] if "MONGO_URI" in st.secrets else None)
+MONGO_DB = os.getenv("MONGO_DB", "massmaildb")
+AUDIT_RETENTION_DAYS = int(os.getenv("MASSMAIL_AUDIT_RETENTION_DAYS", "365"))
+TRACKING_RETENTION_DAYS = int(os.getenv("MASSMAIL_TRACKING_RETENTION_DAYS", "90"))
 
-def get_db():
+logger = logging.getLogger(__name__)
+
+DEFAULT_TENANT = os.getenv("MASSMAIL_DEFAULT_TENANT", "default")  # workspace of documents from before tenants
+# Collections partitioned by tenant_id. The rest (tenants, leases, campaign_throttles, invalidations, tracking,
+# suppressions, attachments) are shared infrastructure used by the workers and the tracking server across tenants.
+TENANT_COLLECTIONS = ("users", "contacts", "contact_attributes", "templates", "template_versions",
+                      "scheduled_emails", "email_stats", "audit_log")
+
+# Indexes backing the app's hot queries, created once per process by ensure_indexes(). Page queries run
+# inside one tenant (see TenantDatabase), so their indexes lead with tenant_id; the few that serve queries
+# across tenants (login, the workers' claim and stale-claim scans, campaign pauses, TTLs) do not.
+INDEXES = {
+    "scheduled_emails": [
+        IndexModel([("tenant_id", ASCENDING), ("schedule_time", DESCENDING), ("_id", DESCENDING)]),
+        IndexModel([("tenant_id", ASCENDING), ("status", ASCENDING), ("schedule_time", DESCENDING), ("_id", DESCENDING)]),
+        IndexModel([("tenant_id", ASCENDING), ("user_id", ASCENDING), ("schedule_time", DESCENDING), ("_id", DESCENDING)]),
+        IndexModel([("tenant_id", ASCENDING), ("user_id", ASCENDING), ("status", ASCENDING), ("schedule_time", DESCENDING),
+                    ("_id", DESCENDING)]),
+        IndexModel([("status", ASCENDING), ("next_run_at", ASCENDING)]),  # workers claim due emails of every tenant
+        IndexModel([("claim", ASCENDING)], sparse=True),
+        IndexModel([("campaign_id", ASCENDING), ("status", ASCENDING)]),
+    ],
+    "users": [
+        # Login finds an admin by username before the tenant is known, so admin usernames are unique across
+        # tenants; other users' usernames only need to be unique within their tenant
+        IndexModel([("username", ASCENDING)], name="superuser_username", unique=True,
+                   partialFilterExpression={"is_superuser": True}),
+        IndexModel([("tenant_id", ASCENDING), ("username_lc", ASCENDING)]),  # prefix search and lookups by username (search.py)
+    ],
+    "contacts": [
+        # Partial so legacy documents without a hash (until contacts.migrate_legacy runs) do not collide on null
+        IndexModel([("tenant_id", ASCENDING), ("address_hash", ASCENDING)], unique=True,
+                   partialFilterExpression={"address_hash": {"$type": "string"}}),
+        IndexModel([("attributes.$**", ASCENDING)]),  # segment queries on any attribute
+        IndexModel([("tenant_id", ASCENDING), ("username", ASCENDING)]),  # prefix search (search.py)
+    ],
+    "contact_attributes": [
+        IndexModel([("tenant_id", ASCENDING), ("name", ASCENDING)], unique=True),
+    ],
+    "templates": [
+        IndexModel([("tenant_id", ASCENDING), ("user_id", ASCENDING), ("template_name", ASCENDING)]),
+        IndexModel([("tenant_id", ASCENDING), ("superuser", ASCENDING)]),
+    ],
+    "email_stats": [
+        IndexModel([("tenant_id", ASCENDING), ("user_id", ASCENDING)]),
+    ],
+    "invalidations": [
+        IndexModel([("at", ASCENDING)], expireAfterSeconds=3600),
+    ],
+    "tracking_events": [
+        IndexModel([("at", ASCENDING)], expireAfterSeconds=TRACKING_RETENTION_DAYS * 24 * 3600),  # raw events; rollups live in email_stats
+    ],
+    "campaign_throttles": [
+        IndexModel([("updated_at", ASCENDING)], expireAfterSeconds=24 * 3600),  # buckets of campaigns done sending
+    ],
+    "engagement": [
+        # First-seen markers per message and kind; an open of a message older than this counts again
+        IndexModel([("at", ASCENDING)], expireAfterSeconds=TRACKING_RETENTION_DAYS * 24 * 3600),
+    ],
+    "audit_log": [
+        IndexModel([("at", ASCENDING)], expireAfterSeconds=AUDIT_RETENTION_DAYS * 24 * 3600),
+        IndexModel([("tenant_id", ASCENDING), ("at", DESCENDING)]),
+        IndexModel([("tenant_id", ASCENDING), ("actor", ASCENDING), ("at", DESCENDING)]),
+        IndexModel([("tenant_id", ASCENDING), ("action", ASCENDING), ("at", DESCENDING)]),
+        IndexModel([("tenant_id", ASCENDING), ("target_id", ASCENDING), ("at", DESCENDING)]),
+        IndexModel([("tenant_id", ASCENDING), ("target", ASCENDING), ("at", DESCENDING)]),
+    ],
+    "template_versions": [
+        IndexModel([("tenant_id", ASCENDING), ("template_id", ASCENDING), ("version", DESCENDING)], unique=True),
+        IndexModel([("tenant_id", ASCENDING), ("user_id", ASCENDING), ("template_name", ASCENDING), ("version", DESCENDING)]),
+    ],
+}
+# Indexes replaced by the ones above. The old unique ones would stop two tenants from holding the same address
+# or template version; users' plain username index is now the unique admin index
+SUPERSEDED_INDEXES = {
+    "users": ["username_1"],
+    "contacts": ["address_hash_1"],
+    "template_versions": ["template_id_1_version_-1"],
+}
+
+_indexes_ready = False
+
+def ensure_indexes(db):
+    """Create INDEXES and give pre-tenant documents the default tenant; once per process."""
+    global _indexes_ready
+    if _indexes_ready:
+        return
+    try:
+        with profiler.setup():
+            for collection, names in SUPERSEDED_INDEXES.items():
+                existing = db[collection].index_information()
+                for name in names:
+                    if name in existing:
+                        db[collection].drop_index(name)
+            # Attribute types were keyed by _id before tenants; name them so the unique index has a key
+            for doc in db.contact_attributes.find({"name": {"$exists": False}}, {"_id": 1}):
+                db.contact_attributes.update_one({"_id": doc["_id"]}, {"$set": {"name": doc["_id"]}})
+            for collection, models in INDEXES.items():
+                db[collection].create_indexes(models)
+            for collection in TENANT_COLLECTIONS:
+                # Equality on null matches missing fields and uses the tenant_id-prefixed indexes
+                db[collection].update_many({"tenant_id": None}, {"$set": {"tenant_id": DEFAULT_TENANT}})
+        _indexes_ready = True
+    except PyMongoError as e:
+        logger.warning(f"Could not create indexes: {e}")
+
+_tenant_resolver = None
+
+def set_tenant_resolver(resolver):
+    """resolver() names the tenant the current page run acts for, or None (login, workers, CLIs); see session.py."""
+    global _tenant_resolver
+    _tenant_resolver = resolver
+
+def current_tenant():
+    return _tenant_resolver() if _tenant_resolver else None
+
+def scope(query, tenant_id):
+    """`query` restricted to one tenant; a query naming another tenant is refused rather than widened."""
+    if not tenant_id:
+        raise ValueError("A tenant is required")
+    query = dict(query or {}) if query is None or isinstance(query, Mapping) else {"_id": query}
+    if query.setdefault("tenant_id", tenant_id) != tenant_id:
+        raise ValueError(f"Query for tenant {query['tenant_id']!r} run as tenant {tenant_id!r}")
+    return query
+
+
+# Collection and Database attributes a scoped handle passes through: metadata that reads or writes no documents.
+# Anything else not wrapped below (watch, drop, rename, raw batch reads, ...) is refused rather than
+# quietly running across every tenant.
+COLLECTION_PASSTHROUGH = {"name", "full_name", "codec_options", "read_preference", "read_concern", "write_concern",
+                          "index_information", "list_indexes"}
+DATABASE_PASSTHROUGH = {"name", "client", "codec_options", "read_preference", "read_concern", "write_concern",
+                        "list_collection_names"}
+
+def _unscoped_attribute(owner, name):
+    return AttributeError(f"{owner}.{name} is not scoped to a tenant; use get_db(unscoped=True) for it")
+
+
+class TenantCollection:
+    """A collection whose reads and writes only ever see one tenant's documents.
+
+    Filters get tenant_id added (so every query can use the tenant-prefixed indexes), inserted documents get
+    it set, and pipelines start with a $match on it. Of the rest, only COLLECTION_PASSTHROUGH is available.
+    """
+
+    def __init__(self, collection, tenant_id):
+        self._collection = collection
+        self.tenant_id = tenant_id
+
+    def __getattr__(self, name):
+        if name in COLLECTION_PASSTHROUGH:
+            return getattr(self._collection, name)
+        raise _unscoped_attribute(f"TenantCollection({self._collection.name})", name)
+
+    def with_options(self, **kwargs):
+        return TenantCollection(self._collection.with_options(**kwargs), self.tenant_id)
+
+    def _doc(self, doc):
+        return scope(doc, self.tenant_id)
+
+    def find(self, filter=None, *args, **kwargs):
+        return self._collection.find(scope(filter, self.tenant_id), *args, **kwargs)
+
+    def find_one(self, filter=None, *args, **kwargs):
+        return self._collection.find_one(scope(filter, self.tenant_id), *args, **kwargs)
+
+    def count_documents(self, filter, **kwargs):
+        return self._collection.count_documents(scope(filter, self.tenant_id), **kwargs)
+
+    def estimated_document_count(self, **kwargs):
+        # Collection metadata counts every tenant; the tenant_id index makes the exact count cheap instead
+        return self._collection.count_documents({"tenant_id": self.tenant_id}, **kwargs)
+
+    def distinct(self, key, filter=None, **kwargs):
+        return self._collection.distinct(key, scope(filter, self.tenant_id), **kwargs)
+
+    def aggregate(self, pipeline, **kwargs):
+        return self._collection.aggregate([{"$match": {"tenant_id": self.tenant_id}}, *pipeline], **kwargs)
+
+    def insert_one(self, document, **kwargs):
+        document.update(self._doc(document))  # like pymongo, the caller's dict is completed in place
+        return self._collection.insert_one(document, **kwargs)
+
+    def insert_many(self, documents, **kwargs):
+        documents = list(documents)
+        for document in documents:
+            document.update(self._doc(document))
+        return self._collection.insert_many(documents, **kwargs)
+
+    # An upsert copies the filter's equality fields, tenant_id included, into the document it inserts
+    def update_one(self, filter, update, *args, **kwargs):
+        return self._collection.update_one(scope(filter, self.tenant_id), update, *args, **kwargs)
+
+    def update_many(self, filter, update, *args, **kwargs):
+        return self._collection.update_many(scope(filter, self.tenant_id), update, *args, **kwargs)
+
+    def replace_one(self, filter, replacement, *args, **kwargs):
+        return self._collection.replace_one(scope(filter, self.tenant_id), self._doc(replacement), *args, **kwargs)
+
+    def delete_one(self, filter, **kwargs):
+        return self._collection.delete_one(scope(filter, self.tenant_id), **kwargs)
+
+    def delete_many(self, filter, **kwargs):
+        return self._collection.delete_many(scope(filter, self.tenant_id), **kwargs)
+
+    def find_one_and_delete(self, filter, *args, **kwargs):
+        return self._collection.find_one_and_delete(scope(filter, self.tenant_id), *args, **kwargs)
+
+    def find_one_and_update(self, filter, update, *args, **kwargs):
+        return self._collection.find_one_and_update(scope(filter, self.tenant_id), update, *args, **kwargs)
+
+    def find_one_and_replace(self, filter, replacement, *args, **kwargs):
+        return self._collection.find_one_and_replace(scope(filter, self.tenant_id), self._doc(replacement),
+                                                     *args, **kwargs)
+
+    def bulk_write(self, requests, **kwargs):
+        # Write models keep their filter and document in _filter/_doc, which both pymongo and mongomock read
+        scoped = []
+        for request in requests:
+            request = copy.copy(request)
+            if isinstance(request, InsertOne):
+                request._doc = self._doc(request._doc)
+            else:
+                request._filter = scope(request._filter, self.tenant_id)
+                if isinstance(request, ReplaceOne):
+                    request._doc = self._doc(request._doc)
+            scoped.append(request)
+        return self._collection.bulk_write(scoped, **kwargs)
+
+
+class TenantDatabase:
+    """The database as one tenant sees it: TENANT_COLLECTIONS come back as TenantCollections."""
+
+    def __init__(self, db, tenant_id):
+        self._db = db
+        self.tenant_id = tenant_id
+
+    def __getitem__(self, name):
+        collection = self._db[name]
+        return TenantCollection(collection, self.tenant_id) if name in TENANT_COLLECTIONS else collection
+
+    def __getattr__(self, name):
+        if name in DATABASE_PASSTHROUGH:
+            return getattr(self._db, name)
+        if hasattr(type(self._db), name):
+            raise _unscoped_attribute("TenantDatabase", name)  # command, watch, drop_collection, aggregate, ...
+        return self[name]
+
+    def get_collection(self, name, **kwargs):
+        collection = self._db.get_collection(name, **kwargs)
+        return TenantCollection(collection, self.tenant_id) if name in TENANT_COLLECTIONS else collection
+
+def tenant_db(db, tenant_id):
+    return db if tenant_id is None else TenantDatabase(db, tenant_id)
+
+def tenant_of(db):
+    """Tenant a database handle from get_db() is scoped to, or None for the unscoped database."""
+    return db.tenant_id if isinstance(db, TenantDatabase) else None  # Database.tenant_id would be a collection
+
+
+@metrics.timed("mongo_connect_seconds")
+def get_db(unscoped=False):
+    """(client, database); inside a signed-in page run the database is scoped to the admin's tenant.
+
+    unscoped=True returns the whole database even there, for writers of shared or multi-tenant buffers.
+    """
     try:
-        uri = st.secrets["mongo"]["uri"]
-        db_name = st.secrets["mongo"].get("database", "massmaildb")  # default fallback
-        client = MongoClient(uri)
+        # MONGO_URI lets processes without Streamlit secrets (scheduler workers, benchmarks) connect
+        if MONGO_URI:
+            uri, db_name = MONGO_URI, MONGO_DB
+        else:
+            uri = st.secrets["mongo"]["uri"]
+            db_name = st.secrets["mongo"].get("database", "massmaildb")  # default fallback
+        client = MongoClient(uri, event_listeners=metrics.mongo_listeners() + profiler.mongo_listeners())
+        metrics.incr("mongo_clients_opened_total")
         db = client[db_name]
-        return client, db
+        ensure_indexes(db)
+        return client, db if unscoped else tenant_db(db, current_tenant())
     except Exception as e:
         st.error(f"Error connecting to MongoDB: {e}")
         return None, None
@@ -0,0 +1,304 @@
+# exports.py
+"""Streaming export and import of contacts, templates and email stats as CSV(.gz), Parquet or NDJSON(.gz).
+
+    python -m exports export contacts contacts.parquet
+    python -m exports import contacts contacts.csv.gz [--batch-size 5000] [--tenant acme]
+
+An export reads the collection through one cursor and writes each batch as it arrives (a Parquet row group,
+a block of CSV or NDJSON lines); an import reads the file back in batches and upserts each one with a
+single bulk_write. Memory stays at one batch whatever the size of the collection or file. The format comes
+from the file name. _id is left out: imports match documents on the collection's natural key instead, so
+running the same import twice changes nothing. Templates that already exist in the target are left as
+they are, since their content belongs to a version history; user ids are copied verbatim. Contact attributes
+are columns named attributes.<name>, typed from the contact_attributes registry; an import goes through
+contacts.upsert_contacts, so it canonicalizes addresses like every other contact write. The CLI reads and
+writes one tenant's documents (--tenant, the default workspace unless given); tenant_id is not a column.
+"""
+import argparse
+import gzip
+import json
+import logging
+import os
+import tempfile
+from contextlib import ExitStack
+from datetime import datetime
+from itertools import islice
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+import streamlit as st
+from bson import ObjectId
+from pymongo import UpdateOne
+from db import DEFAULT_TENANT, get_db, tenant_db
+import audit
+import contacts
+import invalidation
+
+BATCH_SIZE = 5000  # documents per cursor batch, written row group and bulk_write
+CSV_BLOCK_BYTES = 1 << 20  # CSV bytes parsed per read while importing
+FORMATS = ("csv.gz", "csv", "parquet", "ndjson.gz", "ndjson")
+MIME_TYPES = {"csv.gz": "application/gzip", "csv": "text/csv", "parquet": "application/vnd.apache.parquet",
+              "ndjson.gz": "application/gzip", "ndjson": "application/x-ndjson"}
+
+# collection -> (columns, natural key an import upserts on, whether an import overwrites matched documents)
+SPECS = {
+    "contacts": (pa.schema([("username", pa.string()), ("added_at", pa.timestamp("us")), ("updated_at", pa.timestamp("us"))]),
+                 ("username",), True),
+    "templates": (pa.schema([("user_id", pa.string()), ("template_name", pa.string()), ("template_content", pa.string()),
+                             ("summary", pa.string()), ("superuser", pa.bool_())]),
+                  ("user_id", "template_name"), False),
+    "email_stats": (pa.schema([("user_id", pa.string()), ("sent", pa.int64()), ("messages", pa.int64()),
+                               ("bounced", pa.int64()), ("opened", pa.int64()),
+                               ("clicked", pa.int64()), ("complained", pa.int64()), ("timestamp", pa.timestamp("us"))]),
+                    ("user_id",), True),
+}
+
+ATTRIBUTES = "attributes."  # column prefix of contact attributes
+ATTRIBUTE_TYPES = {"bool": pa.bool_(), "int": pa.int64(), "float": pa.float64(), "date": pa.timestamp("us"),
+                   "string": pa.string()}
+
+logger = logging.getLogger(__name__)
+
+
+def detect_format(name):
+    for fmt in FORMATS:
+        if name.lower().endswith(f".{fmt}"):
+            return fmt
+    raise ValueError(f"Unsupported file type for {name}; use one of: {', '.join('.' + f for f in FORMATS)}")
+
+def _schema(db, collection):
+    """The collection's columns, plus one per registered attribute for contacts."""
+    schema = SPECS[collection][0]
+    if collection == "contacts":
+        schema = pa.schema(list(schema) + [(ATTRIBUTES + name, ATTRIBUTE_TYPES.get(type_name, pa.string()))
+                                           for name, type_name in sorted(contacts.attribute_types(db).items())])
+    return schema
+
+def _with_file_attributes(schema, table):
+    """schema plus the attribute columns of an imported contacts file that the registry does not know yet."""
+    extra = [table.schema.field(name) for name in table.column_names
+             if name.startswith(ATTRIBUTES) and name not in schema.names]
+    return pa.schema(list(schema) + extra) if extra else schema
+
+def _field(doc, name):
+    for part in name.split("."):
+        doc = doc.get(part) if isinstance(doc, dict) else None
+    return doc
+
+def _value(value, type_):
+    if value is None:
+        return None
+    if pa.types.is_string(type_):
+        return str(value)  # ObjectId user ids, dates stored as strings by older code
+    if pa.types.is_integer(type_):
+        return int(value)
+    if pa.types.is_boolean(type_):
+        return bool(value)
+    return value
+
+def _table(docs, schema):
+    return pa.Table.from_pylist([{f.name: _value(_field(doc, f.name), f.type) for f in schema} for doc in docs], schema=schema)
+
+def _conform(table, schema):
+    """table with exactly the schema's columns and types; missing columns become nulls."""
+    columns = [table.column(f.name).cast(f.type) if f.name in table.column_names else pa.nulls(len(table), f.type)
+               for f in schema]
+    return pa.Table.from_arrays(columns, schema=schema)
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, ObjectId):
+        return str(value)
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+class _CsvWriter:
+    def __init__(self, stream, schema):
+        self._writer = pa_csv.CSVWriter(stream, schema)
+
+    def write(self, table):
+        self._writer.write_table(table)
+
+    def close(self):
+        self._writer.close()
+
+class _ParquetWriter:
+    def __init__(self, stream, schema):
+        self._writer = pq.ParquetWriter(stream, schema, compression="zstd")
+
+    def write(self, table):
+        self._writer.write_table(table)  # one row group per batch
+
+    def close(self):
+        self._writer.close()
+
+class _NdjsonWriter:
+    def __init__(self, stream, schema):
+        self._stream = stream
+
+    def write(self, table):
+        self._stream.write("".join(json.dumps({k: v for k, v in row.items() if v is not None}, default=_json_default) + "\n"
+                                   for row in table.to_pylist()).encode("utf-8"))
+
+    def close(self):
+        pass
+
+WRITERS = {"csv": _CsvWriter, "parquet": _ParquetWriter, "ndjson": _NdjsonWriter}
+
+
+# Readers yield every column of `schema` (or null) and, for contacts, any attributes.* column in the file
+
+def _read_csv(stream, schema, batch_size, attributes=False):
+    # Attribute columns the schema lacks get Arrow's inferred type; _conform drops any other extra column
+    columns = {} if attributes else {"include_columns": schema.names, "include_missing_columns": True}
+    reader = pa_csv.open_csv(stream, read_options=pa_csv.ReadOptions(block_size=CSV_BLOCK_BYTES),
+                             convert_options=pa_csv.ConvertOptions(
+                                 column_types={f.name: f.type for f in schema}, strings_can_be_null=True, **columns))
+    for batch in reader:
+        yield pa.Table.from_batches([batch])
+
+def _read_parquet(stream, schema, batch_size, attributes=False):
+    parquet = pq.ParquetFile(stream)
+    columns = [name for name in parquet.schema_arrow.names
+               if name in schema.names or (attributes and name.startswith(ATTRIBUTES))]
+    for batch in parquet.iter_batches(batch_size=batch_size, columns=columns):
+        yield pa.Table.from_batches([batch])
+
+def _read_ndjson(stream, schema, batch_size, attributes=False):
+    # Timestamps arrive as ISO strings and are parsed by the cast in _conform
+    loose = pa.schema([(f.name, pa.string() if pa.types.is_timestamp(f.type) else f.type) for f in schema])
+    lines = (line for line in stream if line.strip())
+    while True:
+        rows = [json.loads(line) for line in islice(lines, batch_size)]
+        if not rows:
+            return
+        table = pa.Table.from_pylist([{f.name: _value(row.get(f.name), f.type) for f in loose} for row in rows], schema=loose)
+        if attributes:
+            for name in sorted({k for row in rows for k in row if k.startswith(ATTRIBUTES) and k not in loose.names}):
+                table = table.append_column(name, pa.array([row.get(name) for row in rows]))
+        yield table
+
+READERS = {"csv": _read_csv, "parquet": _read_parquet, "ndjson": _read_ndjson}
+
+
+def _open(stack, target, fmt, mode):
+    """Binary stream for a path or an open file, gzip-wrapped for .gz formats; closed with the stack."""
+    stream = stack.enter_context(open(target, mode)) if isinstance(target, (str, os.PathLike)) else target
+    if fmt.endswith(".gz"):
+        stream = stack.enter_context(gzip.GzipFile(fileobj=stream, mode=mode))
+    return stream
+
+def export_collection(db, collection, target, fmt=None, batch_size=BATCH_SIZE):
+    """Write `collection` to a path or binary file in batches; returns the number of documents written."""
+    schema = _schema(db, collection)
+    fmt = fmt or detect_format(str(target))
+    with ExitStack() as stack:
+        writer = WRITERS[fmt.split(".")[0]](_open(stack, target, fmt, "wb"), schema)
+        cursor = db[collection].find({}, {name: 1 for name in schema.names}, batch_size=batch_size)
+        written = 0
+        while True:
+            docs = list(islice(cursor, batch_size))
+            if not docs:
+                break
+            writer.write(_table(docs, schema))
+            written += len(docs)
+        writer.close()
+    return written
+
+def import_collection(db, collection, source, fmt=None, batch_size=BATCH_SIZE):
+    """Upsert the rows of a path or binary file into `collection` in batches; returns (rows read, documents added)."""
+    _, key, overwrite = SPECS[collection]
+    schema = _schema(db, collection)
+    fmt = fmt or detect_format(str(getattr(source, "name", source)))
+    read, added = 0, 0
+    with ExitStack() as stack:
+        reader = READERS[fmt.split(".")[0]](_open(stack, source, fmt, "rb"), schema, batch_size, collection == "contacts")
+        for table in reader:
+            for offset in range(0, len(table), batch_size):
+                batch = table.slice(offset, batch_size)
+                rows = _conform(batch, _with_file_attributes(schema, batch)).to_pylist()
+                read += len(rows)
+                if collection == "contacts":
+                    added += len(contacts.upsert_contacts(db, [
+                        (row["username"], {k[len(ATTRIBUTES):]: v for k, v in row.items() if k.startswith(ATTRIBUTES)})
+                        for row in rows])[0])
+                    continue
+                ops = [UpdateOne({name: row[name] for name in key},
+                                 {"$set" if overwrite else "$setOnInsert": {k: v for k, v in row.items() if v is not None}},
+                                 upsert=True)
+                       for row in rows if all(row[name] not in (None, "") for name in key)]
+                if ops:
+                    added += db[collection].bulk_write(ops, ordered=False).upserted_count
+    if collection in invalidation.WATCHED:
+        invalidation.publish(db, collection)
+    return read, added
+
+
+def show_export(collection, label=None):
+    """Format picker and download button for one collection."""
+    fmt = st.selectbox("Format", FORMATS, key=f"export_format_{collection}")
+    if not st.button(label or f"Export {collection}", key=f"export_{collection}"):
+        return
+    client, db = get_db()
+    if db is None:
+        return
+    try:
+        # Spills to disk past 64 MB while the cursor is written out; download_button only takes bytes or a plain file
+        with tempfile.SpooledTemporaryFile(max_size=64 << 20) as spool:
+            count = export_collection(db, collection, spool, fmt)
+            spool.seek(0)
+            data = spool.read()
+        st.success(f"{count} document(s) exported.")
+        st.download_button(f"Download {collection}.{fmt}", data, file_name=f"{collection}.{fmt}", mime=MIME_TYPES[fmt])
+    except Exception as e:
+        st.error(f"Error exporting {collection}: {e}")
+    finally:
+        client.close()
+
+def show_import(collection):
+    """Uploader for a file made by show_export or `python -m exports export`."""
+    uploaded = st.file_uploader(f"Import {collection} from an export file", type=["gz", "csv", "parquet", "ndjson"],
+                                key=f"import_{collection}")
+    if uploaded is None or not st.button(f"Import {collection}", key=f"import_button_{collection}"):
+        return
+    client, db = get_db()
+    if db is None:
+        return
+    try:
+        read, added = import_collection(db, collection, uploaded, detect_format(uploaded.name))
+        audit.record("export.import", collection, target=uploaded.name, read=read, added=added)
+        st.success(f"{read} row(s) read, {added} new {collection} added, the rest updated or already present.")
+    except Exception as e:
+        st.error(f"Error importing {collection}: {e}")
+    finally:
+        client.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("action", choices=["export", "import"])
+    parser.add_argument("collection", choices=list(SPECS))
+    parser.add_argument("path", help=f"file name ending in {', '.join('.' + f for f in FORMATS)}")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--tenant", default=DEFAULT_TENANT, help="workspace to export from or import into")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    client, db = get_db()
+    if db is None:
+        parser.exit(1, "Could not connect to MongoDB.\n")
+    db = tenant_db(db, args.tenant)
+    try:
+        if args.action == "export":
+            count = export_collection(db, args.collection, args.path, batch_size=args.batch_size)
+            logger.info(f"Exported {count} {args.collection} document(s) to {args.path}.")
+        else:
+            read, added = import_collection(db, args.collection, args.path, batch_size=args.batch_size)
+            logger.info(f"Imported {read} row(s) from {args.path}; {added} new {args.collection} document(s).")
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    main()
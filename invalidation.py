@@ -0,0 +1,170 @@
+# invalidation.py
+"""Cross-replica invalidation of in-process caches built from the users, templates and contacts collections.
+
+On a replica set (or through mongos) one background thread per process watches a change stream on those
+collections and passes each changed document's _id to the subscribed caches. A standalone mongod has no change
+streams, so writers also record each change in the `invalidations` collection (TTL-expired), and the thread polls
+it instead. Writes made outside the app are only seen through change streams; in polling mode the cache TTLs
+bound how stale they can get.
+
+MASSMAIL_INVALIDATION: "auto" (change streams when available, else polling), "changestream", "poll" or "off".
+"""
+import logging
+import os
+import threading
+import time
+import uuid
+from datetime import timedelta
+from pymongo.errors import PyMongoError
+from db import current_tenant, get_db, now
+
+MODE = os.getenv("MASSMAIL_INVALIDATION", "auto")
+WATCHED = ("users", "templates", "contacts")
+POLL_INTERVAL = 2  # seconds between polls of `invalidations`
+POLL_SKEW = timedelta(seconds=30)  # re-read this far back so replicas with slower clocks are not missed
+RETRY_DELAY = 5  # seconds before reconnecting after an error
+CACHE_TTL = int(os.getenv("MASSMAIL_CACHE_TTL", "300"))
+PROCESS_ID = uuid.uuid4().hex
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_subscribers = {}  # collection -> [callback(key)], key None meaning "anything may have changed"
+_listener = None
+_mode = None  # "changestream" or "poll" once the listener has connected
+
+
+def subscribe(collection, callback):
+    """Call callback(document id as str, or None) whenever any replica changes `collection`."""
+    with _lock:
+        _subscribers.setdefault(collection, []).append(callback)
+
+def start():
+    """Start this process's listener; caches call it on first use, so importing a module starts no thread."""
+    global _listener
+    with _lock:
+        if MODE != "off" and _listener is None:
+            _listener = threading.Thread(target=_listen, name="cache-invalidation", daemon=True)
+            _listener.start()
+
+def notify(collection, key=None):
+    """Run this process's callbacks; collection None reaches every cache."""
+    with _lock:
+        callbacks = [cb for name, cbs in _subscribers.items() if collection in (None, name) for cb in cbs]
+    for callback in callbacks:
+        try:
+            callback(None if key is None else str(key))
+        except Exception as e:
+            logger.error(f"Cache invalidation callback failed for {collection}: {e}")
+
+def publish(db, collection, key=None):
+    """Invalidate after a write: here at once, and on other replicas through the change stream or the poll."""
+    notify(collection, key)
+    if MODE == "off" or _mode == "changestream":
+        return
+    try:
+        db.invalidations.insert_one({"collection": collection, "key": None if key is None else str(key),
+                                     "origin": PROCESS_ID, "at": now()})
+    except PyMongoError as e:
+        logger.warning(f"Could not publish invalidation for {collection}: {e}")
+
+
+def _change_streams_supported(db):
+    try:
+        hello = db.command("hello")
+    except Exception:
+        return False
+    return "setName" in hello or hello.get("msg") == "isdbgrid"
+
+def _watch(db):
+    global _mode
+    resume_token = None
+    pipeline = [{"$match": {"ns.coll": {"$in": list(WATCHED)}}}]
+    while True:
+        with db.watch(pipeline, resume_after=resume_token) as stream:
+            if resume_token is None:
+                notify(None)  # anything written before the stream opened may be missing from caches
+            _mode = "changestream"
+            for change in stream:
+                resume_token = stream.resume_token
+                if change["operationType"] in ("insert", "update", "replace", "delete"):
+                    notify(change["ns"]["coll"], change["documentKey"]["_id"])
+                else:
+                    # drop, rename, dropDatabase, invalidate: the stream cannot say which documents changed
+                    notify(None)
+                    resume_token = None
+                    break
+
+def _poll(db):
+    global _mode
+    _mode = "poll"
+    since, seen = now(), {}
+    while True:
+        for doc in db.invalidations.find({"at": {"$gte": since - POLL_SKEW}}).sort("at", 1):
+            if doc["_id"] in seen:
+                continue
+            seen[doc["_id"]] = doc["at"]
+            since = max(since, doc["at"])
+            if doc.get("origin") != PROCESS_ID:
+                notify(doc.get("collection"), doc.get("key"))
+        seen = {_id: at for _id, at in seen.items() if at >= since - POLL_SKEW}
+        time.sleep(POLL_INTERVAL)
+
+def _listen():
+    while True:
+        client, db = get_db()
+        if db is None:
+            time.sleep(RETRY_DELAY)
+            continue
+        try:
+            if MODE == "changestream" or (MODE == "auto" and _change_streams_supported(db)):
+                _watch(db)
+            else:
+                _poll(db)
+        except PyMongoError as e:
+            logger.warning(f"Cache invalidation listener lost its connection: {e}")
+        except Exception as e:
+            logger.error(f"Cache invalidation listener failed: {e}")
+        finally:
+            client.close()
+        notify(None)  # events may have been missed while reconnecting
+        time.sleep(RETRY_DELAY)
+
+
+class CollectionCache:
+    """Values derived from one collection, dropped whenever any replica writes to it (and after CACHE_TTL).
+
+    Keys are kept per tenant: a value loaded in one tenant's page run is never served to another's.
+    """
+
+    def __init__(self, collection, ttl=CACHE_TTL, max_entries=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._values = {}
+        self._generation = 0
+        subscribe(collection, lambda key: self.clear())
+
+    def get(self, key, loader):
+        start()
+        key = (current_tenant(), key)
+        with self._lock:
+            cached = self._values.get(key)
+            generation = self._generation
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        value = loader()
+        with self._lock:
+            # A write that landed while loading may not be in `value`; only a load that saw no invalidation is kept.
+            # None (no database) is never cached.
+            if value is not None and generation == self._generation:
+                self._values.pop(key, None)
+                self._values[key] = (value, time.monotonic() + self.ttl)
+                while self.max_entries and len(self._values) > self.max_entries:
+                    del self._values[next(iter(self._values))]  # oldest first
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._values.clear()
@@ -0,0 +1,216 @@
+# loadtest.py
+"""Drive concurrent simulated admins through the Streamlit pages headlessly and report per-page cost.
+
+    python loadtest.py [--users 10] [--iterations 5] [--backend mongomock|mongod] [--seed 1000] [--strict-budgets]
+
+Every simulated admin runs in its own process, logs in through login.py, then reruns each page script the way
+a browser session would. Each rerun is timed and profiler.py counts the Mongo commands it issued against the
+page's query budget. With mongomock each process seeds its own in-memory store, so only --backend mongod
+measures contention on the database; the mongomock backend needs pip install -r requirements-dev.txt.
+"""
+import argparse
+import multiprocessing
+import os
+import time
+from datetime import timedelta
+
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")
+os.environ.setdefault("MONGO_DB", "massmail_load")
+os.environ.setdefault("MASSMAIL_SCHEDULER", "none")
+os.environ["MASSMAIL_PROFILE_QUERIES"] = "1"
+
+from streamlit import logger as st_logger
+from streamlit.testing.v1 import AppTest
+st_logger.set_log_level("error")  # importing and seeding outside a script run warn about a missing ScriptRunContext
+import contacts
+import db
+import benchmark
+import passwords
+import preview
+import profiler
+
+ADMIN_USERNAME = "loadtest-admin"
+ADMIN_PASSWORD = "loadtest-password"
+RERUN_TIMEOUT = 60  # seconds a single page rerun may take before AppTest gives up
+
+# (page, script target) in the order a simulated admin visits them
+PAGES = [
+    ("home", "login.py"),
+    ("dashboard", "dashboard:app"),
+    ("compose", "sendmail:email_dashboard"),
+    ("scheduled", "sendmail:generate_scheduled_email_reports"),
+    ("templates", "template:manage_templates"),
+    ("users", "usermanagement:superuser_dashboard"),
+    ("contacts", "usermanagement:managecontacts"),
+    ("audit", "audit:show_audit_log"),
+]
+
+# mongomock method -> the Mongo command pymongo would send for it
+MONGOMOCK_COMMANDS = {
+    "find": "find", "find_one": "find", "insert_one": "insert", "insert_many": "insert", "update_one": "update",
+    "update_many": "update", "delete_one": "delete", "delete_many": "delete", "aggregate": "aggregate",
+    "count_documents": "aggregate", "bulk_write": "update",
+}
+
+
+def profile_mongomock():
+    """mongomock never fires command listeners, so feed its calls to profiler.record() directly."""
+    import mongomock
+    for name, command in MONGOMOCK_COMMANDS.items():
+        original = getattr(mongomock.collection.Collection, name)
+
+        def profiled(self, *args, _original=original, _command=command, **kwargs):
+            start = time.perf_counter()
+            try:
+                return _original(self, *args, **kwargs)
+            finally:
+                profiler.record(_command, self.name, time.perf_counter() - start)
+        setattr(mongomock.collection.Collection, name, profiled)
+
+
+def _page_script(target):
+    # AppTest runs this source on its own script thread, so it cannot close over module globals
+    import importlib
+    import runpy
+    if target.endswith(".py"):
+        runpy.run_path(target, run_name="__main__")
+    else:
+        module, func = target.split(":")
+        getattr(importlib.import_module(module), func)()
+
+
+def seed(n):
+    benchmark.reset_collections("users", "contacts", "contact_attributes", "templates", "template_versions", "scheduled_emails", "email_stats")
+    user_ids = benchmark.seed_users()
+    client, database = db.get_db()
+    try:
+        database = db.tenant_db(database, db.DEFAULT_TENANT)  # the signed-in admin's pages only see their tenant
+        database.users.insert_one({"username": ADMIN_USERNAME, "password": passwords.hash_password(ADMIN_PASSWORD),
+                                   "is_superuser": True, "is_enabled": True})
+        contacts.upsert_contacts(database, [(f"contact{i}@example.com", {"first_name": f"Contact {i}"}) for i in range(n)])
+        templates = [
+            {"user_id": user_ids[i % len(user_ids)] if i % 2 else "superuser", "template_name": f"Template {i}",
+             "template_content": f"<h1>Offer {i}</h1>" + "<p>Body text.</p>" * 20, "version": 1, "superuser": not i % 2,
+             "created_at": db.now()}
+            for i in range(20)
+        ]
+        for t in templates:
+            t["summary"] = preview.summarize(t["template_content"])
+        database.templates.insert_many(templates)
+        database.template_versions.insert_many([
+            {"template_id": t["_id"], "user_id": t["user_id"], "template_name": t["template_name"], "version": 1,
+             "content": t["template_content"], "author": t["user_id"], "created_at": t["created_at"]}
+            for t in templates
+        ])
+        when = db.now() + timedelta(days=1)
+        database.scheduled_emails.insert_many([
+            {"user_id": user_ids[i % len(user_ids)], "to_emails": f"contact{i}@example.com", "subject": "Load", "body": "Hi",
+             "schedule_time": when, "next_run_at": when, "status": "Pending", "created_at": db.now()}
+            for i in range(n)
+        ])
+        database.email_stats.insert_many([
+            {"user_id": uid, "sent": 10, "messages": 5, "bounced": 1, "opened": 4, "timestamp": db.now()} for uid in user_ids
+        ])
+        return user_ids
+    finally:
+        client.close()
+
+
+class SimulatedAdmin:
+    def __init__(self, number, sender_id):
+        self.key = f"admin{number}"
+        self.sender_id = sender_id
+        self.samples = {}  # page -> [(seconds, mongo commands, reruns over budget, exceptions)]
+        self.apps = {page: AppTest.from_function(_page_script, args=(target,), default_timeout=RERUN_TIMEOUT)
+                     for page, target in PAGES}
+
+    def rerun(self, page, app=None):
+        at = self.apps[app or page]
+        start = time.perf_counter()
+        at.run()
+        elapsed = time.perf_counter() - start
+        profiles = profiler.drain()
+        self.samples.setdefault(page, []).append((elapsed, sum(len(p.commands) for p in profiles),
+                                                  sum(p.over_budget for p in profiles), len(at.exception)))
+        return at
+
+    def login(self):
+        at = self.rerun("login", app="home")
+        at.radio[0].set_value("Login")
+        self.rerun("login", app="home")
+        at.text_input(key="username").input(ADMIN_USERNAME)
+        at.text_input(key="password").input(ADMIN_PASSWORD)
+        at.button(key="login").click()
+        self.rerun("login", app="home")
+        # Pages other than home each run in their own AppTest session, already signed in
+        for page, app in self.apps.items():
+            if page == "home":
+                continue
+            app.session_state["is_logged_in"] = True
+            app.session_state["user_details"] = {"user_id": self.sender_id, "username": f"{self.key}@example.com",
+                                                 "is_enabled": True}
+            app.session_state["user_id"] = self.sender_id
+
+    def run(self, iterations):
+        self.login()
+        for _ in range(iterations):
+            for page, _target in PAGES:
+                self.rerun(page)
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def report(samples, users, wall):
+    print(f"{users} concurrent admins, {sum(len(s) for s in samples.values())} reruns in {wall:.1f}s")
+    print(f"{'page':<12}{'reruns':>8}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}{'db ops/rerun':>14}{'max ops':>9}"
+          f"{'budget':>8}{'over':>6}{'errors':>8}")
+    for page, rows in samples.items():
+        latencies = [r[0] * 1000 for r in rows]
+        ops = [r[1] for r in rows]
+        print(f"{page:<12}{len(rows):>8}{percentile(latencies, .5):>10.1f}{percentile(latencies, .95):>10.1f}"
+              f"{max(latencies):>10.1f}{sum(ops) / len(ops):>14.1f}{max(ops):>9}{str(profiler.QUERY_BUDGETS.get(page, '-')):>8}"
+              f"{sum(r[2] for r in rows):>6}{sum(r[3] for r in rows):>8}")
+
+
+def simulate(number, backend, seed_size, iterations, sender_ids=None):
+    """One simulated admin in its own process: AppTest keeps a process-wide runtime, so sessions cannot share one."""
+    benchmark.install_backend(backend)
+    if backend == "mongomock":
+        profile_mongomock()
+    if sender_ids is None:
+        sender_ids = seed(seed_size)  # mongomock stores are per process
+    admin = SimulatedAdmin(number, sender_ids[number % len(sender_ids)])
+    admin.run(iterations)
+    return admin.samples
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--backend", choices=["mongomock", "mongod"], default="mongomock")
+    parser.add_argument("--seed", type=int, default=1000, help="contacts and scheduled emails to seed")
+    parser.add_argument("--strict-budgets", action="store_true", help="fail reruns that exceed profiler.QUERY_BUDGETS")
+    args = parser.parse_args()
+    if args.strict_budgets:
+        os.environ["MASSMAIL_QUERY_BUDGET_STRICT"] = "1"  # read by profiler.py in the spawned processes
+
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))  # pages load ./Massmailit.png
+    sender_ids = None
+    if args.backend == "mongod":
+        benchmark.install_backend(args.backend)
+        sender_ids = seed(args.seed)
+
+    samples = {}
+    start = time.perf_counter()
+    with multiprocessing.get_context("spawn").Pool(args.users) as pool:
+        jobs = [pool.apply_async(simulate, (i, args.backend, args.seed, args.iterations, sender_ids)) for i in range(args.users)]
+        for job in jobs:
+            for page, rows in job.get().items():
+                samples.setdefault(page, []).extend(rows)
+    report(samples, args.users, time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,12 @@
+import re
 import streamlit as st
-from hashlib import sha256
-from db import get_db, to_object_id
+from pymongo.errors import DuplicateKeyError
+from db import DEFAULT_TENANT, get_db, now, to_object_id
 import mainpage
+import passwords
+import profiler
+import search
+import session
 
 # Initialize session state for login status
 if 'is_logged_in' not in st.session_state:
@@ -11,7 +16,12 @@ st.set_page_config(
         page_title="Mass Mailing",
     )
 
-def register_superuser(username, password):
+def tenant_key(workspace):
+    """tenant_id for a workspace name: lower-cased, runs of other characters turned into '-'."""
+    return re.sub(r"[^a-z0-9]+", "-", str(workspace or "").strip().lower()).strip("-")
+
+def register_superuser(username, password, workspace=None):
+    """Register an admin; a new workspace name creates that tenant, a blank one joins the default workspace."""
     if not username or not username.strip():
         return {"status":"error","message":"Username cannot be empty."}
     if not password or len(password)<8:
@@ -20,12 +30,29 @@ def register_superuser(username, password):
     if db is None:
         return {"status":"error","message":"DB connection failed."}
     try:
-        hashed_password = sha256(password.encode()).hexdigest()
+        hashed_password = passwords.hash_password(password)
         # ensure unique username
         if db.users.find_one({"username": username.strip()}):
             return {"status":"error", "message":"Username already exists."}
-        user_doc = {"username": username.strip(), "password": hashed_password, "is_superuser": True, "is_enabled": True}
-        db.users.insert_one(user_doc)
+        tenant_id = DEFAULT_TENANT
+        if workspace and workspace.strip():
+            tenant_id = tenant_key(workspace)
+            if not tenant_id:
+                return {"status":"error", "message":"Workspace name needs at least one letter or digit."}
+            try:
+                # _id is the tenant_id, so two registrations racing for one name cannot both create it
+                db.tenants.insert_one({"_id": tenant_id, "name": workspace.strip(), "created_at": now()})
+            except DuplicateKeyError:
+                return {"status":"error", "message":"Workspace already exists."}
+        user_doc = {"username": username.strip(), "username_lc": search.username_key(username), "password": hashed_password,
+                    "is_superuser": True, "is_enabled": True, "tenant_id": tenant_id}
+        try:
+            db.users.insert_one(user_doc)
+        except DuplicateKeyError:
+            # Another registration took the name since the check above; give up the workspace made for it
+            if tenant_id != DEFAULT_TENANT:
+                db.tenants.delete_one({"_id": tenant_id})
+            return {"status":"error", "message":"Username already exists."}
         return {"status":"success", "message":"Admin registered successfully!"}
     except Exception as e:
         return {"status":"error", "message": f"Registration failed: {e}"}
@@ -37,12 +64,17 @@ def login_superuser(username, password):
     if db is None:
         return {"status":"error","message":"DB connection failed."}
     try:
-        hashed_password = sha256(password.encode()).hexdigest()
-        user = db.users.find_one({"username": username, "password": hashed_password, "is_superuser": True})
-        if user:
+        user = db.users.find_one({"username": username, "is_superuser": True})
+        if user is None:
+            passwords.dummy_verify(password)
+        elif passwords.verify_password(password, user.get("password")):
+            if passwords.needs_rehash(user["password"]):
+                # Upgrade legacy sha256 (or old-cost) hashes now that the plaintext is known
+                rehashed = passwords.hash_password(password)
+                db.users.update_one({"_id": user["_id"], "password": user["password"]}, {"$set": {"password": rehashed}})
+                user["password"] = rehashed
             return {"status":"success", "user": user}
-        else:
-            return {"status":"error", "message":"Invalid credentials or not an Admin"}
+        return {"status":"error", "message":"Invalid credentials or not an Admin"}
     except Exception as e:
         return {"status":"error", "message": f"Login failed: {e}"}
     finally:
@@ -50,6 +82,7 @@ def login_superuser(username, password):
 
 
 # Function to display the login/register page for superusers
+@profiler.page("login")
 def show_login_page():
     logincss="""
     <style>
@@ -110,8 +143,10 @@ def show_login_page():
 
         # Register Button
         if auth_action == "Register":
+            workspace = st.text_input("Workspace", key="workspace",
+                                      help="Name a new workspace to keep its data apart; leave blank for the default one")
             if st.button("Register", key="register", help="Click to Register as Admin"):
-                response = register_superuser(username, password)
+                response = register_superuser(username, password, workspace)
                 if response['status'] == "success":
                     st.success(response['message'])
                 else:
@@ -122,14 +157,15 @@ def show_login_page():
             if st.button("Login", key="login", help="Click to Login as Admin"):
                 response = login_superuser(username, password)
                 if response['status'] == "success":
-                    st.session_state['user'] = response['user']
-                    st.session_state.is_logged_in = True
+                    session.sign_in(response['user'])
                     st.success("Logged in successfully!")
                 else:
                     st.error(response.get('message', "Login failed"))
 
 
 # Main app logic
+if st.session_state.is_logged_in and session.current_admin() is None:
+    session.sign_out()  # the admin was deleted or demoted since signing in
 if st.session_state.is_logged_in:
     mainpage.app()
 else:
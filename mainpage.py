@@ -1,6 +1,7 @@
 import streamlit as st
 from streamlit_option_menu import option_menu
 import dashboard,sendmail,template,usermanagement
+import session
 
 
 
@@ -109,6 +110,6 @@ def app():
 
         run()
     if st.button("Logout"):
-        st.session_state.is_logged_in = False  # Update login state
+        session.sign_out()  # Update login state
 
 
@@ -0,0 +1,217 @@
+# mimebuilder.py
+"""multipart/alternative (text + HTML) messages for the Gmail API, compiled once per template.
+
+The Gmail API takes the whole RFC 822 message base64url-encoded. A compiled template splits that message
+into chunks whose byte lengths are multiples of 3, so each chunk's base64 can be computed on its own and the
+results concatenated. Static chunks (part headers, bodies without placeholders) are encoded once; only the
+recipient headers and bodies containing {{placeholders}} are encoded per message; a placeholder with no value
+is left as written, so a typo shows in the message instead of silently vanishing. Chunk lengths are evened
+out with whitespace the MIME grammar ignores: trailing blanks on the X-Mailer header and transport padding
+after each boundary delimiter (RFC 2046 5.1.1). Bodies are quoted-printable, so for ASCII-heavy templates the
+outer base64 is the only size overhead.
+"""
+import base64
+import binascii
+import html
+import re
+import uuid
+from email.header import Header
+from email.utils import encode_rfc2231, formatdate, make_msgid
+from functools import lru_cache
+from html.parser import HTMLParser
+import attachments
+
+PLACEHOLDER = re.compile(r"{{\s*([A-Za-z_][A-Za-z0-9_]*)\s*}}")
+HTML_TAG = re.compile(r"<([A-Za-z][A-Za-z0-9]*)\b[^>]*>")
+COMPILED_CACHE_SIZE = 64
+# A "tracking_token" render variable (see tracking.py) is also sent as this header, for matching bounces
+TOKEN_VARIABLE = "tracking_token"
+TOKEN_HEADER = "X-MassMail-Token"
+
+
+def _b64(data):
+    return base64.urlsafe_b64encode(data).decode("ascii")
+
+def _quoted_printable(text):
+    """Part body as quoted-printable with CRLF line ends; close to raw size for mostly-ASCII templates."""
+    crlf = text.replace("\r\n", "\n").replace("\n", "\r\n")
+    return binascii.b2a_qp(crlf.encode("utf-8")) + b"\r\n"
+
+def _pad(length):
+    return b" " * (-length % 3)
+
+def _param(name, value):
+    """name="value" MIME parameter, RFC 2231 encoded when the value is not ASCII."""
+    if value.isascii():
+        return f'{name}="{value.replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+    return f"{name}*={encode_rfc2231(value, 'utf-8')}"
+
+def _header(name, value):
+    """One header line; non-ASCII values are RFC 2047 encoded and address lists are folded one per line."""
+    value = str(value)
+    if name in ("To", "Cc", "Bcc"):
+        value = ",\r\n ".join(a.strip() for a in value.split(",") if a.strip())
+    elif not value.isascii():
+        value = Header(value, "utf-8").encode()
+    return f"{name}: {value}\r\n".encode()
+
+
+class _TextExtractor(HTMLParser):
+    BREAKS = {"br", "p", "div", "li", "tr", "h1", "h2", "h3", "h4", "h5", "h6"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self._skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ("style", "script"):
+            self._skip += 1
+        elif tag in self.BREAKS:
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in ("style", "script"):
+            self._skip = max(0, self._skip - 1)
+        elif tag in self.BREAKS:
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        if not self._skip:
+            self.parts.append(data)
+
+def html_to_text(body):
+    parser = _TextExtractor()
+    parser.feed(body)
+    lines = (" ".join(line.split()) for line in "".join(parser.parts).splitlines())
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(lines)).strip()
+
+def is_html(body):
+    return bool(HTML_TAG.search(body or ""))
+
+def variable_names(*texts):
+    """Names of the {{placeholders}} in `texts`."""
+    return {name for text in texts for name in PLACEHOLDER.findall(text or "")}
+
+def _split(text):
+    """literal, (name, placeholder as written), literal, ..., literal"""
+    segments, last = [], 0
+    for match in PLACEHOLDER.finditer(text):
+        segments += [text[last:match.start()], (match.group(1), match.group(0))]
+        last = match.end()
+    segments.append(text[last:])
+    return segments
+
+def _fill(segments, variables, escape):
+    values = variables or {}
+    return "".join(
+        segment if i % 2 == 0 else escape(str(values[segment[0]])) if segment[0] in values else segment[1]
+        for i, segment in enumerate(segments)
+    )
+
+
+class _Part:
+    """One alternative: its delimiter and headers are static, its body is static unless it has placeholders."""
+
+    def __init__(self, boundary, content_type, body, escape):
+        self.head = f"--{boundary}".encode()
+        self.headers = (f"\r\nContent-Type: {content_type}; charset=\"utf-8\"\r\n"
+                        f"Content-Transfer-Encoding: quoted-printable\r\n\r\n").encode()
+        self.segments = _split(body)
+        self.escape = escape
+        self.chunk = None if len(self.segments) > 1 else self._chunk(body)
+        self.encoded = None if self.chunk is None else _b64(self.chunk)
+
+    def _chunk(self, body):
+        tail = self.headers + _quoted_printable(body)
+        return self.head + _pad(len(self.head) + len(tail)) + tail  # transport padding after the delimiter
+
+    def _body(self, variables):
+        return _fill(self.segments, variables, self.escape)
+
+    def render(self, variables):
+        return self.encoded if self.encoded is not None else _b64(self._chunk(self._body(variables)))
+
+    def render_bytes(self, variables):
+        return self.chunk if self.chunk is not None else self._chunk(self._body(variables))
+
+
+class CompiledMessage:
+    """A message template compiled once and rendered per recipient with render(to_emails, variables).
+
+    attachments are (sha256, filename, content_type) refs from attachments.store_attachment(); such messages
+    are rendered with render_stream() for a media upload, reusing each attachment's encoded, mapped body.
+    """
+
+    def __init__(self, from_email, subject, body, cc=None, bcc=None, text=None, attachments=()):
+        boundary = f"=_{uuid.uuid4().hex}"
+        html_body = body if is_html(body) else html.escape(body or "").replace("\n", "<br>\n")
+        text_body = text if text is not None else (html_to_text(body) if is_html(body) else body or "")
+        self.from_email, self.subject, self.cc, self.bcc = from_email, subject or "", cc, bcc
+        self.msgid_domain = (from_email or "").rpartition("@")[2] or None  # skips make_msgid's getfqdn() per message
+        self.subject_segments = _split(self.subject)
+        self.attachments = tuple(attachments)
+        self.prologue, self.attachment_heads = b"", []
+        top_type = f'multipart/alternative; boundary="{boundary}"'
+        if self.attachments:
+            mixed = f"=_{uuid.uuid4().hex}"
+            top_type = f'multipart/mixed; boundary="{mixed}"'
+            self.prologue = f"--{mixed}\r\nContent-Type: multipart/alternative; boundary=\"{boundary}\"\r\n\r\n".encode()
+            self.attachment_heads = [
+                (f"--{mixed}\r\nContent-Type: {content_type}; {_param('name', filename)}\r\n"
+                 f"Content-Disposition: attachment; {_param('filename', filename)}\r\n"
+                 f"Content-Transfer-Encoding: base64\r\n\r\n").encode()
+                for _, filename, content_type in self.attachments
+            ]
+            self.mixed_closing = f"--{mixed}--\r\n".encode()
+        self.top = f"MIME-Version: 1.0\r\nContent-Type: {top_type}\r\nX-Mailer: MassMailIt".encode()
+        self.parts = [
+            _Part(boundary, "text/plain", text_body, lambda v: v),
+            _Part(boundary, "text/html", html_body, html.escape),
+        ]
+        self.alternative_closing = f"--{boundary}--\r\n".encode()
+        self.closing = _b64(self.alternative_closing)
+
+    def _subject(self, variables):
+        if len(self.subject_segments) == 1:
+            return self.subject
+        return _fill(self.subject_segments, variables, str)
+
+    def _head(self, to_emails, variables):
+        lines = [_header("From", self.from_email), _header("To", to_emails)]
+        if self.cc:
+            lines.append(_header("Cc", self.cc))
+        if self.bcc:
+            lines.append(_header("Bcc", self.bcc))
+        if variables and variables.get(TOKEN_VARIABLE):
+            lines.append(_header(TOKEN_HEADER, variables[TOKEN_VARIABLE]))
+        lines += [_header("Subject", self._subject(variables)), _header("Date", formatdate(localtime=True)),
+                  _header("Message-ID", make_msgid(domain=self.msgid_domain)), self.top]
+        head = b"".join(lines)
+        return head + _pad(len(head) + 4) + b"\r\n\r\n"
+
+    def render(self, to_emails, variables=None):
+        """base64url raw message for users.messages.send."""
+        if self.attachments:
+            raise ValueError("Messages with attachments are sent with render_stream()")
+        pieces = [_b64(self._head(to_emails, variables))]
+        pieces += [part.render(variables) for part in self.parts]
+        pieces.append(self.closing)
+        return "".join(pieces)
+
+    def render_stream(self, to_emails, variables=None):
+        """The RFC 822 message as a seekable stream for a media upload; attachment bodies are never copied."""
+        segments = [self._head(to_emails, variables), self.prologue]
+        segments += [part.render_bytes(variables) for part in self.parts]
+        segments.append(self.alternative_closing)
+        if self.attachments:
+            for (sha, _, _), head in zip(self.attachments, self.attachment_heads):
+                segments += [head, attachments.encoded_body(sha)]
+            segments.append(self.mixed_closing)
+        return attachments.MessageStream(segments)
+
+
+@lru_cache(maxsize=COMPILED_CACHE_SIZE)
+def compile_message(from_email, subject, body, cc=None, bcc=None, attachments=()):
+    """Compiled template shared by every send of the same campaign content in this process."""
+    return CompiledMessage(from_email, subject, body, cc, bcc, attachments=attachments)
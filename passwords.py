@@ -0,0 +1,149 @@
+# passwords.py
+"""Password hashing for admins and users.
+
+    python passwords.py [--target-ms 250] [--concurrency 8]
+
+prints the scrypt cost that keeps a login under the target latency with that many logins at once;
+set it as MASSMAIL_SCRYPT_COST, or use "auto" to calibrate once per process at the first hash.
+"""
+import argparse
+import base64
+import hmac
+import os
+import secrets
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from hashlib import scrypt, sha256
+import metrics
+
+# scrypt CPU/memory cost as a power of two (14 -> N=16384, 16 MiB per hash)
+SCRYPT_COST = os.getenv("MASSMAIL_SCRYPT_COST", "14")
+SCRYPT_R = 8
+SCRYPT_P = 1
+MIN_COST, MAX_COST = 12, 20
+LOGIN_BUDGET_MS = int(os.getenv("MASSMAIL_LOGIN_BUDGET_MS", "250"))
+# Hashes allowed to run at once; more only queue on the CPU while multiplying scrypt's memory use
+HASH_CONCURRENCY = int(os.getenv("MASSMAIL_HASH_CONCURRENCY", str(os.cpu_count() or 4)))
+
+_slots = threading.BoundedSemaphore(HASH_CONCURRENCY)
+
+
+def _b64(raw):
+    return base64.b64encode(raw).decode().rstrip("=")
+
+def _unb64(text):
+    return base64.b64decode(text + "=" * (-len(text) % 4))
+
+def _scrypt(password, salt, cost, r=SCRYPT_R, p=SCRYPT_P):
+    n = 1 << cost
+    with _slots, metrics.timer("password_hash_seconds"):
+        return scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r, dklen=32)
+
+
+class ScryptHasher:
+    """Salted scrypt stored as scrypt$<cost>$<r>$<p>$<salt>$<digest>."""
+
+    scheme = "scrypt"
+
+    def identify(self, stored):
+        return stored.startswith("scrypt$")
+
+    def hash(self, password, cost):
+        salt = secrets.token_bytes(16)
+        return f"scrypt${cost}${SCRYPT_R}${SCRYPT_P}${_b64(salt)}${_b64(_scrypt(password, salt, cost))}"
+
+    def verify(self, password, stored):
+        _, cost, r, p, salt, digest = stored.split("$")
+        return hmac.compare_digest(_scrypt(password, _unb64(salt), int(cost), int(r), int(p)), _unb64(digest))
+
+    def cost(self, stored):
+        _, cost, r, p, _, _ = stored.split("$")
+        return int(cost), int(r), int(p)
+
+
+class LegacySha256Hasher:
+    """Unsalted hex sha256 written before scrypt; verified once more, then rehashed on login."""
+
+    scheme = "sha256"
+
+    def identify(self, stored):
+        return len(stored) == 64 and all(c in "0123456789abcdef" for c in stored)
+
+    def verify(self, password, stored):
+        return hmac.compare_digest(sha256(password.encode()).hexdigest(), stored)
+
+
+# The first hasher writes new hashes; the rest are only recognised for verification
+HASHERS = [ScryptHasher(), LegacySha256Hasher()]
+
+
+def _hasher_for(stored):
+    for hasher in HASHERS:
+        if stored and hasher.identify(stored):
+            return hasher
+    return None
+
+@lru_cache(maxsize=1)
+def current_cost():
+    if SCRYPT_COST == "auto":
+        return calibrate()
+    return int(SCRYPT_COST)
+
+def hash_password(password):
+    return HASHERS[0].hash(password, current_cost())
+
+def verify_password(password, stored):
+    hasher = _hasher_for(stored)
+    return bool(hasher and password is not None and hasher.verify(password, stored))
+
+def needs_rehash(stored):
+    """True for legacy formats and for hashes made at another cost than the configured one."""
+    hasher = _hasher_for(stored)
+    return hasher is not HASHERS[0] or hasher.cost(stored) != (current_cost(), SCRYPT_R, SCRYPT_P)
+
+@lru_cache(maxsize=1)
+def _dummy_hash():
+    return hash_password(secrets.token_hex(16))
+
+def dummy_verify(password):
+    """Spend a real verification on unknown usernames so response time does not reveal which exist."""
+    verify_password(password or "", _dummy_hash())
+
+
+def measure_logins(cost, concurrency, rounds=3):
+    """Wall-clock seconds of `concurrency` simultaneous verifications at `cost`, queueing on the hash slots included."""
+    stored = HASHERS[0].hash("calibration", cost)
+
+    def login(_):
+        start = time.perf_counter()
+        HASHERS[0].verify("calibration", stored)
+        return time.perf_counter() - start
+    with ThreadPoolExecutor(concurrency) as pool:
+        return sorted(t for _ in range(rounds) for t in pool.map(login, range(concurrency)))
+
+def calibrate(target_ms=LOGIN_BUDGET_MS, concurrency=HASH_CONCURRENCY, report=None):
+    """Highest cost whose p95 login stays within target_ms under `concurrency` concurrent logins."""
+    best = MIN_COST
+    for cost in range(MIN_COST, MAX_COST + 1):
+        latencies = measure_logins(cost, concurrency)
+        p95 = latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))] * 1000
+        if report:
+            report(cost, latencies[len(latencies) // 2] * 1000, p95)
+        if p95 > target_ms:
+            break
+        best = cost
+    return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--target-ms", type=int, default=LOGIN_BUDGET_MS)
+    parser.add_argument("--concurrency", type=int, default=HASH_CONCURRENCY)
+    args = parser.parse_args()
+
+    print(f"{'cost':>4}{'p50 ms':>10}{'p95 ms':>10}   ({args.concurrency} concurrent logins, {HASH_CONCURRENCY} hash slots)")
+    best = calibrate(args.target_ms, args.concurrency,
+                     report=lambda cost, p50, p95: print(f"{cost:>4}{p50:>10.1f}{p95:>10.1f}"))
+    print(f"MASSMAIL_SCRYPT_COST={best} keeps p95 login under {args.target_ms} ms")
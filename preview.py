@@ -0,0 +1,128 @@
+# preview.py
+"""Template previews rendered as they would be sent to a sample contact, and lint run before a campaign starts.
+
+Previews are sanitized before they reach st.markdown(unsafe_allow_html=True): scripts, styles, event
+handlers and javascript: links would otherwise run inside (or restyle) the Streamlit page itself.
+"""
+import hashlib
+import html
+import threading
+from collections import OrderedDict
+from html.parser import HTMLParser
+import metrics
+from mimebuilder import PLACEHOLDER, html_to_text, is_html, variable_names
+
+SUMMARY_CHARS = 120
+CLIP_BYTES = 102 * 1024  # Gmail hides HTML past ~102 KB behind "View entire message"
+PREVIEW_CACHE_SIZE = 128
+
+ALLOWED_TAGS = {"a", "b", "blockquote", "br", "center", "code", "div", "em", "font", "h1", "h2", "h3", "h4", "h5", "h6",
+                "hr", "i", "img", "li", "ol", "p", "pre", "small", "span", "strong", "sub", "sup", "table", "tbody",
+                "td", "tfoot", "th", "thead", "tr", "u", "ul"}
+VOID_TAGS = {"br", "hr", "img"}
+DROPPED_CONTENT = {"script", "style", "iframe", "object", "embed", "head", "title"}
+ALLOWED_ATTRS = {"href", "src", "alt", "title", "width", "height", "align", "colspan", "rowspan", "color"}
+SAFE_URL_SCHEMES = ("http:", "https:", "mailto:", "cid:", "#")
+
+_lock = threading.Lock()
+_previews = OrderedDict()  # sha256 of the template content and sample values -> sanitized preview HTML
+
+
+class _Sanitizer(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self._skip = 0
+
+    def _open(self, tag, attrs, close=""):
+        kept = []
+        for name, value in attrs:
+            value = (value or "").strip()
+            if name not in ALLOWED_ATTRS:
+                continue
+            if name in ("href", "src") and not value.lower().startswith(SAFE_URL_SCHEMES):
+                continue
+            kept.append(f' {name}="{html.escape(value)}"')
+        self.parts.append(f"<{tag}{''.join(kept)}{close}>")
+
+    def handle_starttag(self, tag, attrs):
+        if tag in DROPPED_CONTENT:
+            self._skip += 1
+        elif not self._skip and tag in ALLOWED_TAGS:
+            self._open(tag, attrs)
+
+    def handle_startendtag(self, tag, attrs):
+        if not self._skip and tag in ALLOWED_TAGS:
+            self._open(tag, attrs, " /")
+
+    def handle_endtag(self, tag):
+        if tag in DROPPED_CONTENT:
+            self._skip = max(0, self._skip - 1)
+        elif not self._skip and tag in ALLOWED_TAGS and tag not in VOID_TAGS:
+            self.parts.append(f"</{tag}>")
+
+    def handle_data(self, data):
+        if not self._skip:
+            self.parts.append(html.escape(data))
+
+def sanitize(markup):
+    parser = _Sanitizer()
+    parser.feed(markup)
+    parser.close()
+    return "".join(parser.parts)
+
+def content_hash(content):
+    return hashlib.sha256((content or "").encode("utf-8")).hexdigest()
+
+def fill(content, values=None):
+    """HTML body as it would be sent: plain text gets line breaks, placeholders with a value are filled in, escaped,
+    and the rest are left as written (see mimebuilder)."""
+    values = values or {}
+    body = content or ""
+    if not is_html(body):
+        body = html.escape(body).replace("\n", "<br>\n")
+    return PLACEHOLDER.sub(lambda m: html.escape(str(values[m.group(1)])) if m.group(1) in values else m.group(0), body)
+
+def render_preview(content, values=None):
+    """Sanitized preview HTML for a template filled in with a sample contact's `values`, rendered once per distinct
+    content and values."""
+    key = content_hash(f"{content}\0{sorted((values or {}).items())!r}")
+    with _lock:
+        cached = _previews.get(key)
+        if cached is not None:
+            _previews.move_to_end(key)
+    if cached is not None:
+        metrics.incr("preview_cache_hits_total")
+        return cached
+    metrics.incr("preview_cache_misses_total")
+    with metrics.timer("preview_render_seconds"):
+        rendered = sanitize(fill(content, values))
+    with _lock:
+        _previews[key] = rendered
+        while len(_previews) > PREVIEW_CACHE_SIZE:
+            _previews.popitem(last=False)
+    return rendered
+
+def summarize(content, limit=SUMMARY_CHARS):
+    """One-line plain-text summary for template lists."""
+    text = " ".join((html_to_text(content) if is_html(content) else content or "").split())
+    return text if len(text) <= limit else text[:limit - 1].rstrip() + "…"
+
+def lint(body, subject="", variables=()):
+    """Problems to fix before a campaign starts, as (level, message); "error" entries should block sending.
+
+    `variables` are the contact attribute names sends fill placeholders in from.
+    """
+    known = set(variables)
+    problems = []
+    undefined = sorted(variable_names(subject, body) - known)
+    if undefined:
+        available = f"Contact attributes: {', '.join(sorted(known))}." if known else "No contact has attributes yet."
+        problems.append(("error", "Undefined variables would be sent as written: "
+                                  + ", ".join(f"{{{{{name}}}}}" for name in undefined) + f". {available}"))
+    size = len(fill(body, {}).encode("utf-8"))
+    if size > CLIP_BYTES:
+        problems.append(("warning", f"The body is {size // 1024} KB; Gmail clips messages over {CLIP_BYTES // 1024} KB."))
+    if not (body or "").strip():
+        problems.append(("warning", "The body is empty."))
+    return problems
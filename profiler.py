@@ -0,0 +1,178 @@
+# profiler.py
+import contextlib
+import functools
+import logging
+import os
+import sys
+import threading
+import time
+from collections import deque
+from pymongo import monitoring
+import metrics
+
+# Read once at import: when disabled, page() returns the function untouched and no listener is registered
+ENABLED = os.getenv("MASSMAIL_PROFILE_QUERIES", "").lower() in ("1", "true", "yes")
+# Raise QueryBudgetExceeded instead of logging a warning; meant for tests and loadtest.py
+STRICT = os.getenv("MASSMAIL_QUERY_BUDGET_STRICT", "").lower() in ("1", "true", "yes")
+
+# Mongo commands one rerun of each page may issue, including the button action that triggered it
+QUERY_BUDGETS = {
+    "login": 2,
+    "dashboard": 6,
+    "compose": 3,
+    "scheduled": 6,
+    "templates": 4,
+    "users": 1,
+    "manage_users": 3,
+    "contacts": 4,
+    "audit": 2,
+}
+# Driver housekeeping that says nothing about how a page queries
+IGNORED_COMMANDS = {"createIndexes", "endSessions", "hello", "isMaster", "ismaster", "ping", "saslStart",
+                    "saslContinue", "killCursors"}
+HISTORY = 200  # reruns kept for the admin panel
+
+_APP_DIR = os.path.dirname(os.path.abspath(__file__))
+_SKIP_FILES = {os.path.join(_APP_DIR, name) for name in ("db.py", "profiler.py", "metrics.py", "loadtest.py")}
+
+logger = logging.getLogger(__name__)
+_local = threading.local()
+_lock = threading.Lock()
+_history = deque(maxlen=HISTORY)
+
+
+class QueryBudgetExceeded(RuntimeError):
+    pass
+
+
+class RerunProfile:
+    """Commands one page rerun issued: [(command, collection, caller, seconds)]."""
+
+    __slots__ = ("page", "started_at", "commands", "seconds")
+
+    def __init__(self, page):
+        self.page = page
+        self.started_at = time.time()
+        self.commands = []
+        self.seconds = 0.0
+
+    @property
+    def budget(self):
+        return QUERY_BUDGETS.get(self.page)
+
+    @property
+    def over_budget(self):
+        return self.budget is not None and len(self.commands) > self.budget
+
+    def by_caller(self):
+        counts = {}
+        for command, collection, caller, seconds in self.commands:
+            count, total = counts.get((caller, command, collection), (0, 0.0))
+            counts[(caller, command, collection)] = (count + 1, total + seconds)
+        return counts
+
+
+def _caller():
+    """First app function up the stack, skipping the db/metrics plumbing, e.g. "dashboard.fetch_user_stats"."""
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(_APP_DIR) and filename not in _SKIP_FILES:
+            return f"{os.path.splitext(os.path.basename(filename))[0]}.{frame.f_code.co_name}"
+        frame = frame.f_back
+    return "?"
+
+def record(command, collection, seconds):
+    """Attribute one command to the page rerun running on this thread; a no-op outside a profiled page."""
+    stack = getattr(_local, "stack", None)
+    if not stack or command in IGNORED_COMMANDS:
+        return
+    stack[-1].commands.append((command, collection, _caller(), seconds))
+
+def _finish(profile):
+    with _lock:
+        _history.append(profile)
+    if not profile.over_budget:
+        return
+    metrics.incr("query_budget_exceeded_total", page=profile.page)
+    summary = ", ".join(f"{caller} {command} {collection} x{count}"
+                        for (caller, command, collection), (count, _) in profile.by_caller().items())
+    message = f"{profile.page} issued {len(profile.commands)} Mongo commands (budget {profile.budget}): {summary}"
+    if STRICT:
+        raise QueryBudgetExceeded(message)
+    logger.warning(message)
+
+def page(name):
+    """Decorator marking a Streamlit page function; its Mongo commands are counted against QUERY_BUDGETS[name]."""
+    def decorator(func):
+        if not ENABLED:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            stack = _local.__dict__.setdefault("stack", [])
+            profile = RerunProfile(name)
+            stack.append(profile)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profile.seconds = time.perf_counter() - start
+                stack.pop()
+                _finish(profile)
+        return wrapper
+    return decorator
+
+@contextlib.contextmanager
+def setup():
+    """Commands inside are one-off schema setup (indexes, backfills), not queries of the page that ran them."""
+    stack = getattr(_local, "stack", None)
+    _local.stack = []
+    try:
+        yield
+    finally:
+        _local.stack = stack
+
+def recent(page_name=None):
+    """Most recent rerun profiles first, optionally for one page."""
+    with _lock:
+        profiles = list(_history)
+    return [p for p in reversed(profiles) if page_name is None or p.page == page_name]
+
+def drain():
+    """Profiles recorded since the last drain, oldest first; used by loadtest.py after each rerun."""
+    with _lock:
+        profiles = list(_history)
+        _history.clear()
+    return profiles
+
+
+class QueryProfiler(monitoring.CommandListener):
+    """Attributes every command a MongoClient sends to the page rerun on the issuing thread (started() runs there)."""
+
+    def __init__(self):
+        self._pending = {}
+
+    def started(self, event):
+        stack = getattr(_local, "stack", None)
+        if not stack:
+            return
+        collection = event.command.get(event.command_name)
+        self._pending[event.request_id] = (stack[-1], _caller(), collection if isinstance(collection, str) else "")
+
+    def _done(self, event):
+        profile, caller, collection = self._pending.pop(event.request_id, (None, None, ""))
+        if profile is not None and event.command_name not in IGNORED_COMMANDS:
+            profile.commands.append((event.command_name, collection, caller, event.duration_micros / 1e6))
+
+    def succeeded(self, event):
+        self._done(event)
+
+    def failed(self, event):
+        self._done(event)
+
+
+_listener = QueryProfiler()
+
+def mongo_listeners():
+    return [_listener] if ENABLED else []
@@ -0,0 +1,136 @@
+# recipients.py
+"""Recipients of an in-flight campaign as one Arrow string array plus a bitmap per delivery status.
+
+A million addresses take about their own bytes plus 4 MB of offsets and 125 KB per status bitmap, against
+roughly 75 MB for a Python list of str. Slicing (recipients[a:b]) is zero-copy: the slice shares the
+addresses buffer and the bitmaps, so a sender can mark its part of a campaign without copying it.
+"""
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+
+SENT, FAILED, SUPPRESSED = "sent", "failed", "suppressed"
+STATUSES = (SENT, FAILED, SUPPRESSED)
+PREVIEW_ROWS = 100
+
+
+def _normalize(values):
+    """Trimmed, lower-cased, de-duplicated addresses in first-seen order, without blanks."""
+    values = pc.utf8_lower(pc.utf8_trim_whitespace(values.cast(pa.string())))
+    values = values.filter(pc.and_kleene(pc.is_valid(values), pc.not_equal(values, "")))
+    return pc.unique(values)
+
+
+class RecipientSet:
+    def __init__(self, addresses, bitmaps=None, offset=0):
+        self.addresses = addresses
+        self._bitmaps = bitmaps or {s: np.zeros((len(addresses) + 7) // 8, np.uint8) for s in STATUSES}
+        self._offset = offset
+
+    @classmethod
+    def from_array(cls, values):
+        if isinstance(values, pa.ChunkedArray):
+            values = values.combine_chunks()
+        return cls(_normalize(values))
+
+    @classmethod
+    def from_list(cls, values):
+        return cls.from_array(pa.array(list(values or []), pa.string()))
+
+    @classmethod
+    def from_text(cls, text):
+        """Addresses from a comma-separated string such as a To header."""
+        return cls.from_array(pc.split_pattern(pa.array([text or ""]), ",").flatten())
+
+    @classmethod
+    def from_csv(cls, fileobj, column="username"):
+        """The `column` of an uploaded CSV, read straight into Arrow."""
+        try:
+            table = pa_csv.read_csv(fileobj, convert_options=pa_csv.ConvertOptions(
+                include_columns=[column], column_types={column: pa.string()}))
+        except KeyError as e:  # pyarrow's ArrowKeyError for a missing include_columns entry
+            raise ValueError(f"The CSV file must contain an '{column}' column.") from e
+        return cls.from_array(table.column(column))
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def __iter__(self):
+        return iter(self.addresses.to_pylist())
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self.addresses[index].as_py()
+        start, stop, step = index.indices(len(self))
+        if step != 1:
+            raise ValueError("RecipientSet slices must be contiguous")
+        return RecipientSet(self.addresses.slice(start, max(0, stop - start)), self._bitmaps, self._offset + start)
+
+    @property
+    def nbytes(self):
+        return self.addresses.nbytes + sum(b.nbytes for b in self._bitmaps.values())
+
+    def header(self, mask=None):
+        """Comma-separated addresses for a To/Cc/Bcc header, joined in Arrow rather than through Python strings."""
+        addresses = self.addresses if mask is None else self.addresses.filter(pa.array(mask))
+        if not len(addresses):
+            return ""
+        joined = pa.ListArray.from_arrays(pa.array([0, len(addresses)], pa.int32()), addresses)
+        return pc.binary_join(joined, ",")[0].as_py()
+
+    def preview(self, rows=PREVIEW_ROWS):
+        return self.addresses.slice(0, rows).to_pandas().rename("username").to_frame()
+
+    def status(self, status):
+        """Boolean mask of the recipients in this set marked `status`."""
+        bits = np.unpackbits(self._bitmaps[status], count=self._offset + len(self))
+        return bits[self._offset:].astype(bool)
+
+    def pending(self):
+        """Mask of recipients with no status yet."""
+        done = np.zeros(len(self), bool)
+        for status in STATUSES:
+            done |= self.status(status)
+        return ~done
+
+    def mark(self, status, mask=None):
+        """Mark every recipient in this set, or those where `mask` is true, as `status`."""
+        positions = np.arange(len(self)) if mask is None else np.flatnonzero(mask)
+        positions = positions + self._offset
+        np.bitwise_or.at(self._bitmaps[status], positions >> 3, (0x80 >> (positions & 7)).astype(np.uint8))
+
+    def mark_addresses(self, status, addresses):
+        """Mark the recipients found in `addresses` (an Arrow array or iterable of normalized addresses) as `status`."""
+        value_set = addresses if isinstance(addresses, pa.Array) else pa.array(list(addresses), pa.string())
+        if len(value_set):
+            self.mark(status, pc.is_in(self.addresses, value_set=value_set).to_numpy(zero_copy_only=False))
+
+    def suppress(self, addresses):
+        self.mark_addresses(SUPPRESSED, addresses)
+
+    def to_list(self, mask=None):
+        """Addresses as Python strings, or only those where `mask` is true."""
+        addresses = self.addresses if mask is None else self.addresses.filter(pa.array(mask))
+        return addresses.to_pylist()
+
+    def counts(self):
+        counts = {status: int(self.status(status).sum()) for status in STATUSES}
+        counts["pending"] = int(self.pending().sum())
+        return counts
+
+
+def coerce(value):
+    """RecipientSet from a RecipientSet, a comma-separated string or a list of addresses."""
+    if isinstance(value, RecipientSet):
+        return value
+    if isinstance(value, str) or value is None:
+        return RecipientSet.from_text(value)
+    return RecipientSet.from_list(value)
+
+def header(value):
+    return coerce(value).header()
+
+def count(value):
+    """Distinct addresses in a header string, list or RecipientSet."""
+    return len(coerce(value))
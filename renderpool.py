@@ -0,0 +1,82 @@
+# renderpool.py
+"""Process-pool stage that turns scheduled emails into ready-to-send raw messages.
+
+Compiling templates and base64-encoding messages is CPU-bound; in the send threads it shares one core with
+them under the GIL. RenderPool spreads it over worker processes in chunks. A chunk carries each distinct
+template once and one compact (template index, to, variables) record per message, and comes back as one
+string of concatenated base64url messages plus end offsets: two pickles per chunk instead of one per message.
+Chunks are yielded in order as they finish, so sending starts before the whole dispatch is rendered. A
+dispatch is split into one chunk per process (within MIN_CHUNK..RENDER_CHUNK), so even a single claim
+batch of a few hundred emails keeps every process busy.
+"""
+import multiprocessing
+import os
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from mimebuilder import compile_message
+
+# Processes rendering for a scheduler; 0 renders in the send threads as before
+RENDER_PROCESSES = int(os.getenv("MASSMAIL_RENDER_PROCESSES", "0"))
+RENDER_CHUNK = 1000  # most messages per task
+MIN_CHUNK = 50  # fewest messages per task; smaller ones spend more on the round trip than on rendering
+MIN_POOLED = 200  # smaller dispatches are rendered in the send threads; the round trip would cost more
+
+
+def render_chunk(templates, records):
+    """Raw messages for one chunk, as (blob, ends); message i is blob[ends[i-1]:ends[i]]."""
+    parts, ends, size = [], array("Q"), 0
+    for template_index, to_emails, variables in records:
+        raw = compile_message(*templates[template_index]).render(to_emails, variables)
+        parts.append(raw)
+        size += len(raw)
+        ends.append(size)
+    return "".join(parts), ends
+
+def _pack(messages):
+    """Chunk-local template table and records for (from, subject, body, cc, bcc, to, variables) messages."""
+    templates, index, records = [], {}, []
+    for from_email, subject, body, cc, bcc, to_emails, variables in messages:
+        key = (from_email, subject, body, cc or None, bcc or None)
+        if key not in index:
+            index[key] = len(templates)
+            templates.append(key)
+        records.append((index[key], to_emails, variables))
+    return templates, records
+
+def _unpack(blob, ends):
+    start = 0
+    for end in ends:
+        yield blob[start:end]
+        start = end
+
+
+def chunk_size(count, processes, largest=RENDER_CHUNK):
+    """Messages per task that spread `count` over every process, within MIN_CHUNK..largest."""
+    return max(1, min(largest, max(MIN_CHUNK, -(-count // processes))))
+
+
+class RenderPool:
+    def __init__(self, processes=None, chunk=RENDER_CHUNK):
+        self.processes = processes or RENDER_PROCESSES or os.cpu_count() or 1
+        self.chunk = chunk
+        # spawn: the scheduler process has sender and Mongo threads that a forked child would inherit half-stopped
+        self._executor = ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context("spawn"))
+
+    def render(self, messages):
+        """Yield the raw message for each (from, subject, body, cc, bcc, to, variables), in order."""
+        messages = list(messages)
+        chunk = chunk_size(len(messages), self.processes, self.chunk)
+        futures = [self._executor.submit(render_chunk, *_pack(messages[i:i + chunk]))
+                   for i in range(0, len(messages), chunk)]
+        for future in futures:
+            yield from _unpack(*future.result())
+
+    def warm_up(self):
+        """Start every process and import the renderer in it, so the first dispatch does not pay for it."""
+        sample = ("warm-up@example.com", "", "", None, None, "warm-up@example.com", None)
+        futures = [self._executor.submit(render_chunk, *_pack([sample])) for _ in range(self.processes)]
+        for future in futures:
+            future.result()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
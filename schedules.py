@@ -0,0 +1,81 @@
+# schedules.py
+import os
+from datetime import timedelta, timezone as dt_timezone
+from functools import lru_cache
+from zoneinfo import ZoneInfo, available_timezones
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
+
+# Wall-clock times typed into the UI are interpreted in this zone unless the sender picks another
+DEFAULT_TIMEZONE = os.getenv("MASSMAIL_TIMEZONE", "UTC")
+
+RECURRENCE_OPTIONS = ["Does not repeat", "Daily", "Weekly", "Every N minutes", "Custom cron"]
+
+
+@lru_cache(maxsize=1)
+def timezone_names():
+    return tuple(sorted(available_timezones()))
+
+def to_utc(local_dt, tz_name=None):
+    """Naive wall time in `tz_name` (server local time if None) -> naive UTC, as stored in Mongo."""
+    aware = local_dt.replace(tzinfo=ZoneInfo(tz_name)) if tz_name else local_dt.astimezone()
+    return aware.astimezone(dt_timezone.utc).replace(tzinfo=None)
+
+def from_utc(utc_dt, tz_name):
+    return utc_dt.replace(tzinfo=dt_timezone.utc).astimezone(ZoneInfo(tz_name))
+
+def build_recurrence(option, local_dt, minutes=None, cron=None):
+    """Turn the compose form's repeat choice into the recurrence stored on scheduled_emails."""
+    if option == "Daily":
+        return {"type": "cron", "expr": f"{local_dt.minute} {local_dt.hour} * * *"}
+    if option == "Weekly":
+        return {"type": "cron", "expr": f"{local_dt.minute} {local_dt.hour} * * {local_dt.strftime('%a').lower()}"}
+    if option == "Every N minutes":
+        return {"type": "interval", "minutes": int(minutes)}
+    if option == "Custom cron":
+        CronTrigger.from_crontab(cron)  # raises ValueError on a malformed expression
+        return {"type": "cron", "expr": cron.strip()}
+    return None
+
+def describe_recurrence(recurrence):
+    if not recurrence:
+        return ""
+    if recurrence["type"] == "cron":
+        return f"cron {recurrence['expr']}"
+    return f"every {recurrence['minutes']} min"
+
+def _trigger(recurrence, tz_name, start):
+    if recurrence["type"] == "cron":
+        return CronTrigger.from_crontab(recurrence["expr"], timezone=ZoneInfo(tz_name))
+    return IntervalTrigger(minutes=recurrence["minutes"], start_date=start, timezone=ZoneInfo(tz_name))
+
+def first_run_at(local_dt, tz_name, recurrence=None):
+    """UTC time of the first send for a schedule starting at the wall time `local_dt` in `tz_name`."""
+    if not recurrence:
+        return to_utc(local_dt, tz_name)
+    start = local_dt.replace(tzinfo=ZoneInfo(tz_name))
+    fire = _trigger(recurrence, tz_name, start).get_next_fire_time(None, start)
+    return fire.astimezone(dt_timezone.utc).replace(tzinfo=None) if fire else None
+
+def next_run_after(doc, after_utc):
+    """Next UTC run strictly after `after_utc` for a recurring scheduled email, or None if it is one-off."""
+    recurrence = doc.get("recurrence")
+    if not recurrence:
+        return None
+    tz_name = doc.get("timezone") or DEFAULT_TIMEZONE
+    start = from_utc(doc.get("first_run_at") or doc["next_run_at"], tz_name)
+    after = (after_utc + timedelta(microseconds=1)).replace(tzinfo=dt_timezone.utc)
+    # previous_fire_time=None makes the trigger skip straight past any runs missed while no scheduler was up
+    fire = _trigger(recurrence, tz_name, start).get_next_fire_time(None, after)
+    return fire.astimezone(dt_timezone.utc).replace(tzinfo=None) if fire else None
+
+def group_by_timezone(recipients, recipient_timezones, default_tz):
+    """Split recipients into {tz_name: [addresses]} using each contact's stored timezone."""
+    valid = set(timezone_names())
+    groups = {}
+    for address in recipients:
+        tz_name = recipient_timezones.get(address.lower())
+        if tz_name not in valid:
+            tz_name = default_tz
+        groups.setdefault(tz_name, []).append(address)
+    return groups
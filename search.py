@@ -0,0 +1,105 @@
+# search.py
+"""Username prefix search for users and contacts, and the pickers that replace pasted ObjectIds.
+
+A search is one query on an indexed lower-cased username: users carry username_lc, and contact usernames
+are already canonical (see contacts.py). An anchored, escaped prefix regex on such a field is an index range
+scan. Results are cached per (prefix, limit) and dropped whenever any replica writes to the collection, so a
+picker re-run on every keystroke costs one query per new prefix.
+"""
+import re
+import streamlit as st
+from bson import ObjectId
+from pymongo import UpdateOne
+from db import get_db, tenant_of
+import contacts
+import invalidation
+
+SEARCH_LIMIT = 10  # matches offered by a picker
+CACHE_ENTRIES = 1000  # prefixes cached per collection
+USER_FIELDS = {"username": 1, "is_enabled": 1, "is_superuser": 1}
+
+_users = invalidation.CollectionCache("users", max_entries=CACHE_ENTRIES)
+_contacts = invalidation.CollectionCache("contacts", max_entries=CACHE_ENTRIES)
+_backfilled = set()  # tenants whose users this process has given username_lc
+
+
+def username_key(username):
+    return str(username or "").strip().lower()
+
+def backfill_username_keys(db):
+    """Give users created before username_lc their key; runs once per tenant and process."""
+    if tenant_of(db) in _backfilled:
+        return
+    ops = [UpdateOne({"_id": d["_id"]}, {"$set": {"username_lc": username_key(d.get("username"))}})
+           for d in db.users.find({"username_lc": {"$exists": False}}, {"username": 1})]
+    if ops:
+        db.users.bulk_write(ops, ordered=False)
+        invalidation.publish(db, "users")
+    _backfilled.add(tenant_of(db))
+
+def _prefix(text):
+    return {"$regex": "^" + re.escape(text)}
+
+def _load(loader):
+    client, db = get_db()
+    if db is None:
+        return None
+    try:
+        return loader(db)
+    finally:
+        client.close()
+
+def search_users(prefix, limit=SEARCH_LIMIT, enabled_only=False):
+    """Users whose username starts with `prefix` (any case), as [{user_id, username, is_enabled, is_superuser}]."""
+    key = username_key(prefix)
+    if not key:
+        return []
+
+    def load(db):
+        backfill_username_keys(db)
+        query = {"username_lc": _prefix(key)}
+        if enabled_only:
+            query["is_enabled"] = True
+        return [{"user_id": str(d["_id"]), "username": d.get("username"), "is_enabled": bool(d.get("is_enabled")),
+                 "is_superuser": bool(d.get("is_superuser"))}
+                for d in db.users.find(query, USER_FIELDS).sort("username_lc", 1).limit(limit)]
+    return _users.get((key, limit, enabled_only), lambda: _load(load)) or []
+
+def search_contacts(prefix, limit=SEARCH_LIMIT):
+    """Contacts whose address starts with `prefix` (any case), as [{id, username}]."""
+    key = contacts.canonical_address(prefix)
+    if not key:
+        return []
+
+    def load(db):
+        contacts.migrate_legacy(db)
+        return [{"id": str(d["_id"]), "username": d["username"]}
+                for d in db.contacts.find({"username": _prefix(key)}, {"username": 1}).sort("username", 1).limit(limit)]
+    return _contacts.get((key, limit), lambda: _load(load)) or []
+
+def user_query(user_ref):
+    """Single indexed lookup for a user id or a username."""
+    if isinstance(user_ref, ObjectId) or ObjectId.is_valid(str(user_ref)):
+        return {"_id": ObjectId(str(user_ref))}
+    return {"username_lc": username_key(user_ref)}
+
+
+def _pick(label, key, search, describe, placeholder):
+    text = st.text_input(label, key=f"{key}_search", placeholder=placeholder)
+    matches = search(text) if text.strip() else []
+    if text.strip() and not matches:
+        st.caption("No matches.")
+    if st.session_state.get(key) not in matches:
+        st.session_state[key] = matches[0] if matches else None  # a new prefix selects its best match
+    return st.selectbox("Matches", matches, format_func=describe, key=key, label_visibility="collapsed",
+                        disabled=not matches)
+
+def user_picker(label, key, enabled_only=False):
+    """Typeahead for a user; returns the chosen search_users entry or None."""
+    return _pick(label, key, lambda text: search_users(text, enabled_only=enabled_only),
+                 lambda u: f"{u['username']}{'' if u['is_enabled'] else ' (disabled)'}",
+                 "Start typing a username")
+
+def contact_picker(label, key):
+    """Typeahead for a contact; returns the chosen search_contacts entry or None."""
+    return _pick(label, key, search_contacts, lambda c: c["username"], "Start typing an address")
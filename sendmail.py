@@ -1,52 +1,70 @@
 import streamlit as st
 import pandas as pd
-import os, pickle, base64, logging
+import os, pickle, logging
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaIoBaseUpload
 from google.auth.transport.requests import Request
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from db import get_db, to_object_id, now
+from mimebuilder import TOKEN_VARIABLE, compile_message, variable_names
+from attachments import store_attachment
+from template import available_templates, get_template_version, load_template_content, preview_variables
+from db import DEFAULT_TENANT, get_db, tenant_db, tenant_of, to_object_id, now
+import audit
+import contacts
+import invalidation
+import metrics
+import preview
+import profiler
+import recipients
+from recipients import FAILED, SENT, RecipientSet
+import search
+import session
+import tracking
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.date import DateTrigger
-from datetime import datetime
+from apscheduler.jobstores.base import JobLookupError
+from pymongo import UpdateMany, UpdateOne
+from pymongo.errors import PyMongoError
+from datetime import datetime, timedelta, timezone as dt_timezone
 from bson import ObjectId
 from streamlit_option_menu import option_menu
+from throttle import is_throttling_error, plan_chunks
+from schedules import (DEFAULT_TIMEZONE, RECURRENCE_OPTIONS, timezone_names, to_utc, from_utc, build_recurrence,
+                       describe_recurrence, first_run_at, next_run_after, group_by_timezone)
+
+# "apscheduler" registers one DateTrigger job per email in this process,
+# "batch" polls scheduled_emails for due work (see batchscheduler.py), "none" runs no scheduler here,
+# "worker" leaves scheduling and sending to `python -m worker` and queues even immediate sends
+SCHEDULER_BACKEND = os.getenv("MASSMAIL_SCHEDULER", "apscheduler")
 
 # APScheduler Scheduler
 scheduler = BackgroundScheduler()
 
-if not scheduler.running:
+if SCHEDULER_BACKEND == "apscheduler" and not scheduler.running:
     scheduler.start()
 
 SCOPES = ['https://www.googleapis.com/auth/gmail.send']
+SCHEDULED_STATUSES = ["Pending", "Sending", "Sent", "Failed", "Cancelled"]
+REPORT_PROJECTION = {"_id": 1, "user_id": 1, "to_emails": 1, "subject": 1, "schedule_time": 1, "timezone": 1,
+                     "recurrence": 1, "next_run_at": 1, "status": 1, "created_at": 1}
+REPORT_PAGE_SIZES = [25, 50, 100]
+SIMPLE_UPLOAD_LIMIT = 5 * 1024 * 1024  # larger messages go up as a resumable upload, one chunk at a time
+UPLOAD_CHUNK = 1024 * 1024  # must be a multiple of 256 KiB
+BULK_CHUNK_SIZE = 1000
+STATUS_COUNTS_TTL = 30  # seconds the report's status chart may lag writes made elsewhere
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 def fetch_user_details(user_id):
-    client, db = get_db()
-    if db is None:
-        return None
+    # ObjectId or username; served from the session cache after the first lookup
     try:
-        # try ObjectId
-        oid = to_object_id(user_id)
-        query = {}
-        if oid:
-            query = {"_id": oid}
-        else:
-            # maybe user passed their username or string id
-            query = {"$or":[{"_id":user_id},{"username":user_id},{"id":user_id}]}
-        user = db.users.find_one(query)
-        if user:
-            return {"user_id": str(user.get("_id")), "username": user.get("username"), "is_enabled": bool(user.get("is_enabled", False))}
-        return None
+        return session.get_principal(user_id)
     except Exception as e:
         st.error(f"Error fetching user details: {e}")
         return None
-    finally:
-        client.close()
 
+@metrics.timed("gmail_auth_seconds")
 def authenticate_gmail_api():
     creds = None
     if os.path.exists('token.pickle'):
@@ -62,43 +80,132 @@ def authenticate_gmail_api():
             pickle.dump(creds, token)
     return build('gmail', 'v1', credentials=creds)
 
-def log_email_stats(user_id, to_emails, cc, bcc):
+def stats_update(num_sent, messages=1):
+    # Bounces, opens, clicks and complaints are counted from real events by tracking.py. sent counts recipients,
+    # messages the emails they went out in, which is what opens and clicks are counted against
+    return {"$inc": {"sent": num_sent, "messages": messages}, "$setOnInsert": {"timestamp": now()}}
+
+def log_email_stats(user_id, to_emails, cc, bcc, tenant_id=None, messages=1):
     client, db = get_db()
     if db is None:
         return
     try:
-        unique_emails = list({e.strip().lower() for e in to_emails.split(',') if e.strip()}) if isinstance(to_emails, str) else []
-        uniqcc = list({e.strip().lower() for e in cc.split(',') if e.strip()}) if isinstance(cc, str) else []
-        uniqbcc = list({e.strip().lower() for e in bcc.split(',') if isinstance(bcc, str)}) if isinstance(bcc, str) else []
-        num_sent = len(unique_emails) + len(uniqcc) + len(uniqbcc)
-        # Upsert a stats doc per user (increment)
-        query = {"user_id": user_id}
-        update = {"$inc": {"sent": num_sent, "delivered": num_sent, "inbox": num_sent}, "$setOnInsert": {"timestamp": now()}}
-        db.email_stats.update_one(query, update, upsert=True)
-        st.write(f"Unique Recipients: {unique_emails}, Count: {num_sent}")
+        num_sent = recipients.count(to_emails) + recipients.count(cc) + recipients.count(bcc)
+        # Upsert a stats doc per user (increment); a page run's db adds its tenant, scheduler threads pass the email's
+        query = {"user_id": user_id, "tenant_id": tenant_id} if tenant_id else {"user_id": user_id}
+        db.email_stats.update_one(query, stats_update(num_sent, messages), upsert=True)
+        st.write(f"Unique Recipients: {num_sent}")
     except Exception as e:
         st.error(f"Error logging email stats: {e}")
     finally:
         client.close()
 
-def send_email(service, from_email, to_emails, subject, body, user_id, cc=None, bcc=None):
+@metrics.timed("mime_build_seconds")
+def build_raw_message(from_email, to_emails, subject, body, cc=None, bcc=None, variables=None):
+    # HTML + plain-text alternative; the encoded static parts are shared by every send of the same content
+    return compile_message(from_email, subject, body, cc or None, bcc or None).render(to_emails, variables)
+
+@metrics.timed("gmail_send_seconds")
+def deliver_raw_message(service, raw_message):
+    return service.users().messages().send(userId="me", body={'raw': raw_message}).execute()
+
+@metrics.timed("gmail_send_seconds")
+def deliver_message_stream(service, stream):
+    media = MediaIoBaseUpload(stream, mimetype="message/rfc822", chunksize=UPLOAD_CHUNK,
+                              resumable=stream.size > SIMPLE_UPLOAD_LIMIT)
+    return service.users().messages().send(userId="me", media_body=media).execute()
+
+def deliver_message(service, from_email, to_emails, subject, body, cc=None, bcc=None, attachments=None, variables=None):
+    """Build and send one message; with attachments it is a media upload streamed from the mapped, pre-encoded files."""
+    if not attachments:
+        return deliver_raw_message(service, build_raw_message(from_email, to_emails, subject, body, cc, bcc, variables))
+    refs = tuple((a["sha256"], a["filename"], a["content_type"]) for a in attachments)
+    with metrics.timer("mime_build_seconds"):
+        stream = compile_message(from_email, subject, body, cc or None, bcc or None, refs).render_stream(to_emails, variables)
+    return deliver_message_stream(service, stream)
+
+def is_personalized(subject, body):
+    """True when the message uses contact placeholders, so each recipient gets a message of their own."""
+    return bool(variable_names(subject, body) - {TOKEN_VARIABLE})
+
+def fetch_contact_attributes(to_set, tenant_id=None):
+    """{address: contact attributes} for a personalized send; tenant_id scopes the unscoped scheduler threads."""
+    client, db = get_db()
+    if db is None:
+        return {}
+    try:
+        if tenant_of(db) is None:
+            db = tenant_db(db, tenant_id or DEFAULT_TENANT)
+        return contacts.attributes(db, to_set)
+    finally:
+        client.close()
+
+def deliver_each(service, from_email, to_set, subject, body, cc, bcc, attachments, user_id, message_id, attributes):
+    """Send each pending recipient of `to_set` a message of their own, filled in from their contact `attributes`.
+
+    Every message has its own tracking token, and Cc/Bcc go out once, with the first message that is sent. Each
+    recipient is marked sent or failed in `to_set`; a throttling error stops the loop and leaves the rest pending.
+    Returns the error that stopped it, else the first one, else None.
+    """
+    sent, failed, error = [], [], None
+    for i, address in enumerate(to_set.to_list(to_set.pending())):
+        variables = {**attributes.get(address, {}), **tracking.variables(user_id, f"{message_id}.{i}")}
+        try:
+            deliver_message(service, from_email, address, subject, body, None if sent else cc, None if sent else bcc,
+                            attachments, variables)
+            sent.append(address)
+        except Exception as e:
+            logger.error(f"Failed to send email ID {message_id} to {address}: {e}")
+            failed.append(address)
+            error = e if is_throttling_error(e) else error or e
+            if is_throttling_error(e):
+                break
+    to_set.mark_addresses(SENT, sent)
+    to_set.mark_addresses(FAILED, failed)
+    return error
+
+def store_uploaded_attachments(uploaded_files):
+    """Content-addressed refs for the compose form's attachments, or None after showing why they were rejected."""
+    refs = []
+    for uploaded in uploaded_files or []:
+        try:
+            refs.append(store_attachment(uploaded, uploaded.name, uploaded.type))
+        except (OSError, ValueError) as e:
+            st.error(f"Could not attach {uploaded.name}: {e}")
+            return None
+    return refs
+
+def lint_campaign(subject, body):
+    """Show what lint finds in the message about to go out; False when an error should stop it."""
+    problems = preview.lint(body, subject, preview_variables()[1])
+    for level, message in problems:
+        (st.error if level == "error" else st.warning)(message)
+    return not any(level == "error" for level, _ in problems)
+
+def send_email(service, from_email, to_emails, subject, body, user_id, cc=None, bcc=None, attachments=None, message_id=None,
+               tenant_id=None):
     if not user_id:
         st.error("Invalid user id")
         return None
     try:
-        message = MIMEMultipart()
-        message["From"] = from_email
-        message["To"] = to_emails
-        message["Subject"] = subject
-        if cc:
-            message["Cc"] = cc
-        if bcc:
-            message["Bcc"] = bcc
-        message.attach(MIMEText(body, "plain"))
-        raw_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
-        send_message = service.users().messages().send(userId="me", body={'raw': raw_message}).execute()
+        # Opens, clicks and bounces are attributed to the scheduled email, or to a fresh id for a direct send
+        message_id = message_id or ObjectId()
+        body = tracking.instrument(body)
+        if is_personalized(subject, body):
+            to_set = recipients.coerce(to_emails)
+            error = deliver_each(service, from_email, to_set, subject, body, cc, bcc, attachments, user_id, message_id,
+                                 fetch_contact_attributes(to_set, tenant_id))
+            sent = int(to_set.status(SENT).sum())
+            if not sent:
+                raise error or ValueError("No recipients to send to")
+            log_email_stats(user_id, to_set.header(to_set.status(SENT)), cc or "", bcc or "", tenant_id, messages=sent)
+            if error is not None:
+                st.warning(f"{int(to_set.status(FAILED).sum())} recipient(s) could not be sent to: {error}")
+            return to_set.counts()
+        send_message = deliver_message(service, from_email, to_emails, subject, body, cc, bcc, attachments,
+                                       tracking.variables(user_id, message_id))
         # Log statistics
-        log_email_stats(user_id, to_emails, cc or "", bcc or "")
+        log_email_stats(user_id, to_emails, cc or "", bcc or "", tenant_id)
         return send_message
     except HttpError as e:
         st.error(f"An error occurred sending the email: {e}")
@@ -107,6 +214,13 @@ def send_email(service, from_email, to_emails, subject, body, user_id, cc=None,
         st.error(f"Unexpected error: {e}")
         return None
 
+def scheduled_body(doc):
+    """Body of a scheduled email; a pinned one stores its template version and only the text added after it."""
+    if doc.get("template_id"):
+        return (get_template_version(doc["template_id"], doc["template_version"], doc.get("tenant_id") or DEFAULT_TENANT)
+                + (doc.get("body") or ""))
+    return doc.get("body")
+
 def send_scheduled_email(email_id):
     client, db = get_db()
     if db is None:
@@ -126,10 +240,14 @@ def send_scheduled_email(email_id):
             return
         from_address = user_details.get("username")
         service = authenticate_gmail_api()
-        result = send_email(service, from_address, doc.get("to_emails"), doc.get("subject"), doc.get("body"), doc.get("user_id"), doc.get("cc"), doc.get("bcc"))
+        result = send_email(service, from_address, doc.get("to_emails"), doc.get("subject"), scheduled_body(doc), doc.get("user_id"), doc.get("cc"), doc.get("bcc"),
+                            doc.get("attachments"), doc["_id"], doc.get("tenant_id") or DEFAULT_TENANT)
+        update = completion_update(doc, bool(result))
+        db.scheduled_emails.update_one({"_id": doc["_id"]}, update)
         if result:
-            db.scheduled_emails.update_one({"_id": doc["_id"]}, {"$set":{"status":"Sent"}})
             logger.info(f"Email ID {email_id} sent successfully.")
+            if update["$set"]["status"] == "Pending":
+                add_scheduler_job(doc["_id"], update["$set"]["next_run_at"])
         else:
             logger.error(f"Failed to send email ID {email_id}.")
     except Exception as e:
@@ -137,35 +255,285 @@ def send_scheduled_email(email_id):
     finally:
         client.close()
 
-def schedule_email_with_apscheduler(user_id, to_emails, subject, body, schedule_time, cc=None, bcc=None):
+def completion_update(doc, sent):
+    """Update for a scheduled email after a send attempt; recurring emails go back to Pending at their next run."""
+    # Never schedule before the run that just fired, even if it fired early
+    next_run = next_run_after(doc, max(now(), doc.get("next_run_at") or now())) if sent else None
+    if next_run:
+        return {"$set": {"status": "Pending", "next_run_at": next_run, "last_run_at": now()}, "$inc": {"run_count": 1}}
+    return {"$set": {"status": "Sent" if sent else "Failed", "last_run_at": now()}}
+
+def backfill_next_run_at(db):
+    """Give scheduled emails from before timezone support (server-local schedule_time only) a UTC next_run_at."""
+    legacy = db.scheduled_emails.find({"status": "Pending", "next_run_at": {"$exists": False}}, {"schedule_time": 1})
+    ops = [UpdateOne({"_id": d["_id"]}, {"$set": {"next_run_at": to_utc(d["schedule_time"])}})
+           for d in legacy if d.get("schedule_time")]
+    if ops:
+        db.scheduled_emails.bulk_write(ops, ordered=False)
+
+def add_scheduler_job(email_id, run_at):
+    # The batch scheduler reads due work straight from scheduled_emails
+    if SCHEDULER_BACKEND != "apscheduler":
+        return
+    trigger = DateTrigger(run_date=run_at.replace(tzinfo=dt_timezone.utc))
+    scheduler.add_job(send_scheduled_email, trigger, args=[str(email_id)], id=f"email_{email_id}",
+                      misfire_grace_time=3600, replace_existing=True)
+
+def load_scheduler_jobs():
+    """Register a DateTrigger for every Pending email; APScheduler keeps its jobs in memory, so a restart loses them.
+
+    Emails that came due while the process was down run at once instead of being dropped as misfires.
+    """
+    client, db = get_db(unscoped=True)  # runs once at startup, for the emails of every tenant
+    if db is None:
+        return 0
+    try:
+        backfill_next_run_at(db)
+        loaded = 0
+        for doc in db.scheduled_emails.find({"status": "Pending", "next_run_at": {"$ne": None}}, {"next_run_at": 1}):
+            add_scheduler_job(doc["_id"], max(doc["next_run_at"], now()))
+            loaded += 1
+        if loaded:
+            logger.info(f"Registered {loaded} pending scheduled email(s) with APScheduler.")
+        return loaded
+    except PyMongoError as e:
+        logger.error(f"Could not load pending scheduled emails: {e}")
+        return 0
+    finally:
+        client.close()
+
+def remove_scheduler_jobs(email_ids):
+    for email_id in email_ids:
+        try:
+            scheduler.remove_job(f"email_{email_id}")
+        except JobLookupError:
+            pass
+
+def fetch_recipient_timezones(db, addresses):
+    return contacts.timezones(db, addresses)
+
+def schedule_email_with_apscheduler(user_id, to_emails, subject, body, schedule_time, cc=None, bcc=None,
+                                    timezone=None, recurrence=None, localize=False, throttle=None, attachments=None, template=None):
     client, db = get_db()
     if db is None:
         st.error("DB connection failed")
         return
     try:
-        cc_str = ",".join(cc) if isinstance(cc, list) else (cc or "")
-        bcc_str = ",".join(bcc) if isinstance(bcc, list) else (bcc or "")
-        doc = {
-            "user_id": user_id,
-            "to_emails": to_emails,
-            "subject": subject,
-            "body": body,
-            "cc": cc_str,
-            "bcc": bcc_str,
-            "schedule_time": schedule_time,
-            "status": "Pending",
-            "created_at": now()
-        }
-        res = db.scheduled_emails.insert_one(doc)
-        email_id = str(res.inserted_id)
-        trigger = DateTrigger(run_date=schedule_time)
-        scheduler.add_job(send_scheduled_email, trigger, args=[email_id], id=f"email_{email_id}", misfire_grace_time=3600)
-        st.success("Email scheduled successfully!")
+        content = {"body": body}
+        if template and body.startswith(template["content"]):
+            # Pin the template version instead of copying its content into every scheduled email
+            content = {"template_id": template["template_id"], "template_version": template["template_version"],
+                       "body": body[len(template["content"]):]}
+        cc_str = recipients.header(cc)
+        bcc_str = recipients.header(bcc)
+        tz_name = timezone or DEFAULT_TIMEZONE
+        to_set = recipients.coerce(to_emails)
+        groups = {tz_name: to_set}
+        if localize:
+            # One scheduled email per recipient timezone, each firing at schedule_time on that zone's clock
+            groups = {tz: RecipientSet.from_list(group) for tz, group in
+                      group_by_timezone(to_set, fetch_recipient_timezones(db, to_set), tz_name).items()}
+        campaign_id = ObjectId()
+        docs = []
+        for group_tz, group in sorted(groups.items(), key=lambda g: g[0] != tz_name):
+            run_at = first_run_at(schedule_time, group_tz, recurrence)
+            if run_at is None:
+                st.error("The repeat rule never fires.")
+                return
+            rate, chunks = None, [(run_at, group)]
+            if throttle:
+                # Throttled campaigns become one scheduled email per chunk (a zero-copy slice), metered out over the window
+                rate, chunks = plan_chunks(group, run_at, throttle.get("window_minutes"), throttle.get("rate_per_minute"))
+            for chunk_run_at, chunk in chunks:
+                docs.append({
+                    "user_id": user_id,
+                    "campaign_id": campaign_id,
+                    "to_emails": chunk.header(),
+                    "subject": subject,
+                    **content,
+                    # Cc/Bcc go out once, with the first chunk of the sender's own timezone group
+                    "cc": cc_str if not docs else "",
+                    "bcc": bcc_str if not docs else "",
+                    "attachments": attachments or [],
+                    "schedule_time": schedule_time,
+                    "timezone": group_tz,
+                    "recurrence": recurrence,
+                    "throttle": {"rate_per_minute": rate} if rate else None,
+                    "first_run_at": chunk_run_at,
+                    "next_run_at": chunk_run_at,
+                    "status": "Pending",
+                    "created_at": now()
+                })
+        res = db.scheduled_emails.insert_many(docs)
+        _status_counts.clear()
+        for email_id, doc in zip(res.inserted_ids, docs):
+            add_scheduler_job(email_id, doc["next_run_at"])
+        if len(docs) > 1:
+            st.success(f"Email scheduled successfully as {len(docs)} sends (campaign {campaign_id})!")
+        else:
+            st.success("Email scheduled successfully!")
     except Exception as e:
         st.error(f"Error scheduling email: {e}")
     finally:
         client.close()
 
+def build_scheduled_email_filter(user_id=None, status=None, start=None, end=None):
+    query = {}
+    if user_id:
+        query["user_id"] = user_id
+    if status and status != "All":
+        query["status"] = status
+    if start or end:
+        query["schedule_time"] = {}
+        if start:
+            query["schedule_time"]["$gte"] = start
+        if end:
+            query["schedule_time"]["$lt"] = end
+    return query
+
+def fetch_scheduled_email_page(db, query, page_size, after=None):
+    """Keyset page of scheduled emails, newest first. `after` is the (schedule_time, _id) of the last row already shown."""
+    if after:
+        last_time, last_id = after
+        query = {"$and": [query, {"$or": [
+            {"schedule_time": {"$lt": last_time}},
+            {"schedule_time": last_time, "_id": {"$lt": last_id}},
+        ]}]}
+    rows = list(
+        db.scheduled_emails.find(query, REPORT_PROJECTION)
+        .sort([("schedule_time", -1), ("_id", -1)])
+        .limit(page_size + 1)
+    )
+    next_after = (rows[page_size - 1].get("schedule_time"), rows[page_size - 1]["_id"]) if len(rows) > page_size else None
+    return rows[:page_size], next_after
+
+def fetch_scheduled_status_counts(db, query):
+    pipeline = [{"$match": query}, {"$group": {"_id": "$status", "count": {"$sum": 1}}}]
+    return {r["_id"] or "Unknown": r["count"] for r in db.scheduled_emails.aggregate(pipeline)}
+
+# Status counts per tenant and filter; the $group reads the whole filtered window, so reruns share one result
+_status_counts = invalidation.CollectionCache("scheduled_emails", ttl=STATUS_COUNTS_TTL, max_entries=256)
+
+def cached_status_counts(db, query):
+    return _status_counts.get(repr(query), lambda: fetch_scheduled_status_counts(db, query))
+
+PAGE_FIELDS = {"campaign_id": 1, "next_run_at": 1, "schedule_time": 1, "timezone": 1}
+
+def _bulk_update_scheduled(db, query, required_status, update, on_page=None):
+    """Apply `update` to emails matching `query` that are still in `required_status`; returns the number modified.
+
+    Emails are paged by _id, BULK_CHUNK_SIZE at a time, so a large match is never held in memory. `update` is an
+    update document, or a function giving each page document (the _id and PAGE_FIELDS) its own; `on_page` sees
+    every page once it is written, to keep the in-process scheduler in sync.
+    """
+    modified, last_id = 0, None
+    while True:
+        conditions = [query, {"status": required_status}]
+        if last_id is not None:
+            conditions.append({"_id": {"$gt": last_id}})
+        page = list(db.scheduled_emails.find({"$and": conditions}, PAGE_FIELDS)
+                    .sort("_id", 1).limit(BULK_CHUNK_SIZE))
+        if not page:
+            return modified
+        if callable(update):
+            ops = [UpdateOne({"_id": d["_id"], "status": required_status}, update(d)) for d in page]
+        else:
+            ops = [UpdateMany({"_id": {"$in": [d["_id"] for d in page]}, "status": required_status}, update)]
+        modified += db.scheduled_emails.bulk_write(ops, ordered=False).modified_count
+        if on_page:
+            on_page(page)
+        last_id = page[-1]["_id"]
+
+def _campaign_starts(db, query, status):
+    """Earliest next_run_at of each campaign among the emails matching `query` in `status`, and whether its
+    emails were split by recipient timezone."""
+    pipeline = [
+        {"$match": {"$and": [query, {"status": status}, {"campaign_id": {"$ne": None}}]}},
+        {"$group": {"_id": "$campaign_id", "start": {"$min": "$next_run_at"}, "timezones": {"$addToSet": "$timezone"}}},
+    ]
+    return {r["_id"]: (r["start"], len(r["timezones"]) > 1) for r in db.scheduled_emails.aggregate(pipeline)}
+
+def _moved_schedule(campaigns, schedule_time, tz_name):
+    """Schedule fields that move each email to `schedule_time` plus its offset from the first email of its campaign.
+
+    Throttled chunks and timezone groups keep their spacing instead of all firing together. Emails of a campaign
+    split by recipient timezone keep their own timezone, with their wall-clock time moved by as much.
+    """
+    run_at = to_utc(schedule_time, tz_name)
+
+    def move(doc):
+        start, grouped = campaigns.get(doc.get("campaign_id"), (None, False))
+        if start is None or doc.get("next_run_at") is None:
+            return {"schedule_time": schedule_time, "timezone": tz_name, "next_run_at": run_at}
+        shift = run_at - start
+        if grouped and doc.get("schedule_time") and doc.get("timezone"):
+            # Derived from the shifted instant, so a daylight-saving change in between is accounted for
+            moved = to_utc(doc["schedule_time"], doc["timezone"]) + shift
+            return {"schedule_time": from_utc(moved, doc["timezone"]).replace(tzinfo=None),
+                    "next_run_at": doc["next_run_at"] + shift}
+        return {"schedule_time": schedule_time, "timezone": tz_name, "next_run_at": doc["next_run_at"] + shift}
+    return move
+
+def cancel_scheduled_emails(db, query):
+    count = _bulk_update_scheduled(db, query, "Pending", {"$set": {"status": "Cancelled", "cancelled_at": now()}},
+                                   on_page=lambda page: remove_scheduler_jobs(d["_id"] for d in page))
+    audit.record("scheduled_email.cancel", "scheduled_email", filter=str(query), count=count)
+    return {"status": "success", "message": f"Cancelled {count} scheduled email(s).", "count": count}
+
+def _move_scheduled(db, query, required_status, schedule_time, tz_name, fields=None):
+    move = _moved_schedule(_campaign_starts(db, query, required_status), schedule_time, tz_name)
+
+    def update(doc):
+        return {"$set": {**(fields or {}), **move(doc)}}
+
+    def register(page):
+        for doc in page:
+            add_scheduler_job(doc["_id"], move(doc)["next_run_at"])
+
+    return _bulk_update_scheduled(db, query, required_status, update, on_page=register)
+
+def reschedule_scheduled_emails(db, query, schedule_time, tz_name=None):
+    tz_name = tz_name or DEFAULT_TIMEZONE
+    count = _move_scheduled(db, query, "Pending", schedule_time, tz_name)
+    audit.record("scheduled_email.reschedule", "scheduled_email", filter=str(query), count=count,
+                 schedule_time=schedule_time, timezone=tz_name)
+    return {"status": "success", "message": f"Rescheduled {count} email(s) to {schedule_time} {tz_name}.", "count": count}
+
+def retry_scheduled_emails(db, query, schedule_time, tz_name=None):
+    tz_name = tz_name or DEFAULT_TIMEZONE
+    count = _move_scheduled(db, query, "Failed", schedule_time, tz_name, fields={"status": "Pending"})
+    audit.record("scheduled_email.retry", "scheduled_email", filter=str(query), count=count,
+                 schedule_time=schedule_time, timezone=tz_name)
+    return {"status": "success", "message": f"Queued {count} failed email(s) for retry at {schedule_time} {tz_name}.", "count": count}
+
+def bulk_actions_section(db, query):
+    st.subheader("Bulk Actions")
+    st.markdown("Applies to every scheduled email matching the filters above.")
+    action = st.selectbox("Action", ["Cancel pending", "Reschedule pending", "Retry failed"])
+    schedule_time, tz_name = None, DEFAULT_TIMEZONE
+    if action != "Cancel pending":
+        new_date = st.date_input("New Date", key="bulk_date")
+        new_time = st.time_input("New Time", key="bulk_time")
+        tz_options = timezone_names()
+        tz_name = st.selectbox("Timezone", tz_options, index=tz_options.index(DEFAULT_TIMEZONE), key="bulk_tz")
+        schedule_time = datetime.combine(new_date, new_time)
+    if st.button("Apply to matching emails"):
+        if schedule_time and to_utc(schedule_time, tz_name) <= now():
+            st.error("Schedule date and time must be in the future.")
+            return
+        try:
+            if action == "Cancel pending":
+                response = cancel_scheduled_emails(db, query)
+            elif action == "Reschedule pending":
+                response = reschedule_scheduled_emails(db, query, schedule_time, tz_name)
+            else:
+                response = retry_scheduled_emails(db, query, schedule_time, tz_name)
+            _status_counts.clear()
+            st.success(response['message'])
+        except Exception as e:
+            st.error(f"Bulk action failed: {e}")
+
+@profiler.page("scheduled")
 def generate_scheduled_email_reports():
     schcss = """
         <style>
@@ -219,14 +587,32 @@ def generate_scheduled_email_reports():
     st.title("Scheduled Email Reports")
     st.markdown("Manage your scheduled emails below.")
     
+    # Filters map onto the scheduled_emails indexes in db.INDEXES
+    f1, f2, f3 = st.columns(3)
+    user_filter = f1.text_input("Filter by User ID").strip()
+    status_filter = f2.selectbox("Status", ["All"] + SCHEDULED_STATUSES)
+    today = datetime.now().date()
+    date_range = f3.date_input("Schedule window", value=(today - timedelta(days=30), today + timedelta(days=90)))
+    page_size = st.selectbox("Rows per page", REPORT_PAGE_SIZES)
+
+    start = datetime.combine(date_range[0], datetime.min.time()) if len(date_range) > 0 else None
+    end = datetime.combine(date_range[1], datetime.min.time()) + timedelta(days=1) if len(date_range) > 1 else None
+    query = build_scheduled_email_filter(user_filter, status_filter, start, end)
+
+    # Reset paging whenever the filters change
+    filter_key = (user_filter, status_filter, start, end, page_size)
+    if st.session_state.get('report_filter_key') != filter_key:
+        st.session_state['report_filter_key'] = filter_key
+        st.session_state['report_cursors'] = [None]
+    cursors = st.session_state['report_cursors']
+
     client, db = get_db()
     if db is None:
         st.error("Database connection failed.")
         return
 
     try:
-        emails = list(db.scheduled_emails.find({}, {"_id": 1, "user_id": 1, "to_emails": 1, "subject": 1,
-                                                    "schedule_time": 1, "status": 1, "created_at": 1}))
+        emails, next_after = fetch_scheduled_email_page(db, query, page_size, cursors[-1])
         if emails:
             df = pd.DataFrame([
                 {
@@ -235,18 +621,33 @@ def generate_scheduled_email_reports():
                     "To": e.get("to_emails", ""),
                     "Subject": e.get("subject", ""),
                     "Schedule Time": e.get("schedule_time", ""),
+                    "Timezone": e.get("timezone", ""),
+                    "Repeats": describe_recurrence(e.get("recurrence")),
+                    "Next Run (UTC)": e.get("next_run_at", ""),
                     "Status": e.get("status", ""),
                     "Created At": e.get("created_at", "")
                 }
                 for e in emails
             ])
             st.dataframe(df)
-            # Bar chart by status
-            if "Status" in df.columns:
-                st.bar_chart(df.groupby("Status")["ID"].count())
+            st.caption(f"Page {len(cursors)}")
+            prev_col, next_col = st.columns(2)
+            if len(cursors) > 1 and prev_col.button("Previous page"):
+                cursors.pop()
+                st.rerun()
+            if next_after and next_col.button("Next page"):
+                cursors.append(next_after)
+                st.rerun()
+
+            # Bar chart by status, grouped server-side over the whole filter
+            counts = cached_status_counts(db, query)
+            if counts:
+                st.bar_chart(pd.DataFrame({"Count": counts}))
         else:
             st.warning("No scheduled emails found.")
 
+        bulk_actions_section(db, query)
+
         # Delete scheduled email
         st.subheader("Delete Scheduled Email by ID")
         email_id_to_delete = st.text_input("Enter the Email ID to delete")
@@ -257,7 +658,10 @@ def generate_scheduled_email_reports():
                 try:
                     oid = to_object_id(email_id_to_delete)
                     res = db.scheduled_emails.delete_one({"_id": oid})
+                    remove_scheduler_jobs([oid])
                     if res.deleted_count:
+                        _status_counts.clear()
+                        audit.record("scheduled_email.delete", "scheduled_email", oid)
                         st.success(f"Email with ID {email_id_to_delete} deleted successfully.")
                     else:
                         st.warning(f"No email found with ID {email_id_to_delete}.")
@@ -272,6 +676,7 @@ def generate_scheduled_email_reports():
 
 
 #Function to display email dashboard
+@profiler.page("compose")
 def email_dashboard():
     sendcss = """
         <style>
@@ -342,14 +747,14 @@ def email_dashboard():
     # Always display Compose Email Form
     st.subheader("Compose Email")
 
-    # Input for User ID
-    user_id = st.text_input("Enter User ID to fetch details", key="userid")
+    # Sender, found by username
+    sender = search.user_picker("Sender", key="userid")
     user_details = st.session_state.get('user_details')
 
     # Fetch and display user details when button is clicked
     if st.button("Fetch User Details"):
-        if user_id:
-            user_details = fetch_user_details(user_id)
+        if sender:
+            user_details = fetch_user_details(sender["user_id"])
             if user_details:
                 if user_details.get('is_enabled') == 0:
                     st.warning("This user is not enabled for sending emails.")
@@ -362,7 +767,7 @@ def email_dashboard():
             else:
                 st.error("User not found.")
         else:
-            st.warning("Please enter a valid User ID.")
+            st.warning("Choose a sender first.")
 
     # Ensure user details are available in session state
     user_details = st.session_state['user_details']
@@ -382,38 +787,34 @@ def email_dashboard():
         st.markdown("### CC Address")
 
         cc_uploaded_file = st.file_uploader("Choose a CSV file for CC", type=["csv"], key="cc_upload")
-        cc_addresses = []
+        cc_addresses = RecipientSet.from_list([])
         if cc_uploaded_file:
             try:
-                cc_df = pd.read_csv(cc_uploaded_file)
-                if 'username' in cc_df.columns:
-                    cc_addresses = cc_df['username'].tolist()
-                    st.write("CC Addresses:")
-                    st.dataframe(cc_df)
-                else:
-                    st.error("The CSV file must contain an 'username' column.")
+                cc_addresses = RecipientSet.from_csv(cc_uploaded_file)
+                st.write(f"CC Addresses: {len(cc_addresses)}")
+                st.dataframe(cc_addresses.preview())
+            except ValueError as e:
+                st.error(str(e))
             except Exception as e:
                 st.error(f"Error reading CC CSV file: {e}")
         else:
-            cc_addresses = st.text_input("Cc")
+            cc_addresses = RecipientSet.from_text(st.text_input("Cc"))
 
         # BCC Address Upload
         st.markdown("### BCC Address")
         bcc_uploaded_file = st.file_uploader("Choose a CSV file for BCC", type=["csv"], key="bcc_upload")
-        bcc_addresses = []
+        bcc_addresses = RecipientSet.from_list([])
         if bcc_uploaded_file:
             try:
-                bcc_df = pd.read_csv(bcc_uploaded_file)
-                if 'username' in bcc_df.columns:
-                    bcc_addresses = bcc_df['username'].tolist()
-                    st.write("BCC Addresses:")
-                    st.dataframe(bcc_df)
-                else:
-                    st.error("The CSV file must contain an 'username' column.")
+                bcc_addresses = RecipientSet.from_csv(bcc_uploaded_file)
+                st.write(f"BCC Addresses: {len(bcc_addresses)}")
+                st.dataframe(bcc_addresses.preview())
+            except ValueError as e:
+                st.error(str(e))
             except Exception as e:
                 st.error(f"Error reading BCC CSV file: {e}")
         else:
-            bcc_addresses = st.text_input("Bcc")
+            bcc_addresses = RecipientSet.from_text(st.text_input("Bcc"))
         
          #Manual Inputs for Subject, Body, and Signature
         subject = st.text_input(
@@ -421,73 +822,100 @@ def email_dashboard():
             value=st.session_state.get('selected_subject', '')  # Pre-load if a template is selected
         )
 
-        # Template dropdown (Mongo)
-        client, db = get_db()
+        # Template dropdown; available_templates() serves it from the template cache
         body = ""
-        if db is not None:
-
-            try:
-                templates = list(
-                    db.templates.find(
-                        {"$or": [{"user_id": user_id}, {"superuser": True}]},
-                        {"template_name": 1, "template_content": 1, "_id": 0},
-                    )
-                )
-                if templates:
-                    template_dict = {t["template_name"]: t["template_content"] for t in templates}
-                    selected_template = st.selectbox("Choose Template", ["Select"] + list(template_dict.keys()))
-                    if selected_template != "Select":
-                        content = template_dict[selected_template]
-                        st.markdown(content, unsafe_allow_html=True)
-                        body = st.text_area("Body", value=content)
-                    else:
-                        body = st.text_area("Body", placeholder="Enter your email content here.")
+        pinned_template = None
+        try:
+            templates = available_templates(user_id)
+            if templates:
+                template_dict = {t["template_name"]: t for t in templates}
+                selected_template = st.selectbox("Choose Template", ["Select"] + list(template_dict.keys()))
+                if selected_template != "Select":
+                    # Content is loaded only for the chosen template, from the version cache when versioned
+                    content = load_template_content(template_dict[selected_template])
+                    if template_dict[selected_template].get("version"):
+                        pinned_template = {"template_id": template_dict[selected_template]["_id"],
+                                           "template_version": template_dict[selected_template]["version"],
+                                           "content": content}
+                    with st.expander("Preview", expanded=True), metrics.timer("template_render_seconds", page="compose"):
+                        st.markdown(preview.render_preview(content, preview_variables()[0]), unsafe_allow_html=True)
+                    body = st.text_area("Body", value=content)
                 else:
-                    st.warning("No templates found.")
                     body = st.text_area("Body", placeholder="Enter your email content here.")
-            except Exception as e:
-                st.error(f"Error loading templates: {e}")
-            finally:
-                client.close()
-        else:
-            st.error("Failed to connect to the database.")
-            body = st.text_area("Body", placeholder="Enter your email content here.")
+            else:
+                st.warning("No templates found.")
+                body = st.text_area("Body", placeholder="Enter your email content here.")
+        except Exception as e:
+            st.error(f"Error loading templates: {e}")
     
         signature = st.text_area(
             "Signature", 
             value=st.session_state.get('selected_signature', '') if 'selected_signature' in st.session_state else ''
         )
+
+        attachment_files = st.file_uploader("Attachments", accept_multiple_files=True, key="attachments")
         
 
         # Send Email Button
         if st.button("Send Email"):
-            if to_addresses:
-                full_body = body + f"\n\n{signature}" if signature else body
-                try:
-                    service = authenticate_gmail_api()
-                    send_email(service, from_address, to_addresses, subject, full_body, user_id, ",".join(cc_addresses), ",".join(bcc_addresses))
-                    st.success("Email sent successfully!")
-                except Exception as e:
-                    st.error(f"Failed to send email: {e}")
-            else:
+            full_body = body + f"\n\n{signature}" if signature else body
+            if not to_addresses:
                 st.warning("Please upload a CSV file with valid To contacts.")
+            elif lint_campaign(subject, full_body):
+                attachment_refs = store_uploaded_attachments(attachment_files)
+                if attachment_refs is not None and SCHEDULER_BACKEND == "worker":
+                    # Due now: the next worker poll sends it
+                    schedule_email_with_apscheduler(user_id, to_addresses, subject, full_body, now(), cc_addresses, bcc_addresses,
+                                                    "UTC", attachments=attachment_refs, template=pinned_template)
+                elif attachment_refs is not None:
+                    try:
+                        service = authenticate_gmail_api()
+                        send_email(service, from_address, to_addresses, subject, full_body, user_id, cc_addresses.header(), bcc_addresses.header(),
+                                   attachment_refs)
+                        st.success("Email sent successfully!")
+                    except Exception as e:
+                        st.error(f"Failed to send email: {e}")
 
 
         schedule_date = st.date_input("Schedule Date")
         schedule_time = st.time_input("Schedule Time")  # Default time is the current time
+        tz_options = timezone_names()
+        schedule_tz = st.selectbox("Timezone", tz_options, index=tz_options.index(DEFAULT_TIMEZONE))
+        repeat = st.selectbox("Repeat", RECURRENCE_OPTIONS)
+        repeat_minutes = st.number_input("Repeat every (minutes)", min_value=5, value=60) if repeat == "Every N minutes" else None
+        repeat_cron = st.text_input("Cron expression (min hour day month weekday)") if repeat == "Custom cron" else None
+        localize = st.checkbox("Send at this time in each recipient's own timezone")
+        throttle = None
+        if st.checkbox("Spread delivery over a time window"):
+            window_col, rate_col = st.columns(2)
+            window_minutes = window_col.number_input("Window (minutes)", min_value=1, value=60)
+            rate_per_minute = rate_col.number_input("Target recipients per minute (0 = fit the window)", min_value=0, value=0)
+            throttle = {"window_minutes": int(window_minutes), "rate_per_minute": int(rate_per_minute) or None}
 
         # Combine Date and Time
         schedule_datetime = datetime.combine(schedule_date, schedule_time)
 
         # Scheduling Section
-        if schedule_datetime <= datetime.now():
+        if to_utc(schedule_datetime, schedule_tz) <= now():
             st.error("Schedule date and time must be in the future.")
         else:
             if st.button("Schedule Email"):
                 from_address = user_details['username'] 
                 if to_addresses:
-                    full_body = body + f"\n\n{signature}" if signature else body
-                    schedule_email_with_apscheduler(user_id, to_addresses, subject, full_body, schedule_datetime, cc_addresses, bcc_addresses)
+                    try:
+                        recurrence = build_recurrence(repeat, schedule_datetime, repeat_minutes, repeat_cron)
+                    except ValueError as e:
+                        st.error(f"Invalid repeat rule: {e}")
+                    else:
+                        if recurrence and throttle:
+                            st.error("Spread delivery cannot be combined with a repeat rule.")
+                        else:
+                            full_body = body + f"\n\n{signature}" if signature else body
+                            attachment_refs = store_uploaded_attachments(attachment_files) if lint_campaign(subject, full_body) else None
+                            if attachment_refs is not None:
+                                schedule_email_with_apscheduler(user_id, to_addresses, subject, full_body, schedule_datetime, cc_addresses,
+                                                                bcc_addresses, schedule_tz, recurrence, localize, throttle, attachment_refs,
+                                                                pinned_template)
                 else:
                     st.warning("Please add recipients.")
 
@@ -518,10 +946,9 @@ def app():
 
         run()
 
-
-
-
-
-
-
-    
\ No newline at end of file
+if SCHEDULER_BACKEND == "apscheduler":
+    load_scheduler_jobs()
+elif SCHEDULER_BACKEND == "batch":
+    from batchscheduler import BatchScheduler
+    batch_scheduler = BatchScheduler()
+    batch_scheduler.start()
@@ -0,0 +1,119 @@
+# session.py
+import os
+import threading
+import time
+import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from db import DEFAULT_TENANT, current_tenant, get_db, set_tenant_resolver
+import invalidation
+import search
+
+# Seconds a cached principal is trusted before it is re-read; edits made in this process invalidate at once
+SESSION_TTL = int(os.getenv("MASSMAIL_SESSION_TTL", "900"))
+MAX_PRINCIPALS = 10000
+
+_lock = threading.Lock()
+_principals = {}  # (tenant looked up in, user id or username) -> (principal, expires_at)
+
+
+def principal_from_doc(user):
+    """The compact form pages need: identity, permissions and sender settings, never the password hash."""
+    permissions = []
+    if user.get("is_enabled", False):
+        permissions.append("send")
+    if user.get("is_superuser", False):
+        permissions.append("admin")
+    return {
+        "user_id": str(user.get("_id")),
+        "username": user.get("username"),
+        "tenant_id": user.get("tenant_id") or DEFAULT_TENANT,
+        "is_enabled": bool(user.get("is_enabled", False)),
+        "is_superuser": bool(user.get("is_superuser", False)),
+        "permissions": permissions,
+        "from_address": user.get("username"),
+        "timezone": user.get("timezone"),
+    }
+
+def _store(principal, tenant_id, *keys):
+    expires_at = time.monotonic() + SESSION_TTL
+    with _lock:
+        for key in {principal["user_id"], principal["username"], *keys}:
+            _principals.pop((tenant_id, key), None)
+            _principals[(tenant_id, key)] = (principal, expires_at)
+        while len(_principals) > MAX_PRINCIPALS:
+            del _principals[next(iter(_principals))]
+
+def get_principal(user_ref):
+    """Principal for an ObjectId string or a username (any case), from the cache or one indexed query; None if unknown."""
+    if not user_ref:
+        return None
+    invalidation.start()
+    key = str(user_ref)
+    tenant_id = current_tenant()  # a page only ever finds users of its own tenant
+    with _lock:
+        cached = _principals.get((tenant_id, key))
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+    client, db = get_db()
+    if db is None:
+        return None
+    try:
+        query = search.user_query(key)
+        if "username_lc" in query:
+            search.backfill_username_keys(db)
+        user = db.users.find_one(query, {"password": 0})
+    finally:
+        client.close()
+    if user is None:
+        invalidate(key)
+        return None
+    principal = principal_from_doc(user)
+    _store(principal, tenant_id, key)
+    return principal
+
+def invalidate(user_ref):
+    """Drop every cached entry for a user, or every principal when user_ref is None."""
+    if user_ref is None:
+        with _lock:
+            _principals.clear()
+        return
+    key = str(user_ref)
+    with _lock:
+        stale = {key}
+        for principal, _ in _principals.values():
+            if key in (principal["user_id"], principal["username"]):
+                stale.update((principal["user_id"], principal["username"]))
+        for k, (principal, _) in list(_principals.items()):
+            if k[1] in stale or principal["user_id"] in stale:
+                _principals.pop(k, None)
+
+# Writes to users on any replica reach this cache through invalidation.publish or the change stream
+invalidation.subscribe("users", invalidate)
+
+def sign_in(user):
+    """Remember the admin who just logged in; only the user and tenant ids live in st.session_state."""
+    principal = principal_from_doc(user)
+    _store(principal, principal["tenant_id"])
+    st.session_state["principal_id"] = principal["user_id"]
+    st.session_state["tenant_id"] = principal["tenant_id"]
+    st.session_state.is_logged_in = True
+    return principal
+
+def sign_out():
+    st.session_state.pop("principal_id", None)
+    st.session_state.pop("tenant_id", None)
+    st.session_state.is_logged_in = False
+
+def current_admin():
+    """Principal of the signed-in admin, or None once the account is gone or no longer an admin."""
+    principal = get_principal(st.session_state.get("principal_id"))
+    return principal if principal and principal["is_superuser"] else None
+
+def _session_tenant():
+    """Tenant of the admin signed in to this page run; None outside one (scheduler threads, workers, CLIs)."""
+    if get_script_run_ctx() is None:
+        return None
+    return st.session_state.get("tenant_id")
+
+# Every get_db() in a signed-in page run is scoped to the admin's tenant
+set_tenant_resolver(_session_tenant)
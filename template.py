@@ -1,25 +1,37 @@
+import difflib
+from functools import lru_cache
 import streamlit as st
 import pandas as pd
-from db import get_db, to_object_id, now
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+from db import current_tenant, get_db, now, tenant_db, tenant_of, to_object_id
+import audit
+import contacts
+import invalidation
+import metrics
+import preview
+import profiler
+import search
+import session
 
+VERSION_CACHE_SIZE = 256
+HEAD_FIELDS = {"template_name": 1, "summary": 1, "version": 1, "user_id": 1, "superuser": 1}
 
+# Template lists (no content), dropped whenever any replica writes to templates
+_heads = invalidation.CollectionCache("templates")
+# Sample contact and attribute names for previews and lint; attribute types are recorded with every contacts write
+_samples = invalidation.CollectionCache("contacts")
 
-def check_user_and_store(user_id):
-    client, db = get_db()
-    if db is  None:
 
-        return False
+def check_user_and_store(user_id):
+    if not user_id:
+        st.session_state['user_id'] = "superuser"
+        st.success("Using default 'superuser' account.")
+        return True
     try:
-        if not user_id:
-            st.session_state['user_id'] = "superuser"
-            st.success("Using default 'superuser' account.")
-            return True
-        # try find by _id or by id/username
-        oid = to_object_id(user_id)
-        query = {"$or":[{"_id": oid}] } if oid else {"$or":[{"username": user_id},{"id":user_id}]}
-        user = db.users.find_one(query) if query else None
-        if user and user.get("is_enabled", False):
-            st.session_state['user_id'] = str(user.get("_id"))
+        user = session.get_principal(user_id)
+        if user and user["is_enabled"]:
+            st.session_state['user_id'] = user["user_id"]
             st.success(f"User {st.session_state['user_id']} is enabled.")
             return True
         else:
@@ -28,12 +40,14 @@ def check_user_and_store(user_id):
     except Exception as e:
         st.error(f"Database error: {e}")
         return False
-    finally:
-        client.close()
+
+def _version_doc(template, version, content, author):
+    return {"template_id": template["_id"], "user_id": template["user_id"], "template_name": template["template_name"],
+            "version": version, "content": content, "author": author, "created_at": now()}
 
 def create_template(user_id, template_name, template_content):
     client, db = get_db()
-    if db is  None:
+    if db is None:
         return False
     try:
         if not user_id:
@@ -43,8 +57,12 @@ def create_template(user_id, template_name, template_content):
         if existing:
             st.warning("Template name already exists for this user.")
             return False
-        doc = {"user_id": user_id, "template_name": template_name, "template_content": template_content, "superuser": user_id=="superuser", "created_at": now()}
-        db.templates.insert_one(doc)
+        doc = {"user_id": user_id, "template_name": template_name, "template_content": template_content,
+               "summary": preview.summarize(template_content), "version": 1, "superuser": user_id=="superuser", "created_at": now()}
+        doc["_id"] = db.templates.insert_one(doc).inserted_id
+        db.template_versions.insert_one(_version_doc(doc, 1, template_content, user_id))
+        invalidation.publish(db, "templates", doc["_id"])
+        audit.record("template.create", "template", doc["_id"], template_name, owner=user_id)
         st.success(f"Template '{template_name}' created.")
         return True
     except Exception as e:
@@ -53,26 +71,51 @@ def create_template(user_id, template_name, template_content):
     finally:
         client.close()
 
-def update_template(template_name, new_template_content):
+def update_template(user_id, template_name, new_template_content):
+    """Add a new version of this user's template; earlier versions stay as they were."""
     client, db = get_db()
-    if db is  None:
+    if db is None:
         return False
     try:
-        db.templates.update_many({"template_name": template_name}, {"$set":{"template_content": new_template_content}})
-        st.success("Template updated successfully!")
+        template = db.templates.find_one({"user_id": user_id, "template_name": template_name})
+        if template is None:
+            st.warning("Template not found for this user.")
+            return False
+        if "version" not in template:
+            # Created before versioning: its current content becomes version 1
+            db.template_versions.update_one(
+                {"template_id": template["_id"], "version": 1},
+                {"$setOnInsert": _version_doc(template, 1, template.get("template_content"), template["user_id"])},
+                upsert=True)
+        version = template.get("version", 1) + 1
+        # The unique (template_id, version) index turns a concurrent edit into a DuplicateKeyError
+        db.template_versions.insert_one(_version_doc(template, version, new_template_content, user_id))
+        db.templates.update_one({"_id": template["_id"]},
+                                {"$set": {"template_content": new_template_content, "summary": preview.summarize(new_template_content),
+                                          "version": version, "updated_at": now()}})
+        invalidation.publish(db, "templates", template["_id"])
+        audit.record("template.update", "template", template["_id"], template_name, owner=user_id, version=version)
+        st.success(f"Template updated successfully (version {version})!")
         return True
+    except DuplicateKeyError:
+        st.warning("The template was changed meanwhile; reload and try again.")
+        return False
     except Exception as e:
         st.error(f"Database error: {e}")
         return False
     finally:
         client.close()
 
-def delete_template(template_name):
+def delete_template(user_id, template_name):
+    """Remove this user's template; its versions are kept for scheduled emails that still use them."""
     client, db = get_db()
-    if db is  None:
+    if db is None:
         return False
     try:
-        db.templates.delete_many({"template_name": template_name})
+        deleted = db.templates.find_one_and_delete({"user_id": user_id, "template_name": template_name}, {"_id": 1})
+        if deleted:
+            invalidation.publish(db, "templates", deleted["_id"])
+            audit.record("template.delete", "template", deleted["_id"], template_name, owner=user_id)
         st.success("Template deleted successfully.")
         return True
     except Exception as e:
@@ -81,33 +124,113 @@ def delete_template(template_name):
     finally:
         client.close()
 
-def get_templates(user_id):
+def get_template_version(template_id, version, tenant_id=None):
+    """Content of one template version; versions never change, so they are cached for the life of the process.
+
+    tenant_id defaults to the page run's tenant; workers pass the scheduled email's.
+    """
+    return _template_version(tenant_id or current_tenant(), str(template_id), int(version))
+
+@lru_cache(maxsize=VERSION_CACHE_SIZE)
+def _template_version(tenant_id, template_id, version):
     client, db = get_db()
-    if db is  None:
-        return []
+    if db is None:
+        raise LookupError("No database connection")
     try:
-        docs = list(db.templates.find({"user_id": user_id}, {"template_name":1, "template_content":1, "_id":0}))
-        return [(d.get("template_name"), d.get("template_content")) for d in docs]
-    except Exception as e:
-        st.error(f"Error: {e}")
-        return []
+        db = tenant_db(db, tenant_id) if tenant_of(db) is None else db
+        doc = db.template_versions.find_one({"template_id": to_object_id(template_id), "version": version}, {"content": 1})
     finally:
         client.close()
+    if doc is None:
+        raise LookupError(f"Template {template_id} has no version {version}")
+    return doc["content"]
 
-def get_Supertemplates():
+def get_template_history(db, template_id):
+    return list(db.template_versions.find({"template_id": template_id}, {"version": 1, "content": 1, "author": 1, "created_at": 1})
+                .sort("version", -1))
+
+def _backfill_summaries(db, docs):
+    """Templates saved before summaries existed get theirs written once."""
+    missing = [d["_id"] for d in docs if "summary" not in d]
+    if not missing:
+        return
+    summaries = {d["_id"]: preview.summarize(d.get("template_content"))
+                 for d in db.templates.find({"_id": {"$in": missing}}, {"template_content": 1})}
+    db.templates.bulk_write([UpdateOne({"_id": i}, {"$set": {"summary": summary}}) for i, summary in summaries.items()],
+                            ordered=False)
+    invalidation.publish(db, "templates")
+    for d in docs:
+        d.setdefault("summary", summaries.get(d["_id"]))
+
+def _load_heads(query):
     client, db = get_db()
-    if db is  None:
+    if db is None:
+        return None
+    try:
+        docs = list(db.templates.find(query, HEAD_FIELDS))
+        _backfill_summaries(db, docs)
+        return docs
+    finally:
+        client.close()
+
+def owned_templates(user_id):
+    return _heads.get(("owner", user_id), lambda: _load_heads({"user_id": user_id})) or []
+
+def available_templates(user_id):
+    """The user's own and the ready-made templates, as offered on the compose page."""
+    return _heads.get(("available", user_id), lambda: _load_heads({"$or": [{"user_id": user_id}, {"superuser": True}]})) or []
+
+def get_templates(user_id):
+    try:
+        return [(d.get("template_name"), d.get("summary")) for d in owned_templates(user_id)]
+    except Exception as e:
+        st.error(f"Error: {e}")
         return []
+
+def get_Supertemplates():
     try:
-        docs = list(db.templates.find({"superuser": True}, {"template_name":1,"template_content":1,"_id":0}))
-        return [(d.get("template_name"), d.get("template_content")) for d in docs]
+        docs = _heads.get(("superuser",), lambda: _load_heads({"superuser": True})) or []
+        return [(d.get("template_name"), d.get("summary")) for d in docs]
     except Exception as e:
         st.error(f"Error: {e}")
         return []
+
+def _load_sample():
+    client, db = get_db()
+    if db is None:
+        return None
+    try:
+        return contacts.sample_attributes(db), sorted(contacts.attribute_types(db))
     finally:
         client.close()
 
+def preview_variables():
+    """(a sample contact's attributes, every contact attribute name): what previews fill in and lint accepts."""
+    return _samples.get("sample", _load_sample) or ({}, [])
+
+def load_template_content(template):
+    """Full content of a head document listed without it; versioned templates come from the version cache."""
+    if template.get("version"):
+        return get_template_version(template["_id"], template["version"])
+    client, db = get_db()
+    if db is None:
+        return ""
+    try:
+        doc = db.templates.find_one({"_id": template["_id"]}, {"template_content": 1})
+        return (doc or {}).get("template_content") or ""
+    finally:
+        client.close()
+
+def show_preview(content):
+    """Sanitized preview as the template would be sent to a sample contact, plus anything lint would flag before a campaign."""
+    sample, names = preview_variables()
+    with metrics.timer("template_render_seconds", page="templates"):
+        st.markdown(preview.render_preview(content, sample), unsafe_allow_html=True)
+    for level, message in preview.lint(content, variables=names):
+        (st.error if level == "error" else st.warning)(message)
+
 #Display and manage templates
+@profiler.page("templates")
 def manage_templates():
     tempcss="""<style>
     @import url('https://fonts.googleapis.com/css2?family=Delius+Unicase:wght@400;700&family=DynaPuff:wght@400..700&family=Funnel+Sans:ital,wght@0,300..800;1,300..800&display=swap');
@@ -155,16 +278,17 @@ def manage_templates():
     st.subheader("Ready-made Templates")
     superuser_templates = get_Supertemplates()
     if superuser_templates:
-        st.table(pd.DataFrame(superuser_templates, columns=["Template_Name", "Template_Content"]))
+        with metrics.timer("template_render_seconds", page="templates"):
+            st.table(pd.DataFrame(superuser_templates, columns=["Template_Name", "Summary"]))
     else:
         st.write("No templates found for the superuser.")
 
     st.markdown("---------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------")
         
     st.header("User Authentication")
-    user_id = st.text_input("Enter your User ID (Leave blank for default superuser)")
+    user = search.user_picker("Your username (leave blank for the default superuser)", key="template_user")
     if st.button("Check User Status and Proceed"):
-        if check_user_and_store(user_id):
+        if check_user_and_store(user["user_id"] if user else None):
             st.success("User ID stored successfully. You can now manage templates or send emails.")
 
     # Retrieve user_id from session state
@@ -175,9 +299,30 @@ def manage_templates():
     st.subheader("Available Templates")
     user_templates = get_templates(user_id)
     if user_templates:
-        st.table(pd.DataFrame(user_templates, columns=["Template_Name", "Template_Content"]))
+        with metrics.timer("template_render_seconds", page="templates"):
+            st.table(pd.DataFrame(user_templates, columns=["Template_Name", "Summary"]))
     else:
         st.write("No templates found for this user.")
+
+    # Full content is only fetched for the template being previewed
+    preview_names = sorted({name for name, _ in superuser_templates + user_templates})
+    preview_name = st.selectbox("Preview a template", ["Select"] + preview_names)
+    if preview_name != "Select":
+        client, db = get_db()
+        if db is not None:
+            try:
+                template = db.templates.find_one(
+                    {"template_name": preview_name, "$or": [{"user_id": user_id}, {"superuser": True}]},
+                    {"template_content": 1})
+                if template:
+                    content = template.get("template_content") or ""
+                    show_preview(content)
+                    with st.expander("Full content"):
+                        st.code(content, language="html")
+            except Exception as e:
+                st.error(f"Database error: {e}")
+            finally:
+                client.close()
     st.markdown("---------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------")
         
     # Create Template
@@ -196,27 +341,37 @@ def manage_templates():
     client, db = get_db()
     if db is not None:
         try:
-            # fetch templates for this user or superuser
-            templates = list(
-                db.templates.find(
-                    {"$or": [{"user_id": user_id}, {"superuser": True}]},
-                    {"template_name": 1, "_id": 0},
-                )
-            )
-            template_options = [t["template_name"] for t in templates]
-            selected_template = st.selectbox("Select a Template to Update/Delete", template_options)
+            # only the owner's templates can be changed; ready-made ones belong to the superuser
+            templates = owned_templates(user_id)
+            template_ids = {t["template_name"]: t["_id"] for t in templates}
+            selected_template = st.selectbox("Select a Template to Update/Delete", list(template_ids))
 
             if selected_template:
                 new_content = st.text_area("New Template Content", "")
 
                 if st.button("Update Template"):
                     if new_content:
-                        update_template(selected_template, new_content)
+                        update_template(user_id, selected_template, new_content)
                     else:
                         st.warning("Please fill out the new content to update the template.")
 
                 if st.button("Delete Template"):
-                    delete_template(selected_template)
+                    delete_template(user_id, selected_template)
+
+                if st.checkbox("Show version history"):
+                    history = get_template_history(db, template_ids[selected_template])
+                    if len(history) < 2:
+                        st.write("This template has not been edited yet.")
+                    else:
+                        st.table(pd.DataFrame([{"Version": h["version"], "Author": h.get("author"), "Created": h.get("created_at")}
+                                               for h in history]))
+                        versions = {h["version"]: h["content"] for h in history}
+                        old_col, new_col = st.columns(2)
+                        old_version = old_col.selectbox("From version", list(versions), index=1)
+                        new_version = new_col.selectbox("To version", list(versions), index=0)
+                        diff = difflib.unified_diff(versions[old_version].splitlines(), versions[new_version].splitlines(),
+                                                    f"version {old_version}", f"version {new_version}", lineterm="")
+                        st.code("\n".join(diff) or "No differences.", language="diff")
         except Exception as e:
             st.error(f"Database error: {e}")
         finally:
@@ -0,0 +1,56 @@
+# test_exports.py
+"""The Streamlit export widgets, driven headlessly through AppTest against mongomock.
+
+    pip install -r requirements-dev.txt && python -m pytest -q test_exports.py
+"""
+import os
+import unittest
+
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")
+os.environ.setdefault("MASSMAIL_SCHEDULER", "none")
+os.environ.setdefault("MASSMAIL_INVALIDATION", "off")
+
+import benchmark  # noqa: E402
+
+benchmark.install_backend("mongomock")
+
+from streamlit.testing.v1 import AppTest  # noqa: E402
+import db  # noqa: E402
+
+
+def export_page(collection):
+    import exports
+    exports.show_export(collection)
+
+
+class ShowExportTest(unittest.TestCase):
+    def setUp(self):
+        client, database = db.get_db()
+        try:
+            scoped = db.tenant_db(database, db.DEFAULT_TENANT)
+            scoped.email_stats.delete_many({})
+            scoped.email_stats.insert_many([{"user_id": f"user{i}", "date": "2026-01-01", "sent": i, "messages": 1}
+                                            for i in range(3)])
+        finally:
+            client.close()
+
+    def _export(self, fmt):
+        at = AppTest.from_function(export_page, args=("email_stats",))
+        at.run()
+        at.selectbox(key="export_format_email_stats").set_value(fmt).run()
+        at.button(key="export_email_stats").click().run()
+        self.assertFalse(at.exception, at.exception)
+        self.assertFalse(at.error, [e.value for e in at.error])
+        return at
+
+    def test_every_format_offers_a_download(self):
+        import exports
+        for fmt in exports.FORMATS:
+            with self.subTest(fmt=fmt):
+                at = self._export(fmt)
+                self.assertEqual(at.success[0].value, "3 document(s) exported.")
+                self.assertEqual(len(at.get("download_button")), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+# test_invalidation.py
+"""Change-stream invalidation against a real replica set; skipped unless MONGO_REPLSET_URI names one.
+
+    docker run -d -p 27017:27017 mongo:7 --replSet rs0 && docker exec <id> mongosh --eval "rs.initiate()"
+    MONGO_REPLSET_URI="mongodb://localhost:27017/?replicaSet=rs0&directConnection=true" python -m pytest -q test_invalidation.py
+"""
+import os
+import time
+import unittest
+import uuid
+
+REPLSET_URI = os.getenv("MONGO_REPLSET_URI")
+TIMEOUT = 10  # seconds a change may take to reach the cache
+
+if REPLSET_URI:
+    # db.py and invalidation.py read these at import
+    os.environ["MONGO_URI"] = REPLSET_URI
+    os.environ["MONGO_DB"] = f"massmail_test_{uuid.uuid4().hex[:8]}"
+    os.environ["MASSMAIL_INVALIDATION"] = "changestream"
+    os.environ["MASSMAIL_SCHEDULER"] = "none"
+
+
+@unittest.skipUnless(REPLSET_URI, "set MONGO_REPLSET_URI to a replica set to run change-stream tests")
+class ChangeStreamInvalidationTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        from pymongo import MongoClient
+        import invalidation
+        cls.invalidation = invalidation
+        # A separate client stands in for another replica: its writes never go through invalidation.publish
+        cls.writer = MongoClient(REPLSET_URI)
+        cls.db = cls.writer[os.environ["MONGO_DB"]]
+        invalidation.start()
+        deadline = time.monotonic() + TIMEOUT
+        while invalidation._mode != "changestream" and time.monotonic() < deadline:
+            time.sleep(0.05)
+        if invalidation._mode != "changestream":
+            raise AssertionError("the change stream did not open")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.writer.drop_database(os.environ["MONGO_DB"])
+        cls.writer.close()
+
+    def _wait_for(self, condition):
+        deadline = time.monotonic() + TIMEOUT
+        while time.monotonic() < deadline:
+            if condition():
+                return True
+            time.sleep(0.05)
+        return False
+
+    def test_write_on_another_client_invalidates_cache(self):
+        cache = self.invalidation.CollectionCache("users", ttl=3600)
+        loads = []
+
+        def loader():
+            loads.append(1)
+            return self.db.users.count_documents({})
+
+        self.assertEqual(cache.get("count", loader), 0)
+        cache.get("count", loader)
+        self.assertEqual(len(loads), 1, "a cached value was loaded again without a write")
+
+        self.db.users.insert_one({"username": "replica-write@example.com"})
+        self.assertTrue(self._wait_for(lambda: cache.get("count", loader) == 1), "the insert did not invalidate the cache")
+
+    def test_unwatched_collection_leaves_cache(self):
+        cache = self.invalidation.CollectionCache("templates", ttl=3600)
+        cache.get("value", lambda: "cached")
+        self.db.leases.insert_one({"_id": uuid.uuid4().hex})
+        time.sleep(1)
+        self.assertEqual(cache.get("value", lambda: "reloaded"), "cached")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+# throttle.py
+import logging
+import math
+from datetime import timedelta
+from googleapiclient.errors import HttpError
+from pymongo.errors import DuplicateKeyError
+from db import now
+
+CHUNK_SECONDS = 60  # a throttled campaign releases one chunk of recipients per chunk interval
+MIN_RATE = 1  # recipients per minute; the adaptive rate never drops below this
+INCREASE_STEP = 0.1  # fraction of the target rate recovered after each clean send
+DECREASE_FACTOR = 0.5  # rate multiplier after a provider throttling error
+MAX_BACKOFF = 30 * 60  # seconds
+CAS_ATTEMPTS = 5  # tries to update a campaign's shared bucket before giving up for this round
+CONTENDED_WAIT = 1  # seconds a job waits when its bucket could not be updated
+
+logger = logging.getLogger(__name__)
+
+
+def is_throttling_error(exc):
+    """Provider errors that mean "slow down" rather than "this message is bad"."""
+    if not isinstance(exc, HttpError):
+        return False
+    status = exc.resp.status
+    if status == 403:
+        return b"rateLimitExceeded" in (exc.content or b"") or b"userRateLimitExceeded" in (exc.content or b"")
+    return status == 429 or status >= 500
+
+def plan_chunks(recipients, start, window_minutes=None, rate_per_minute=None):
+    """Split recipients into (rate, [(run_at, chunk)]) spreading delivery over the window at the target rate.
+
+    With only a window the rate is what fits the window; with only a rate the window is what the rate needs.
+    """
+    rate = rate_per_minute or math.ceil(len(recipients) / max(window_minutes or 1, 1))
+    chunk_size = max(1, math.ceil(rate * CHUNK_SECONDS / 60))
+    return rate, [
+        (start + timedelta(seconds=CHUNK_SECONDS * i), recipients[offset:offset + chunk_size])
+        for i, offset in enumerate(range(0, len(recipients), chunk_size))
+    ]
+
+
+class AdaptiveThrottle:
+    """Per-campaign token bucket whose rate backs off on provider errors and creeps back up on success.
+
+    The bucket lives in `campaign_throttles`, one document per campaign, so every worker draws from the same
+    tokens and N workers together still send at the campaign's rate. Changes are compare-and-set on a version
+    field; a TTL index drops the document once its campaign has stopped sending for a day.
+    """
+
+    def _update(self, db, key, target, change):
+        """Refill the campaign's bucket, apply change(state) and store it; returns change's result, or None
+        if other workers kept winning the race."""
+        for _ in range(CAS_ATTEMPTS):
+            doc = db.campaign_throttles.find_one({"_id": key})
+            at = now()
+            if doc is None:
+                state = {"rate": float(target), "tokens": float(target), "errors": 0}
+            else:
+                elapsed = max(0.0, (at - doc["refilled_at"]).total_seconds())  # clocks of workers may disagree
+                state = {"rate": doc["rate"], "tokens": min(float(target), doc["tokens"] + elapsed * doc["rate"] / 60),
+                         "errors": doc["errors"]}
+            result = change(state)
+            fields = {**state, "refilled_at": at, "updated_at": at}
+            try:
+                if doc is None:
+                    db.campaign_throttles.insert_one({"_id": key, **fields, "version": 1})
+                    return result
+                if db.campaign_throttles.update_one({"_id": key, "version": doc["version"]},
+                                                    {"$set": fields, "$inc": {"version": 1}}).modified_count:
+                    return result
+            except DuplicateKeyError:
+                pass  # another worker created the bucket first
+        logger.warning(f"Throttle state of campaign {key} kept changing under this worker; retrying later.")
+        return None
+
+    def acquire(self, db, key, target, cost):
+        """Take `cost` recipients from the bucket; returns 0 when allowed, else seconds to wait."""
+        cost = min(cost, target)  # a chunk larger than the bucket still goes out once it is full
+
+        def take(state):
+            if state["tokens"] >= cost:
+                state["tokens"] -= cost
+                return 0
+            return math.ceil((cost - state["tokens"]) * 60 / state["rate"])
+        wait = self._update(db, key, target, take)
+        return CONTENDED_WAIT if wait is None else wait
+
+    def on_success(self, db, key, target):
+        def recover(state):
+            state["rate"] = min(float(target), state["rate"] + target * INCREASE_STEP)
+            state["errors"] = 0
+        self._update(db, key, target, recover)
+
+    def on_error(self, db, key, target):
+        """Cut the rate and return how long the campaign should pause, growing with consecutive errors."""
+        def back_off(state):
+            state["rate"] = max(float(MIN_RATE), state["rate"] * DECREASE_FACTOR)
+            state["tokens"] = 0.0
+            state["errors"] += 1
+            return min(MAX_BACKOFF, CHUNK_SECONDS * 2 ** (state["errors"] - 1))
+        backoff = self._update(db, key, target, back_off)
+        return CHUNK_SECONDS if backoff is None else backoff
+
+    def rate(self, db, key):
+        doc = db.campaign_throttles.find_one({"_id": key}, {"rate": 1})
+        return doc["rate"] if doc else None
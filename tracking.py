@@ -0,0 +1,388 @@
+# tracking.py
+"""Delivery and engagement tracking: open pixels, click redirects, bounces and spam complaints.
+
+    MASSMAIL_TRACKING_URL=https://t.example.com MASSMAIL_TRACKING_SECRET=... python -m tracking serve [--port 8090]
+    python -m tracking bounces /var/mail/bounces      # a Maildir; or "-" for one message on stdin (MTA pipe)
+
+With MASSMAIL_TRACKING_URL and MASSMAIL_TRACKING_SECRET set, HTML messages get a 1x1 pixel and their links go
+through /c/ redirects. Both carry a signed token naming the sender's user id and the message (the scheduled
+email id), which is also sent as an X-MassMail-Token header so bounce and ARF reports that quote the original
+headers can be matched. Link targets are signed too, so the redirect cannot be used to send people elsewhere.
+
+Requests only append to an in-memory buffer; a flusher thread writes the buffer with one insert_many into
+`tracking_events`, then folds the first event of each kind per message (per address for bounces and
+complaints) into email_stats through `engagement` upserts. An engagement document stays uncounted until its
+increment is in email_stats, and each stats document remembers the last batches applied to it, so a retried
+batch neither loses nor repeats an increment. Opens and clicks are per message (a message goes to a whole
+chunk of recipients and carries one token), bounces and complaints per address; the dashboard compares
+them with email_stats.messages and .sent respectively.
+"""
+import argparse
+import base64
+import email
+import hashlib
+import hmac
+import logging
+import mailbox
+import os
+import re
+import sys
+import threading
+from collections import deque
+from email.parser import HeaderParser
+from email.utils import parseaddr
+from functools import lru_cache
+from html import unescape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+from db import DEFAULT_TENANT, get_db, now, to_object_id
+import metrics
+from mimebuilder import TOKEN_HEADER, TOKEN_VARIABLE, is_html
+
+TRACKING_URL = os.getenv("MASSMAIL_TRACKING_URL", "").rstrip("/")
+SECRET = os.getenv("MASSMAIL_TRACKING_SECRET", "").encode()
+ENABLED = bool(TRACKING_URL and SECRET)
+TRACKING_PORT = int(os.getenv("MASSMAIL_TRACKING_PORT", "8090"))
+FLUSH_SIZE = 1000  # events per insert_many
+FLUSH_INTERVAL = 1.0  # seconds between flushes when the buffer is not full
+MAX_BUFFERED = 200000  # events held while Mongo is unreachable; newer ones are dropped past this
+BATCHES_KEPT = 20  # engagement batches each email_stats document remembers, so a retry does not apply one twice
+
+OPEN, CLICK, BOUNCE, COMPLAINT = "open", "click", "bounce", "complaint"
+STAT_FIELDS = {OPEN: "opened", CLICK: "clicked", BOUNCE: "bounced", COMPLAINT: "complained"}
+PIXEL = base64.b64decode("R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7")
+LINK = re.compile(r"""(<a\b[^>]*?\bhref\s*=\s*)(["'])(https?://[^"']+)\2""", re.IGNORECASE)
+BODY_END = re.compile(r"</body\s*>", re.IGNORECASE)
+
+logger = logging.getLogger(__name__)
+
+
+def _b64(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+def _sign(value):
+    return _b64(hmac.new(SECRET, value.encode(), hashlib.sha256).digest()[:12])
+
+def make_token(user_id, message_id):
+    payload = _b64(f"{user_id}\n{message_id}".encode())
+    return f"{payload}.{_sign(payload)}"
+
+def parse_token(token):
+    """(user_id, message_id) from a token made here, or None if it is malformed or forged."""
+    payload, _, signature = (token or "").partition(".")
+    if not payload or not hmac.compare_digest(signature, _sign(payload)):
+        return None
+    try:
+        user_id, _, message_id = base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)).decode().partition("\n")
+    except ValueError:
+        return None
+    return user_id, message_id
+
+def variables(user_id, message_id):
+    """Render variables that fill the tracking token into an instrumented body; empty when tracking is off."""
+    return {TOKEN_VARIABLE: make_token(user_id, message_id)} if ENABLED else {}
+
+@lru_cache(maxsize=64)
+def instrument(body):
+    """HTML body with tracked links and an open pixel; the token is a placeholder, so this runs once per campaign.
+
+    Plain-text bodies are left alone, as are links whose target is personalized with a {{placeholder}}.
+    """
+    if not ENABLED or not is_html(body):
+        return body
+
+    def tracked(match):
+        url = unescape(match.group(3))
+        if "{{" in url:
+            return match.group(0)
+        target = f"{TRACKING_URL}/c/{{{{{TOKEN_VARIABLE}}}}}?u={quote(url, safe='')}&amp;s={_sign(url)}"
+        return f"{match.group(1)}{match.group(2)}{target}{match.group(2)}"
+
+    pixel = f'<img src="{TRACKING_URL}/o/{{{{{TOKEN_VARIABLE}}}}}.gif" width="1" height="1" alt="">'
+    body = LINK.sub(tracked, body)
+    end = BODY_END.search(body)
+    return body[:end.start()] + pixel + body[end.start():] if end else body + pixel
+
+
+def _user_tenants(db, user_ids):
+    """{user id: tenant_id} for the senders of a batch; tokens carry the user, whose document names the tenant."""
+    oids = [oid for oid in (to_object_id(u) for u in user_ids) if oid]
+    return {str(d["_id"]): d.get("tenant_id") or DEFAULT_TENANT
+            for d in db.users.find({"_id": {"$in": oids}}, {"tenant_id": 1})} if oids else {}
+
+def _count_engagement(db, pending):
+    """Add uncounted engagement documents to email_stats, once per (batch, user) even if repeated."""
+    increments = {}
+    for doc in pending:
+        fields = increments.setdefault((doc["batch"], doc["user_id"]), {})
+        fields[STAT_FIELDS[doc["type"]]] = fields.get(STAT_FIELDS[doc["type"]], 0) + 1
+    tenants = _user_tenants(db, {user_id for _, user_id in increments})
+    ops = []
+    for (batch, user_id), fields in increments.items():
+        key = {"tenant_id": tenants.get(user_id, DEFAULT_TENANT), "user_id": user_id}
+        # The stats document is made first, so the guarded $inc below can match without an upsert of its own
+        ops.append(UpdateOne(key, {"$setOnInsert": {"timestamp": now()}}, upsert=True))
+        ops.append(UpdateOne({**key, "engagement_batches": {"$ne": batch}},
+                             {"$inc": fields, "$push": {"engagement_batches": {"$each": [batch], "$slice": -BATCHES_KEPT}}}))
+    db.email_stats.bulk_write(ops, ordered=True)
+
+def write_events(db, events):
+    """Store a batch of events and fold them into email_stats; safe to repeat after a partial failure."""
+    try:
+        db.tracking_events.insert_many(events, ordered=False)
+    except BulkWriteError as e:
+        # Events carry their _id from the buffer, so a retried batch only hits duplicate keys
+        if e.details.get("writeConcernErrors") or any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+            raise
+    firsts = {}
+    for event in events:
+        if event.get("user_id") and event.get("message_id"):
+            firsts.setdefault(":".join(filter(None, (event["message_id"], event["type"], event.get("address")))), event)
+    if firsts:
+        # Only the first open/click per message (bounce/complaint per address) creates its engagement document
+        batch = ObjectId()
+        db.engagement.bulk_write([
+            UpdateOne({"_id": key}, {"$setOnInsert": {"user_id": event["user_id"], "type": event["type"], "at": event["at"],
+                                                      "batch": batch, "counted": False}}, upsert=True)
+            for key, event in firsts.items()
+        ], ordered=False)
+        # Uncounted ones include those a failed earlier attempt inserted; they keep that attempt's batch id
+        pending = list(db.engagement.find({"_id": {"$in": list(firsts)}, "counted": False}, {"user_id": 1, "type": 1, "batch": 1}))
+        if pending:
+            _count_engagement(db, pending)
+            db.engagement.update_many({"_id": {"$in": [d["_id"] for d in pending]}}, {"$set": {"counted": True}})
+    # Hard bounces and complaints go on the suppression list the schedulers check before sending
+    suppressed = {event["address"]: event for event in events if event["type"] in (BOUNCE, COMPLAINT) and event.get("address")}
+    if suppressed:
+        db.suppressions.bulk_write([
+            UpdateOne({"_id": address}, {"$setOnInsert": {"reason": event["type"], "user_id": event.get("user_id"),
+                                                          "at": event["at"]}}, upsert=True)
+            for address, event in suppressed.items()
+        ], ordered=False)
+
+
+class EventBuffer:
+    """Events appended by request threads and written in bulk by one flusher thread."""
+
+    def __init__(self, flush_size=FLUSH_SIZE, flush_interval=FLUSH_INTERVAL, max_buffered=MAX_BUFFERED):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_buffered = max_buffered
+        self._events = deque()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._events)
+
+    def add(self, event_type, user_id=None, message_id=None, **fields):
+        if len(self._events) >= self.max_buffered:
+            metrics.incr("tracking_events_dropped_total", type=event_type)
+            return False
+        self._events.append({"_id": ObjectId(), "type": event_type, "user_id": user_id, "message_id": message_id,
+                             "at": now(), **fields})
+        metrics.incr("tracking_events_total", type=event_type)
+        if len(self._events) >= self.flush_size:
+            self._wake.set()
+        return True
+
+    def flush(self):
+        """Write everything buffered, flush_size events per round trip; returns the number written."""
+        if not self._events:
+            return 0
+        client, db = get_db()
+        if db is None:
+            return 0
+        written = 0
+        try:
+            while self._events:
+                batch = []
+                while self._events and len(batch) < self.flush_size:
+                    batch.append(self._events.popleft())
+                try:
+                    with metrics.timer("tracking_flush_seconds"):
+                        write_events(db, batch)
+                except PyMongoError as e:
+                    logger.warning(f"Could not write {len(batch)} tracking event(s), retrying: {e}")
+                    self._events.extendleft(reversed(batch))
+                    break
+                written += len(batch)
+            return written
+        finally:
+            client.close()
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="tracking-flush", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join()
+        self.flush()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Tracking flush failed: {e}")
+
+
+buffer = EventBuffer()
+
+
+class TrackingHandler(BaseHTTPRequestHandler):
+    """GET /o/<token>.gif answers with the pixel; GET /c/<token>?u=<url>&s=<signature> redirects to url."""
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        path, _, query = self.path.partition("?")
+        if path.startswith("/o/") and path.endswith(".gif"):
+            ident = parse_token(path[3:-4])
+            if ident:
+                buffer.add(OPEN, *ident)
+            # A forged or stale token still gets the image, so the message renders normally
+            self._reply(200, "image/gif", PIXEL)
+        elif path.startswith("/c/"):
+            params = parse_qs(query)
+            url, signature = params.get("u", [""])[0], params.get("s", [""])[0]
+            if not url.startswith(("http://", "https://")) or not hmac.compare_digest(signature, _sign(url)):
+                self._reply(404, "text/plain", b"Not found")
+                return
+            ident = parse_token(path[3:])
+            if ident:
+                buffer.add(CLICK, *ident, url=url)
+            self._reply(302, "text/plain", b"", Location=url)
+        else:
+            self._reply(404, "text/plain", b"Not found")
+
+    def _reply(self, status, content_type, body, **headers):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-store")
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_http_server(port=TRACKING_PORT, host="0.0.0.0"):
+    """Serve the tracking endpoints from a daemon thread and start the buffer's flusher."""
+    server = ThreadingHTTPServer((host, port), TrackingHandler)
+    server.daemon_threads = True
+    buffer.start()
+    threading.Thread(target=server.serve_forever, name="tracking-http", daemon=True).start()
+    return server
+
+
+def _original_token(part):
+    """X-MassMail-Token of the original message quoted in a report, if the report kept it."""
+    if part.get_content_type() == "text/rfc822-headers":
+        headers = HeaderParser().parsestr(part.get_payload(decode=True).decode("utf-8", "replace"))
+    elif part.is_multipart():
+        headers = part.get_payload(0)
+    else:
+        return None
+    return headers.get(TOKEN_HEADER)
+
+def parse_report(message):
+    """(event type, address, token) for each failed recipient of a DSN and the complainant of an ARF report."""
+    if message.get_content_type() != "multipart/report":
+        return []
+    token, found = None, []
+    for part in message.walk():
+        content_type = part.get_content_type()
+        if content_type in ("message/rfc822", "text/rfc822-headers"):
+            token = token or _original_token(part)
+        elif content_type == "message/delivery-status":
+            for fields in part.get_payload()[1:]:  # the first block describes the reporting MTA
+                # Only permanent failures (5.x.x); delayed or transient ones may still be delivered
+                if (fields.get("Action", "").strip().lower() == "failed"
+                        and fields.get("Status", "").strip().startswith("5")):
+                    found.append((BOUNCE, fields.get("Final-Recipient") or fields.get("Original-Recipient")))
+        elif content_type == "message/feedback-report":
+            fields = part.get_payload(0)
+            found.append((COMPLAINT, fields.get("Original-Rcpt-To") or fields.get("Removal-Recipient")))
+    return [(event_type, parseaddr((address or "").rpartition(";")[2])[1].strip().lower(), token)
+            for event_type, address in found if address]
+
+def ingest_report(message, events=None):
+    """Queue the bounces and complaints in one report; returns how many were found."""
+    events = buffer if events is None else events
+    reports = parse_report(message)
+    for event_type, address, token in reports:
+        ident = parse_token(token) or (None, None)
+        events.add(event_type, *ident, address=address)
+    return len(reports)
+
+def ingest_maildir(path, events=None):
+    """Ingest every new report in a Maildir, moving each to cur/ (seen) once its events are written."""
+    events = buffer if events is None else events
+    box = mailbox.Maildir(path, factory=None, create=False)
+    done, found = [], 0
+    for key in list(box.iterkeys()):
+        message = box.get_message(key)
+        if message.get_subdir() != "new":
+            continue
+        found += ingest_report(message, events)
+        done.append((key, message))
+    events.flush()
+    if len(events):
+        raise RuntimeError(f"{len(events)} event(s) could not be written; the reports stay in new/")
+    for key, message in done:
+        message.set_subdir("cur")
+        message.add_flag("S")
+        box[key] = message
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve = commands.add_parser("serve", help="serve the open pixel and click redirects")
+    serve.add_argument("--port", type=int, default=TRACKING_PORT)
+    serve.add_argument("--host", default="0.0.0.0")
+    bounces = commands.add_parser("bounces", help="ingest DSN bounces and ARF complaints")
+    bounces.add_argument("source", help='a Maildir, or "-" to read one message from stdin')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    if args.command == "bounces":
+        if args.source == "-":
+            found = ingest_report(email.message_from_binary_file(sys.stdin.buffer))
+            buffer.flush()
+            if len(buffer):
+                parser.exit(75, "tracking: events could not be written; try again later\n")  # EX_TEMPFAIL: the MTA retries
+        else:
+            found = ingest_maildir(args.source)
+        logger.info(f"Recorded {found} bounce(s)/complaint(s).")
+        return
+    if not ENABLED:
+        parser.error("set MASSMAIL_TRACKING_URL and MASSMAIL_TRACKING_SECRET first")
+    server = start_http_server(args.port, args.host)
+    logger.info(f"Tracking on {args.host}:{server.server_port}, links point at {TRACKING_URL}.")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+        buffer.stop()
+
+
+if __name__ == "__main__":
+    main()
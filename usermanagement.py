@@ -1,103 +1,147 @@
 # usermanagement.py
 import streamlit as st
 from streamlit_option_menu import option_menu
-from hashlib import sha256
-from datetime import datetime
 import pandas as pd
+from pymongo.errors import DuplicateKeyError
 from db import get_db, now, to_object_id
-
-def get_enabled_superusers():
+import audit
+import contacts
+import exports
+import invalidation
+import passwords
+import profiler
+import search
+
+def get_user_lists():
+    """Admins, enabled users and all users from a single users query."""
     client, db = get_db()
     if db is  None:
-        return []
+        return [], [], []
     try:
-        docs = list(db.users.find({"is_superuser": True}, {"username":1}))
-        return [{"ID": str(d.get("_id")), "UserName": d.get("username")} for d in docs]
+        docs = list(db.users.find({}, {"username":1,"is_superuser":1,"is_enabled":1}))
+        rows = [({"ID": str(d.get("_id")), "UserName": d.get("username")}, d) for d in docs]
+        superusers = [row for row, d in rows if d.get("is_superuser")]
+        enabled = [row for row, d in rows if d.get("is_enabled") and not d.get("is_superuser")]
+        return superusers, enabled, [row for row, _ in rows]
     finally:
         client.close()
 
-def get_enabled_users():
-    client, db = get_db()
-    if db is  None:
-        return []
-    try:
-        docs = list(db.users.find({"is_enabled": True, "is_superuser": False}, {"username":1}))
-        return [{"ID": str(d.get("_id")), "UserName": d.get("username")} for d in docs]
-    finally:
-        client.close()
+_contacts = invalidation.CollectionCache("contacts")
 
-def get_users():
+def _load_contacts():
     client, db = get_db()
     if db is  None:
-        return []
+        return None
     try:
-        docs = list(db.users.find({}, {"username":1,"is_superuser":1}))
-        return [{"ID": str(d.get("_id")), "UserName": d.get("username")} for d in docs]
+        contacts.migrate_legacy(db)
+        return list(db.contacts.find({}, {"username":1,"added_at":1,"attributes":1}))
     finally:
         client.close()
 
+def _show_contacts(docs):
+    if docs:
+        df = pd.DataFrame([{"id":str(d.get("_id")), "username":d.get("username"), "added_at":d.get("added_at"),
+                            **(d.get("attributes") or {})} for d in docs])
+        st.dataframe(df)
+
 def get_contacts():
+    docs = _contacts.get("all", _load_contacts) or []
+    _show_contacts(docs)
+    return docs
+
+def find_contacts(conditions):
+    """Contacts matching {attribute: value or {operator: value}}, e.g. {"plan": "pro", "age": {"$gte": 30}}."""
     client, db = get_db()
     if db is  None:
         return []
     try:
-        docs = list(db.contacts.find({}, {"username":1,"added_at":1}))
-        if docs:
-            df = pd.DataFrame([{"id":str(d.get("_id")), "username":d.get("username"), "added_at":d.get("added_at")} for d in docs])
-            st.dataframe(df)
-        return docs
+        return list(db.contacts.find(contacts.segment_query(conditions), {"username":1,"added_at":1,"attributes":1}))
     finally:
         client.close()
 
+def parse_attribute_lines(text):
+    """{name: typed value} from "name=value" lines, as typed into the contact forms."""
+    attributes = {}
+    for line in (text or "").splitlines():
+        if not line.strip():
+            continue
+        name, sep, value = line.partition("=")
+        if not sep:
+            raise ValueError(f"'{line.strip()}' is not in name=value form.")
+        attributes[name.strip()] = contacts.parse_value(value)
+    return contacts.clean_attributes(attributes)
+
 def fetch_contact(id_):
     client, db = get_db()
     if db is  None:
         return None
     try:
-        doc = db.contacts.find_one({"_id": to_object_id(id_)}) or db.contacts.find_one({"id": id_})
+        doc = db.contacts.find_one({"_id": to_object_id(id_)})
         if doc:
-            return {"username": doc.get("username")}
+            return {"id": str(doc["_id"]), "username": doc.get("username"), "attributes": doc.get("attributes") or {}}
         return None
     finally:
         client.close()
 
-def is_email_in_database(username):
+def create_contact(username, attributes=None):
+    """Add one contact; an address that already exists is reported and left unchanged."""
     client, db = get_db()
     if db is  None:
-        return False
+        return {"status":"error","message":"DB failed"}
     try:
-        return db.contacts.find_one({"username": username}) is not None
+        attributes = contacts.clean_attributes(attributes)
+        res = db.contacts.bulk_write([contacts.upsert_op(username, attributes, overwrite=False)])
+        if not res.upserted_count:
+            return {"status":"error","message":f"{contacts.canonical_address(username)} already exists."}
+        contacts.record_attribute_types(db, [attributes])
+        invalidation.publish(db, "contacts", res.upserted_ids[0])
+        audit.record("contact.create", "contact", res.upserted_ids[0], contacts.canonical_address(username),
+                     attributes=sorted(attributes))
+        return {"status":"success","message":"Contact created successfully!"}
     except Exception as e:
-        st.error(f"Error checking username: {e}")
-        return False
+        return {"status":"error","message": f"Error creating contact: {e}"}
     finally:
         client.close()
 
-def create_contact(username, added_at):
-    if is_email_in_database(username):
-        return {"status":"error","message":f"{username} already exists."}
+def import_contacts(emails, attributes=None):
+    """Upsert contacts from an uploaded list in one bulk write; attributes[i] (if given) is set on emails[i].
+
+    Safe to run concurrently and to repeat: each address maps to one document, and existing contacts only
+    have the given attributes updated.
+    """
+    rows = list(zip(emails, attributes or [None] * len(emails)))
     client, db = get_db()
     if db is  None:
-        return {"status":"error","message":"DB failed"}
+        return {"status":"error","message":"DB failed","added":[],"existing":[],"duplicates":[]}
     try:
-        doc = {"username": username, "added_at": added_at}
-        db.contacts.insert_one(doc)
-        return {"status":"success","message":"Contact created successfully!"}
+        added, existing, duplicates = contacts.upsert_contacts(db, rows)
+        invalidation.publish(db, "contacts")
+        audit.record("contact.import", "contact", added=len(added), existing=len(existing), duplicates=len(duplicates))
+        return {"status":"success","message":f"{len(added)} contacts imported.","added":added,
+                "existing":existing,"duplicates":duplicates}
     except Exception as e:
-        return {"status":"error","message": f"Error creating contact: {e}"}
+        return {"status":"error","message": f"Error importing contacts: {e}","added":[],"existing":[],"duplicates":[]}
     finally:
         client.close()
 
-def update_contact(id_, username, added_at):
+def update_contact(id_, username, attributes=None):
     client, db = get_db()
     if db is  None:
         return {"status":"error","message":"DB failed"}
     try:
-        res = db.contacts.update_one({"_id": to_object_id(id_)}, {"$set":{"username": username, "added_at": added_at}})
+        attributes = contacts.clean_attributes(attributes)
+        update = {"username": contacts.canonical_address(username), "address_hash": contacts.address_hash(username),
+                  "updated_at": now(), **{f"attributes.{name}": value for name, value in attributes.items()}}
+        res = db.contacts.update_one({"_id": to_object_id(id_)}, {"$set": update})
         if res.matched_count:
+            contacts.record_attribute_types(db, [attributes])
+            invalidation.publish(db, "contacts", id_)
+            audit.record("contact.update", "contact", id_, update["username"], attributes=sorted(attributes))
             return {"status":"success","message":"Contact updated successfully."}
         else:
             return {"status":"error","message":"Contact not found."}
+    except DuplicateKeyError:
+        return {"status":"error","message":f"{contacts.canonical_address(username)} already exists."}
     except Exception as e:
         return {"status":"error","message": f"Error updating contact: {e}"}
     finally:
@@ -110,6 +154,8 @@ def delete_contact(id_):
     try:
         res = db.contacts.delete_one({"_id": to_object_id(id_)})
         if res.deleted_count:
+            invalidation.publish(db, "contacts", id_)
+            audit.record("contact.delete", "contact", id_)
             return {"status":"success","message":"Contact deleted successfully!"}
         return {"status":"error","message":"Contact not found."}
     except Exception as e:
@@ -122,11 +168,14 @@ def create_user(username, password, is_enabled=False):
     if db is  None:
         return {"status":"error","message":"DB failed"}
     try:
-        if db.users.find_one({"username": username}):
+        search.backfill_username_keys(db)
+        if db.users.find_one({"username_lc": search.username_key(username)}, {"_id":1}):
             return {"status":"error","message":"User exists"}
-        hashed = sha256(password.encode()).hexdigest()
-        doc = {"username": username, "password": hashed, "is_enabled": bool(is_enabled), "is_superuser": False, "created_at": now()}
-        db.users.insert_one(doc)
+        hashed = passwords.hash_password(password)
+        doc = {"username": username, "username_lc": search.username_key(username), "password": hashed,
+               "is_enabled": bool(is_enabled), "is_superuser": False, "created_at": now()}
+        user_id = db.users.insert_one(doc).inserted_id
+        audit.record("user.create", "user", user_id, username, is_enabled=bool(is_enabled))
         return {"status":"success","message":"User created successfully!"}
     except Exception as e:
         return {"status":"error","message": f"Error creating user: {e}"}
@@ -138,12 +187,16 @@ def update_user(user_id, username, hashed_password=None, is_enabled=False):
     if db is  None:
         return {"status":"error","message":"DB failed"}
     try:
-        query = {"_id": to_object_id(user_id)} if to_object_id(user_id) else {"id": user_id}
-        update = {"$set":{"username": username, "is_enabled": bool(is_enabled), "is_superuser": False}}
+        query = search.user_query(user_id)
+        update = {"$set":{"username": username, "username_lc": search.username_key(username),
+                          "is_enabled": bool(is_enabled), "is_superuser": False}}
         if hashed_password:
             update["$set"]["password"] = hashed_password
         res = db.users.update_one(query, update)
         if res.matched_count:
+            invalidation.publish(db, "users", user_id)
+            audit.record("user.update", "user", user_id, username, is_enabled=bool(is_enabled),
+                         password_changed=bool(hashed_password))
             return {"status":"success","message":"User updated successfully."}
         return {"status":"error","message":"User not found."}
     except Exception as e:
@@ -158,6 +211,8 @@ def delete_user(user_id):
     try:
         res = db.users.delete_one({"_id": to_object_id(user_id)})
         if res.deleted_count:
+            invalidation.publish(db, "users", user_id)
+            audit.record("user.delete", "user", user_id)
             return {"status":"success","message":"User deleted successfully!"}
         return {"status":"error","message":"User not found."}
     except Exception as e:
@@ -166,6 +221,7 @@ def delete_user(user_id):
         client.close()
 
 # Admin Dashboard
+@profiler.page("users")
 def superuser_dashboard():
         supercss="""<style>
         @import url('https://fonts.googleapis.com/css2?family=Delius+Unicase:wght@400;700&family=DynaPuff:wght@400..700&family=Funnel+Sans:ital,wght@0,300..800;1,300..800&display=swap');
@@ -208,16 +264,19 @@ def superuser_dashboard():
         
         st.title("Users Dashboard")
         
+        superusers, enabled_users, users = get_user_lists()
+
         st.subheader("List of Admins")
-        st.table(get_enabled_superusers())
+        st.table(superusers)
 
         st.subheader("List of Enabled Users")
-        st.table(get_enabled_users()) 
+        st.table(enabled_users) 
 
         st.subheader("List of All Users")
-        st.table(get_users()) 
+        st.table(users) 
 
 #User management portal
+@profiler.page("manage_users")
 def manageusers():
         usercss = """
         <style>
@@ -289,15 +348,15 @@ def manageusers():
                     
         elif action == "Update User":
             st.subheader("Update Existing User")
-            update_user_id = st.text_input("Enter User ID to Update")  # Manual ID input
-            update_username = st.text_input("Updated Username")
+            user = search.user_picker("User to update", key="update_user")
+            update_username = st.text_input("Updated Username", value=user["username"] if user else "")
             update_password = st.text_input("Updated Password", type="password")
             update_is_enabled = st.checkbox("Enable Email Permissions", value=True)  # Toggle for email permissions
 
             if st.button("Update User"):
-                if update_user_id and update_username:
+                if user and update_username:
                     # Hash the password if provided
-                    hashed_password = sha256(update_password.encode()).hexdigest() if update_password else None
+                    hashed_password = passwords.hash_password(update_password) if update_password else None
                     if update_is_enabled:
                         is_enabled=True
                         st.warning("user is enabled")
@@ -305,31 +364,32 @@ def manageusers():
                         update_is_enabled=False
                         st.warning("user is disabled")
                     # Call the update_user function with the provided inputs
-                    response = update_user(update_user_id, update_username,hashed_password,update_is_enabled)
+                    response = update_user(user["user_id"], update_username,hashed_password,update_is_enabled)
 
                     if response['status'] == "success":
                         st.success(response['message'])
                     else:
                         st.error(response['message'])
                 else:
-                    st.warning("User ID and username are required.")
+                    st.warning("Choose a user and enter a username.")
 
 
         elif action == "Delete User":
             st.subheader("Delete User")
-            delete_user_id = st.text_input("Enter User ID to Delete")  # Manual ID input
+            user = search.user_picker("User to delete", key="delete_user")
 
             if st.button("Delete User"):
-                if delete_user_id:
-                    response = delete_user(delete_user_id)
+                if user:
+                    response = delete_user(user["user_id"])
                     if response['status'] == "success":
                         st.success(response['message'])
                     else:
                         st.error(response['message'])
                 else:
-                    st.warning("User ID is required.")
+                    st.warning("Choose a user first.")
 
 #Contact Management portal
+@profiler.page("contacts")
 def managecontacts():
         contcss = """
         <style>
@@ -379,6 +439,18 @@ def managecontacts():
 
         st.subheader("Available Contacts")
         get_contacts()
+        with st.expander("Find contacts by attribute"):
+            segment = st.text_area("One name=value per line; all must match", key="contact_segment")
+            if st.button("Find contacts"):
+                try:
+                    matches = find_contacts(parse_attribute_lines(segment))
+                    st.write(f"{len(matches)} contact(s) match.")
+                    _show_contacts(matches)
+                except ValueError as e:
+                    st.error(str(e))
+        with st.expander("Export or import contacts"):
+            exports.show_export("contacts")
+            exports.show_import("contacts")
         action = st.selectbox("Select Action", ["Create Contact", "Update Contact", "Delete Contact"])
 
         if action == "Create Contact":
@@ -387,24 +459,26 @@ def managecontacts():
             
             if option == "Enter Manually":
                 new_username = st.text_input("Enter Username")
+                new_attributes = st.text_area("Attributes (optional), one name=value per line, e.g. first_name=Jane")
 
             uploaded_file = None
             if option == "Upload CSV":
                 uploaded_file = st.file_uploader("Upload CSV File", type=["csv"])
-                st.write("Contacts must be written under the column 'username'")
+                st.write("Contacts must be written under the column 'username'; any other column is stored as an attribute")
 
             if st.button("Create Contact"):
                 if option == "Enter Manually":
                     if new_username:
-                        if is_email_in_database(new_username):
+                        try:
+                            response = create_contact(new_username, parse_attribute_lines(new_attributes))
+                        except ValueError as e:
+                            response = {"status":"error","message":str(e)}
+                        if response['status'] == "success":
+                            st.success(response['message'])
+                        elif response['message'].endswith("already exists."):
                             st.warning(f"The email '{new_username}' is already in the database.")
                         else:
-                            added_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')  # ISO 8601 format
-                            response = create_contact(new_username, added_at)
-                            if response['status'] == "success":
-                                st.success(response['message'])
-                            else:
-                                st.error(response['message'])
+                            st.error(response['message'])
                     else:
                         st.warning("Username is required.")
 
@@ -416,27 +490,14 @@ def managecontacts():
                             st.error("CSV file must contain 'username' column.")
                             return
 
-                        # Initialize tracking variables
-                        duplicate_emails = []
-                        existing_emails = []
-                        added_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                        successful_contacts = []
-                        seen_emails = set()
-
-                        for _, row in df.iterrows():
-                            email = row['username']
-
-                            # Check for duplicates within the file
-                            if email in seen_emails:
-                                duplicate_emails.append(email)
-                            # Check if the email already exists in the database
-                            elif is_email_in_database(email):
-                                existing_emails.append(email)
-                            else:
-                                seen_emails.add(email)
-                                response = create_contact(email, added_at)
-                                if response['status'] == "success":
-                                    successful_contacts.append(email)
+                        attribute_columns = [c for c in df.columns if c != "username"]
+                        response = import_contacts(df['username'].tolist(),
+                                                   df[attribute_columns].to_dict("records") if attribute_columns else None)
+                        if response['status'] != "success":
+                            st.error(response['message'])
+                        successful_contacts = response['added']
+                        duplicate_emails = response['duplicates']
+                        existing_emails = response['existing']
 
                         # Display results
                         if successful_contacts:
@@ -457,11 +518,11 @@ def managecontacts():
             if "contact_details" not in st.session_state:
                 st.session_state.contact_details = None
 
-            contact_id = st.text_input("Enter ID of the contact to update")
+            contact = search.contact_picker("Contact to update", key="update_contact")
 
             if st.button("Fetch Contact"):
-                if contact_id:
-                    response = fetch_contact(contact_id)
+                if contact:
+                    response = fetch_contact(contact["id"])
                     if response:
                         st.session_state.contact_details = response  # Store contact details in session state
                         st.success("Contact details fetched successfully!")
@@ -469,19 +530,26 @@ def managecontacts():
                         st.error("Contact not found.")
                         st.session_state.contact_details = None  # Clear session state if not found
                 else:
-                    st.warning("Contact ID is required.")
+                    st.warning("Choose a contact first.")
 
             # Display and update only if contact details are fetched
             if st.session_state.contact_details:
                 current_username = st.session_state.contact_details['username']
                 st.write(f"Current Username: {current_username}")
+                current_attributes = st.session_state.contact_details.get('attributes') or {}
+                if current_attributes:
+                    st.write("Current Attributes:", current_attributes)
 
-                update_username = st.text_input("Enter Updated Username")
+                update_username = st.text_input("Enter Updated Username", value=current_username)
+                update_attributes = st.text_area("Attributes to set, one name=value per line")
 
                 if st.button("Update Contact"):
                     if update_username:
-                        added_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')  #  ISO 8601 format
-                        update_response = update_contact(contact_id, update_username, added_at)
+                        try:
+                            update_response = update_contact(st.session_state.contact_details['id'], update_username,
+                                                             parse_attribute_lines(update_attributes))
+                        except ValueError as e:
+                            update_response = {"status":"error","message":str(e)}
 
                         if update_response['status'] == "success":
                             st.success(update_response['message'])
@@ -496,17 +564,17 @@ def managecontacts():
 
         elif action == "Delete Contact":
             st.subheader("Delete Contact")
-            delete_user_id = st.text_input("Enter ID to Delete")  # Manual ID input
+            contact = search.contact_picker("Contact to delete", key="delete_contact")
 
             if st.button("Delete Contact"):
-                if delete_user_id:
-                    response = delete_contact(delete_user_id)
+                if contact:
+                    response = delete_contact(contact["id"])
                     if response['status'] == "success":
                         st.success(response['message'])
                     else:
                         st.error(response['message'])
                 else:
-                    st.warning("User ID is required.")
+                    st.warning("Choose a contact first.")
 
 
 
@@ -528,7 +596,7 @@ def app():
             with st.sidebar:
                 app=option_menu(
                     menu_title="User & Contact Management",
-                    options=['Admin Dashboard','Manage users','Manage contacts'],
+                    options=['Admin Dashboard','Manage users','Manage contacts','Audit log'],
                     default_index=0   
                 )
 
@@ -538,6 +606,8 @@ def app():
                 manageusers()
             if app=='Manage contacts':
                 managecontacts()
+            if app=='Audit log':
+                audit.show_audit_log()
 
         run()
      
@@ -0,0 +1,49 @@
+# worker.py
+"""Headless sender that owns scheduling and sending, so the Streamlit UI only enqueues.
+
+    MASSMAIL_SCHEDULER=worker streamlit run mainpage.py
+    python -m worker [--concurrency 8] [--poll-interval 5] [--claim-batch 500] [--render-processes 4]
+
+Start as many workers as the send volume needs. Each one claims due emails from scheduled_emails in batches,
+and a claim only takes emails that are still Pending, so replicas never send the same email twice. Singleton
+maintenance (stale-claim recovery, backfills) runs on whichever worker holds the lease in `leases`.
+"""
+import argparse
+import logging
+import os
+import signal
+import threading
+
+# This process is the scheduler: importing sendmail must not start an APScheduler of its own
+os.environ["MASSMAIL_SCHEDULER"] = "worker"
+
+from batchscheduler import BatchScheduler, DISPATCH_CHUNK, POLL_INTERVAL, SEND_CONCURRENCY
+from renderpool import RENDER_PROCESSES
+
+logger = logging.getLogger("worker")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=SEND_CONCURRENCY, help="sends in flight in this worker")
+    parser.add_argument("--poll-interval", type=float, default=POLL_INTERVAL, help="seconds between polls")
+    parser.add_argument("--claim-batch", type=int, default=DISPATCH_CHUNK, help="emails claimed per round")
+    parser.add_argument("--render-processes", type=int, default=RENDER_PROCESSES,
+                        help="processes rendering messages ahead of the senders (0 renders in the send threads)")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    scheduler = BatchScheduler(args.poll_interval, args.concurrency, claim_batch=args.claim_batch,
+                               render_processes=args.render_processes)
+    stopping = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: stopping.set())
+    scheduler.start()
+    logger.info(f"Worker {scheduler.worker_id} polling every {args.poll_interval}s with {args.concurrency} sender(s).")
+    stopping.wait()
+    logger.info("Stopping; finishing the sends in flight.")
+    scheduler.stop()
+
+
+if __name__ == "__main__":
+    main()